@@ -0,0 +1,190 @@
+"""
+Measures data path throughput with several clients streaming different files
+from one HttpFs server at the same time
+
+Each client is a separate process with its own keep-alive connection that
+sends framed OP_READ/OP_WRITE requests directly, so neither FUSE nor client
+side caching is involved. With positional I/O and no global lock on the
+server, aggregate throughput should keep growing with the number of clients
+up to the server's core count.
+
+    python benchmarks/concurrent_io.py --clients 1 2 4 8 --op read
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from httpfs.common import HttpFsFrame, HttpFsRequest  # noqa: E402
+
+HEADERS = {
+    "Accept": "application/json, {}".format(HttpFsFrame.CONTENT_TYPE),
+    "Content-Type": HttpFsFrame.CONTENT_TYPE,
+    "User-Agent": "HttpFsClient/bench"
+}
+
+
+def send(conn, op_type, **kwargs):
+    body = HttpFsFrame.pack_bytes(HttpFsRequest(op_type, kwargs).as_dict())
+    conn.request("POST", "/", body=body, headers=HEADERS)
+    response = conn.getresponse()
+    content = response.read()
+    if response.getheader("Content-Type", "").startswith("application/json"):
+        return json.loads(content)
+    return HttpFsFrame.unpack(content)
+
+
+def client_worker(port, path, op, chunk_size, file_size, duration, start_event, results):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    uid, gid = os.getuid(), os.getgid()
+    flags = os.O_RDONLY if op == "read" else os.O_WRONLY
+    fd = send(
+        conn, HttpFsRequest.OP_OPEN, path=path, flags=flags, uid=uid, gid=gid
+    )["response_data"]["file_descriptor"]
+    data = os.urandom(chunk_size)
+
+    start_event.wait()
+    transferred = 0
+    offset = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        if op == "read":
+            response = send(
+                conn, HttpFsRequest.OP_READ, file_descriptor=fd,
+                size=chunk_size, offset=offset, uid=uid, gid=gid
+            )
+            transferred += len(response["response_data"]["bytes_read"])
+        else:
+            response = send(
+                conn, HttpFsRequest.OP_WRITE, file_descriptor=fd,
+                data=data, offset=offset, uid=uid, gid=gid
+            )
+            transferred += response["response_data"]["bytes_written"]
+        offset = (offset + chunk_size) % file_size
+
+    send(conn, HttpFsRequest.OP_RELEASE, file_descriptor=fd)
+    results.put(transferred)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start on port {}".format(port))
+
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as fs_root:
+        max_clients = max(args.clients)
+        file_size = args.file_size * 1024**2
+        for i in range(max_clients):
+            with open(os.path.join(fs_root, "file-{}".format(i)), "wb") as f:
+                f.write(os.urandom(file_size))
+
+        server = subprocess.Popen(
+            [
+                sys.executable, "-m", "httpfs.server", str(args.port), fs_root,
+                "--workers", str(args.workers)
+            ],
+            cwd=REPO_ROOT,
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            wait_for_port(args.port)
+            for num_clients in args.clients:
+                start_event = multiprocessing.Event()
+                queue = multiprocessing.Queue()
+                procs = [
+                    multiprocessing.Process(
+                        target=client_worker,
+                        args=(
+                            args.port, "/file-{}".format(i), args.op,
+                            args.chunk_size * 1024, file_size, args.duration,
+                            start_event, queue
+                        )
+                    )
+                    for i in range(num_clients)
+                ]
+                for proc in procs:
+                    proc.start()
+                # Let every client open its file before timing starts
+                time.sleep(0.5)
+                start_event.set()
+                total = sum(queue.get() for _ in procs)
+                for proc in procs:
+                    proc.join()
+
+                mb_per_sec = total / 1024**2 / args.duration
+                results.append({
+                    "op": args.op,
+                    "clients": num_clients,
+                    "mb_per_sec": round(mb_per_sec, 2),
+                    "mb_per_sec_per_client": round(mb_per_sec / num_clients, 2)
+                })
+        finally:
+            server.terminate()
+            server.wait()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="concurrent_io")
+    parser.add_argument(
+        "--clients",
+        help="Client counts to measure",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, os.cpu_count()]
+    )
+    parser.add_argument("--op", choices=["read", "write"], default="read")
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        help="Request size in KiB",
+        type=int,
+        default=128
+    )
+    parser.add_argument(
+        "--file-size",
+        dest="file_size",
+        help="Size of each client's file in MiB",
+        type=int,
+        default=64
+    )
+    parser.add_argument(
+        "--duration",
+        help="Seconds to measure each client count",
+        type=float,
+        default=5
+    )
+    parser.add_argument(
+        "--workers",
+        help="Server worker processes",
+        type=int,
+        default=1
+    )
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    for result in run(args):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
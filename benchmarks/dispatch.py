@@ -0,0 +1,96 @@
+"""
+Measures the per-request overhead of _HttpFsRequestHandler._delegate_request
+
+Every registered op is replaced with a no-op handler and the response is
+discarded, so the numbers only cover the opcode lookup, logging, metrics,
+request timing and response hand-off, not any filesystem work or HTTP
+parsing.
+
+    python benchmarks/dispatch.py --iterations 1000000
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from httpfs.common import HttpFsRequest, HttpFsResponse  # noqa: E402
+from httpfs.server._HttpFsRequestHandler import _HttpFsRequestHandler  # noqa: E402
+from httpfs.server._RequestTimer import _RequestTimer  # noqa: E402
+from httpfs.server._ServerMetrics import _ServerMetrics  # noqa: E402
+from httpfs.server._WorkerGroup import _WorkerGroup  # noqa: E402
+
+NOOP_RESPONSE = HttpFsResponse()
+
+
+class _NoOpServer:
+    """
+    Stands in for the server of a single worker
+    """
+    _worker_group = _WorkerGroup()
+    _metrics = _ServerMetrics()
+
+    def get_worker_group(self):
+        return self._worker_group
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_slow_request_time(self):
+        return None
+
+
+class _NoOpRequestHandler(_HttpFsRequestHandler):
+    """
+    Request handler that isn't attached to a socket and sends nothing
+    """
+    # pylint: disable=super-init-not-called
+    def __init__(self):
+        self.client_address = ("127.0.0.1", 0)
+        self.server = _NoOpServer()
+        self._timer = _RequestTimer()
+        self._request_id = None
+
+    def send_httpfs_response(self, response_obj):
+        return response_obj
+
+
+def noop_handler(request_handler, httpfs_request_args):
+    return NOOP_RESPONSE
+
+
+for op_type, (op_name, _) in list(_HttpFsRequestHandler._op_handlers.items()):
+    _NoOpRequestHandler.register_op(op_type, op_name, noop_handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="dispatch")
+    parser.add_argument("--iterations", type=int, default=1000000)
+    args = parser.parse_args()
+
+    request_handler = _NoOpRequestHandler()
+    ops = [
+        ("getattr", HttpFsRequest.OP_GET_ATTR),
+        ("read", HttpFsRequest.OP_READ),
+        ("write", HttpFsRequest.OP_WRITE),
+        ("chmod", HttpFsRequest.OP_CHMOD)
+    ]
+
+    for op_name, op_type in ops:
+        request = HttpFsRequest(op_type, {})
+        elapsed = timeit.timeit(
+            lambda: request_handler._delegate_request(request),
+            number=args.iterations
+        )
+        print(json.dumps({
+            "op": op_name,
+            "ns_per_dispatch": round(elapsed / args.iterations * 1e9, 1)
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Compares the threading and asyncio server engines under many concurrent
+keep-alive connections
+
+Each connection sends getattr requests back to back for the duration of the
+run. Requests/sec and latency percentiles are reported per engine and
+connection count. The load generator is a single asyncio process, so at high
+connection counts make sure it isn't the bottleneck (compare its CPU use with
+the server's).
+
+    python benchmarks/engines.py --connections 10 100 1000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from httpfs.common import HttpFsRequest  # noqa: E402
+
+
+def build_request(path):
+    body = json.dumps(
+        HttpFsRequest(HttpFsRequest.OP_GET_ATTR, {"path": path}).as_dict()
+    ).encode("utf-8")
+    head = (
+        "POST / HTTP/1.1\r\n"
+        "Host: 127.0.0.1\r\n"
+        "User-Agent: HttpFsClient/bench\r\n"
+        "Content-Type: application/json\r\n"
+        "Content-Length: {}\r\n\r\n"
+    ).format(len(body)).encode("utf-8")
+    return head + body
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    for line in head.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.lower() == b"content-length":
+            await reader.readexactly(int(value))
+            return
+
+
+async def connection_loop(port, request, start_event, deadline, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        await start_event.wait()
+        while time.monotonic() < deadline[0]:
+            start = time.perf_counter()
+            writer.write(request)
+            await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_load(port, num_connections, duration):
+    """
+    Opens every connection first, then runs them all for duration seconds
+    :return: (request latencies, number of connections that failed)
+    """
+    request = build_request("/")
+    latencies = []
+    start_event = asyncio.Event()
+    deadline = [float("inf")]
+
+    tasks = [
+        asyncio.ensure_future(
+            connection_loop(port, request, start_event, deadline, latencies)
+        )
+        for _ in range(num_connections)
+    ]
+    # Give the server time to accept every connection
+    await asyncio.sleep(min(5, 0.5 + num_connections / 500))
+    deadline[0] = time.monotonic() + duration
+    start_event.set()
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = sum(1 for r in results if isinstance(r, Exception))
+    return latencies, errors
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start on port {}".format(port))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run(args):
+    raise_fd_limit()
+    results = []
+
+    with tempfile.TemporaryDirectory() as fs_root:
+        for engine in args.engines:
+            server = subprocess.Popen(
+                [
+                    sys.executable, "-m", "httpfs.server",
+                    str(args.port), fs_root, "--engine", engine,
+                    "--workers", str(args.workers)
+                ],
+                cwd=REPO_ROOT,
+                stdout=subprocess.DEVNULL
+            )
+            try:
+                wait_for_port(args.port)
+                for num_connections in args.connections:
+                    latencies, errors = asyncio.run(
+                        run_load(args.port, num_connections, args.duration)
+                    )
+                    latencies.sort()
+                    results.append({
+                        "engine": engine,
+                        "connections": num_connections,
+                        "failed_connections": errors,
+                        "requests_per_sec": round(len(latencies) / args.duration, 1),
+                        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+                        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)
+                    })
+            finally:
+                server.terminate()
+                server.wait()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="engines")
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["threading", "asyncio"],
+        default=["threading", "asyncio"]
+    )
+    parser.add_argument(
+        "--connections",
+        help="Concurrent connection counts to measure",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000]
+    )
+    parser.add_argument(
+        "--duration",
+        help="Seconds to measure each connection count",
+        type=float,
+        default=5
+    )
+    parser.add_argument(
+        "--workers",
+        help="Server worker processes",
+        type=int,
+        default=1
+    )
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    for result in run(args):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+"""
+Replays a trace recorded with the client's --trace against a server and
+compares the latency of every op with the traced one
+
+Traces only hold path hashes, so each traced path becomes a file, directory
+or symlink named after its hash under a scratch directory on the server.
+Paths that existed before the trace started are created first: files as
+large as the furthest traced read, and directories with as many entries as
+their largest traced listing. Ops are then issued from a pool of threads at
+the times they were traced, divided by --speed, or back to back with
+--speed 0. Files opened before the trace started are opened on their first
+use.
+
+Without --server, the trace is replayed against a server started in this
+process on a temporary directory. The client caches are on by default, like
+on the traced mount, so the server sees the same requests.
+
+    python -m httpfs.client localhost:8080 /mnt/httpfs --trace build.trace
+    python benchmarks/replay.py build.trace --speed 4 --output replay.json
+"""
+
+import argparse
+import binascii
+import concurrent.futures
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import httpfs.client.httpfs_client as httpfs_client  # noqa: E402
+from httpfs.client import HttpFsClient  # noqa: E402
+from httpfs.client.trace_recorder import TraceRecorder  # noqa: E402
+from httpfs.server import HttpFsServer  # noqa: E402
+
+# There's no FUSE request to take the caller's context from
+httpfs_client.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+
+# Ops that create their path, those that take a file handle, and those
+# whose offset holds a second path
+CREATE_OPS = ("create", "link", "mkdir", "mknod", "symlink")
+HANDLE_OPS = ("flush", "fsync", "read", "release", "write")
+TWO_PATH_OPS = ("link", "rename", "symlink")
+
+WRITE_CHUNK_SIZE = 1024**2
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return None
+    return {
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 1),
+        "p90_us": round(percentile(latencies, 0.9) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+        "max_us": round(latencies[-1] * 1e6, 1)
+    }
+
+
+class Plan:
+    """
+    What each traced path hash is and what has to exist before replaying
+    """
+
+    def __init__(self, records, root):
+        self.root = root
+        self.dirs = set()
+        self.symlinks = set()
+        # Hashes of the paths that existed before the trace started
+        self.existing = set()
+        # hash -> size of existing files, and entry count of existing dirs
+        self.sizes = dict()
+
+        seen = set()
+        for record in records:
+            if record.op in ("mkdir", "readdir", "rmdir"):
+                self.dirs.add(record.path_hash)
+            elif record.op in ("readlink", "symlink"):
+                self.symlinks.add(record.path_hash)
+
+            appearances = [(record.path_hash, record.op not in CREATE_OPS)]
+            if record.op == "link":
+                appearances.append((record.offset, True))
+            elif record.op == "rename":
+                appearances.append((record.offset, False))
+            for path_hash, must_exist in appearances:
+                if path_hash not in seen:
+                    seen.add(path_hash)
+                    if must_exist and not record.errno:
+                        self.existing.add(path_hash)
+
+            if record.op == "read":
+                size = record.offset + record.size
+            elif record.op == "readdir":
+                size = record.size
+            else:
+                continue
+            self.sizes[record.path_hash] = max(self.sizes.get(record.path_hash, 0), size)
+
+    def get_path(self, path_hash):
+        if path_hash in self.dirs:
+            kind = "d"
+        elif path_hash in self.symlinks:
+            kind = "l"
+        else:
+            kind = "f"
+        return "{}/{}{:016x}".format(self.root, kind, path_hash)
+
+    def prepare(self, client):
+        """
+        Creates the paths that existed before the trace started
+        """
+        client.mkdir(self.root, 0o755)
+        zeros = bytes(WRITE_CHUNK_SIZE)
+        for path_hash in sorted(self.existing):
+            path = self.get_path(path_hash)
+            size = self.sizes.get(path_hash, 0)
+            if path_hash in self.dirs:
+                client.mkdir(path, 0o755)
+                for i in range(size):
+                    fh = client.create("{}/e{}".format(path, i), 0o644)
+                    client.release(path, fh)
+            elif path_hash in self.symlinks:
+                client.symlink(path, self.root)
+            else:
+                fh = client.create(path, 0o644)
+                for offset in range(0, size, WRITE_CHUNK_SIZE):
+                    client.write(path, zeros[:size - offset], offset, fh)
+                client.release(path, fh)
+
+
+def remove_tree(client, path):
+    for name in list(client.readdir(path)):
+        if name in (".", ".."):
+            continue
+        entry_path = "{}/{}".format(path, name)
+        if stat.S_ISDIR(client.getattr(entry_path)["st_mode"]):
+            remove_tree(client, entry_path)
+        else:
+            client.unlink(entry_path)
+    client.rmdir(path)
+
+
+class Replayer:
+    """
+    Issues the traced ops with a pool of threads, mapping traced file
+    handles to the replay's
+
+    An op waits for the ops on the same paths that had ended when it was
+    traced, so a release doesn't overtake reads of its file and a getattr
+    doesn't overtake the create of its file.
+    """
+
+    def __init__(self, client, plan, threads):
+        self._client = client
+        self._plan = plan
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # traced fh -> future of the replay's fh
+        self._handles = dict()
+        # path hash -> [(traced end time, future)] of the ops still running
+        self._running = dict()
+        self._guard = threading.Lock()
+        # op -> latencies, and op -> number of ops that failed
+        self.latencies = dict()
+        self.errors = dict()
+        self.max_lag = 0.0
+
+    def run(self, records, speed):
+        start_time = time.perf_counter()
+        for record in records:
+            if speed > 0:
+                due = start_time + record.time / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+
+            handle = None
+            if record.op in HANDLE_OPS:
+                handle = self._handles.get(record.fh)
+                if handle is None:
+                    # Opened before the trace started
+                    handle = self._executor.submit(
+                        self._client.open, self._plan.get_path(record.path_hash), os.O_RDWR
+                    )
+                    self._handles[record.fh] = handle
+                if record.op == "release":
+                    del self._handles[record.fh]
+
+            path_hashes = [record.path_hash]
+            if record.op in TWO_PATH_OPS:
+                path_hashes.append(record.offset)
+            waits = []
+            for path_hash in path_hashes:
+                running = [
+                    (end_time, future)
+                    for end_time, future in self._running.get(path_hash, [])
+                    if not future.done()
+                ]
+                waits.extend(
+                    future for end_time, future in running if end_time <= record.time
+                )
+                self._running[path_hash] = running
+
+            future = self._executor.submit(self._replay, record, handle, waits)
+            end_time = record.time + record.latency / 1e6
+            for path_hash in path_hashes:
+                self._running[path_hash].append((end_time, future))
+            if record.op in ("create", "open") and not record.errno:
+                self._handles[record.fh] = future
+        self._executor.shutdown(wait=True)
+        return time.perf_counter() - start_time
+
+    def _replay(self, record, handle, waits):
+        client = self._client
+        path = self._plan.get_path(record.path_hash)
+        concurrent.futures.wait(waits)
+        try:
+            fh = handle.result() if handle is not None else None
+        except OSError:
+            self._add(record.op, None)
+            raise
+
+        op_start = time.perf_counter()
+        try:
+            if record.op == "access":
+                result = client.access(path, record.size)
+            elif record.op == "chmod":
+                result = client.chmod(path, record.size)
+            elif record.op == "chown":
+                result = client.chown(path, os.getuid(), os.getgid())
+            elif record.op == "create":
+                result = client.create(path, record.size)
+            elif record.op == "flush":
+                result = client.flush(path, fh)
+            elif record.op == "fsync":
+                result = client.fsync(path, False, fh)
+            elif record.op == "getattr":
+                result = client.getattr(path)
+            elif record.op == "link":
+                result = client.link(path, self._plan.get_path(record.offset))
+            elif record.op == "mkdir":
+                result = client.mkdir(path, record.size)
+            elif record.op == "mknod":
+                result = client.mknod(path, record.size, 0)
+            elif record.op == "open":
+                result = client.open(path, record.size)
+            elif record.op == "read":
+                result = client.read(path, record.size, record.offset, fh)
+            elif record.op == "readdir":
+                result = list(client.readdir(path))
+            elif record.op == "readlink":
+                result = client.readlink(path)
+            elif record.op == "release":
+                result = client.release(path, fh)
+            elif record.op == "rename":
+                result = client.rename(path, self._plan.get_path(record.offset))
+            elif record.op == "rmdir":
+                result = client.rmdir(path)
+            elif record.op == "statfs":
+                result = client.statfs(path)
+            elif record.op == "symlink":
+                result = client.symlink(path, self._plan.get_path(record.offset))
+            elif record.op == "truncate":
+                result = client.truncate(path, record.offset)
+            elif record.op == "unlink":
+                result = client.unlink(path)
+            elif record.op == "utimens":
+                result = client.utimens(path)
+            else:
+                result = client.write(path, bytes(record.size), record.offset, fh)
+        except OSError:
+            self._add(record.op, None)
+            raise
+        self._add(record.op, time.perf_counter() - op_start)
+        return result
+
+    def _add(self, op, latency):
+        with self._guard:
+            if latency is None:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            else:
+                self.latencies.setdefault(op, []).append(latency)
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def replay(args, hostname, port):
+    _, records = TraceRecorder.read_trace(args.trace)
+    records.sort(key=lambda record: record.time)
+
+    cache_args = dict(
+        attr_timeout=0, negative_timeout=0, block_cache_size=0
+    ) if args.no_client_caches else dict()
+    client = HttpFsClient(
+        hostname,
+        port,
+        api_key=args.api_key,
+        transport=args.transport,
+        max_connections=args.threads,
+        **cache_args
+    )
+    plan = Plan(records, "/replay-{}".format(binascii.hexlify(os.urandom(4)).decode()))
+    try:
+        plan.prepare(client)
+        replayer = Replayer(client, plan, args.threads)
+        elapsed = replayer.run(records, args.speed)
+        remove_tree(client, plan.root)
+    finally:
+        client.destroy("/")
+
+    traced = dict()
+    traced_errors = dict()
+    for record in records:
+        traced.setdefault(record.op, []).append(record.latency / 1e6)
+        if record.errno:
+            traced_errors[record.op] = traced_errors.get(record.op, 0) + 1
+
+    return {
+        "commit": get_commit(),
+        "trace": os.path.abspath(args.trace),
+        "ops": len(records),
+        "speed": args.speed,
+        "traced_seconds": round(records[-1].time if records else 0, 3),
+        "replayed_seconds": round(elapsed, 3),
+        "max_lag_ms": round(replayer.max_lag * 1000, 1),
+        "results": [
+            {
+                "op": op,
+                "count": len(latencies),
+                "traced": summarize(latencies),
+                "traced_errors": traced_errors.get(op, 0),
+                "replayed": summarize(replayer.latencies.get(op, [])),
+                "replayed_errors": replayer.errors.get(op, 0)
+            }
+            for op, latencies in sorted(traced.items())
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="replay")
+    parser.add_argument("trace", help="Trace recorded with the client's --trace")
+    parser.add_argument(
+        "--server",
+        help="hostname:port of the server to replay against, by default one "
+             "started in this process on a temporary directory"
+    )
+    parser.add_argument("--api-key", dest="api_key")
+    parser.add_argument(
+        "--speed",
+        help="How many times faster than traced to issue ops, 0 for as fast "
+             "as possible",
+        type=float,
+        default=1.0
+    )
+    parser.add_argument(
+        "--threads",
+        help="Max ops in flight at once",
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        "--transport",
+        choices=["requests", "http", "mux"],
+        default="http"
+    )
+    parser.add_argument(
+        "--no-client-caches",
+        dest="no_client_caches",
+        help="Turn the client's attribute and block caches off",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--output",
+        help="File to write the results to instead of stdout"
+    )
+    args = parser.parse_args()
+
+    if args.server:
+        hostname, port = args.server.rsplit(":", 1)
+        report = replay(args, hostname, int(port))
+    else:
+        with tempfile.TemporaryDirectory() as fs_root:
+            server = HttpFsServer(0, fs_root)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+            try:
+                report = replay(args, "127.0.0.1", server.server_address[1])
+            finally:
+                server.shutdown()
+                server_thread.join()
+                server.server_close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+"""
+End to end benchmarks of the common workloads, reported as JSON
+
+Starts a server on a temporary directory inside this process and drives
+HttpFsClient methods directly, so no FUSE mount is needed. Every workload
+reports ops/sec and p50/p99 latency per op:
+
+  - metadata: getattr and readdir of a directory of small files
+  - small_files: create, write 4 KiB and release new files
+  - sequential: write then read a large file in large requests
+  - random: 4 KiB reads and writes at random offsets
+  - concurrency: many client processes mixing getattr and 4 KiB reads
+
+The client's attribute and block caches are off unless --client-caches is
+given, so every op is a round trip. The server and the single client
+workloads share this process and its GIL, the concurrency workload runs its
+clients in separate processes.
+
+The results are written as one JSON document with the commit they were
+measured on. Passing an earlier document with --compare prints the change
+of every op against it, to spot regressions between commits:
+
+    python benchmarks/suite.py --output before.json
+    git checkout my-branch
+    python benchmarks/suite.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import httpfs.client.httpfs_client as httpfs_client  # noqa: E402
+from httpfs.client import HttpFsClient  # noqa: E402
+from httpfs.server import AsyncHttpFsServer, HttpFsServer  # noqa: E402
+
+# There's no FUSE request to take the caller's context from
+httpfs_client.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+
+WORKLOADS = ("metadata", "small_files", "sequential", "random", "concurrency")
+
+SMALL_FILE_SIZE = 4096
+RANDOM_IO_SIZE = 4096
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def summarize(workload, op_name, latencies, elapsed, bytes_per_op=None):
+    """
+    :param latencies: Seconds each op took
+    :param elapsed: Wall clock seconds of the whole run, which is shorter
+    than the sum of latencies when clients run concurrently
+    :param bytes_per_op: Bytes each op transfers, to also report MB/s
+    """
+    latencies = sorted(latencies)
+    result = {
+        "workload": workload,
+        "op": op_name,
+        "ops": len(latencies),
+        "ops_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 1)
+    }
+    if bytes_per_op is not None:
+        result["mb_per_sec"] = round(len(latencies) * bytes_per_op / elapsed / 1024**2, 1)
+    return result
+
+
+def time_ops(run_op, num_ops):
+    """
+    :param run_op: Called with the op's index
+    :return: (latencies, elapsed seconds)
+    """
+    latencies = []
+    start = time.perf_counter()
+    for i in range(num_ops):
+        op_start = time.perf_counter()
+        run_op(i)
+        latencies.append(time.perf_counter() - op_start)
+    return latencies, time.perf_counter() - start
+
+
+def new_client(port, args):
+    cache_args = dict() if args.client_caches else dict(
+        attr_timeout=0, negative_timeout=0, block_cache_size=0
+    )
+    return HttpFsClient(
+        "127.0.0.1",
+        port,
+        transport=args.transport,
+        max_connections=max(16, args.clients),
+        **cache_args
+    )
+
+
+def bench_metadata(client, fs_root, args):
+    os.mkdir(os.path.join(fs_root, "metadata"))
+    names = ["file-{}".format(i) for i in range(args.dir_entries)]
+    for name in names:
+        with open(os.path.join(fs_root, "metadata", name), "wb") as f:
+            f.write(b"x" * 100)
+
+    getattr_latencies, getattr_elapsed = time_ops(
+        lambda i: client.getattr("/metadata/" + names[i % len(names)]), args.ops
+    )
+    # A listing is dir_entries times the work of a getattr
+    num_listings = max(10, args.ops * 10 // args.dir_entries)
+    readdir_latencies, readdir_elapsed = time_ops(
+        lambda i: list(client.readdir("/metadata")), num_listings
+    )
+    return [
+        summarize("metadata", "getattr", getattr_latencies, getattr_elapsed),
+        summarize("metadata", "readdir", readdir_latencies, readdir_elapsed)
+    ]
+
+
+def bench_small_files(client, fs_root, args):
+    client.mkdir("/small", 0o755)
+    data = os.urandom(SMALL_FILE_SIZE)
+
+    def create_write_release(i):
+        path = "/small/file-{}".format(i)
+        fh = client.create(path, 0o644)
+        client.write(path, data, 0, fh)
+        client.release(path, fh)
+
+    latencies, elapsed = time_ops(create_write_release, args.ops)
+    return [summarize(
+        "small_files", "create_write_release", latencies, elapsed, SMALL_FILE_SIZE
+    )]
+
+
+def bench_sequential(client, fs_root, args):
+    chunk_size = args.chunk_size * 1024
+    num_chunks = args.file_size * 1024**2 // chunk_size
+    data = os.urandom(chunk_size)
+
+    fh = client.create("/sequential", 0o644)
+    write_latencies, write_elapsed = time_ops(
+        lambda i: client.write("/sequential", data, i * chunk_size, fh), num_chunks
+    )
+    client.release("/sequential", fh)
+
+    fh = client.open("/sequential", os.O_RDONLY)
+    read_latencies, read_elapsed = time_ops(
+        lambda i: client.read("/sequential", chunk_size, i * chunk_size, fh), num_chunks
+    )
+    client.release("/sequential", fh)
+    return [
+        summarize("sequential", "write", write_latencies, write_elapsed, chunk_size),
+        summarize("sequential", "read", read_latencies, read_elapsed, chunk_size)
+    ]
+
+
+def bench_random(client, fs_root, args):
+    file_size = args.file_size * 1024**2
+    with open(os.path.join(fs_root, "random"), "wb") as f:
+        f.write(os.urandom(file_size))
+    rng = random.Random(0)
+    offsets = [
+        rng.randrange(file_size // RANDOM_IO_SIZE) * RANDOM_IO_SIZE
+        for _ in range(args.ops)
+    ]
+    data = os.urandom(RANDOM_IO_SIZE)
+
+    fh = client.open("/random", os.O_RDWR)
+    read_latencies, read_elapsed = time_ops(
+        lambda i: client.read("/random", RANDOM_IO_SIZE, offsets[i], fh), args.ops
+    )
+    write_latencies, write_elapsed = time_ops(
+        lambda i: client.write("/random", data, offsets[i], fh), args.ops
+    )
+    client.release("/random", fh)
+    return [
+        summarize("random", "read", read_latencies, read_elapsed, RANDOM_IO_SIZE),
+        summarize("random", "write", write_latencies, write_elapsed, RANDOM_IO_SIZE)
+    ]
+
+
+def concurrency_worker(port, args, index, start_event, results):
+    client = new_client(port, args)
+    path = "/concurrency/file-{}".format(index)
+    rng = random.Random(index)
+    num_blocks = 1024**2 // RANDOM_IO_SIZE
+    fh = client.open(path, os.O_RDONLY)
+
+    start_event.wait()
+    latencies = {"getattr": [], "read": []}
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        client.getattr(path)
+        latencies["getattr"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        client.read(path, RANDOM_IO_SIZE, rng.randrange(num_blocks) * RANDOM_IO_SIZE, fh)
+        latencies["read"].append(time.perf_counter() - start)
+
+    client.release(path, fh)
+    client.destroy("/")
+    results.put(latencies)
+
+
+def bench_concurrency(client, fs_root, args):
+    os.mkdir(os.path.join(fs_root, "concurrency"))
+    for i in range(args.clients):
+        with open(os.path.join(fs_root, "concurrency", "file-{}".format(i)), "wb") as f:
+            f.write(os.urandom(1024**2))
+
+    # Forked so the clients inherit the patched fuse_get_context
+    context = multiprocessing.get_context("fork")
+    start_event = context.Event()
+    queue = context.Queue()
+    procs = [
+        context.Process(
+            target=concurrency_worker,
+            args=(args.port, args, i, start_event, queue)
+        )
+        for i in range(args.clients)
+    ]
+    for proc in procs:
+        proc.start()
+    # Let every client connect and open its file before timing starts
+    time.sleep(0.5)
+    start_event.set()
+    worker_latencies = [queue.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+
+    results = []
+    for op_name in ("getattr", "read"):
+        latencies = [
+            latency
+            for latencies in worker_latencies
+            for latency in latencies[op_name]
+        ]
+        result = summarize(
+            "concurrency", op_name, latencies, args.duration,
+            RANDOM_IO_SIZE if op_name == "read" else None
+        )
+        result["clients"] = args.clients
+        results.append(result)
+    return results
+
+
+BENCHMARKS = {
+    "metadata": bench_metadata,
+    "small_files": bench_small_files,
+    "sequential": bench_sequential,
+    "random": bench_random,
+    "concurrency": bench_concurrency
+}
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as fs_root:
+        server_class = AsyncHttpFsServer if args.engine == "asyncio" else HttpFsServer
+        server = server_class(args.port, fs_root)
+        args.port = server.server_address[1]
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        client = new_client(args.port, args)
+        try:
+            for workload in args.workloads:
+                results.extend(BENCHMARKS[workload](client, fs_root, args))
+        finally:
+            client.destroy("/")
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+    return {
+        "commit": get_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "engine": args.engine,
+        "transport": args.transport,
+        "client_caches": args.client_caches,
+        "results": results
+    }
+
+
+def compare(report, baseline):
+    """
+    :return: One line per op measured in both, with the change in ops/sec
+    and p99 latency
+    """
+    baseline_results = {
+        (result["workload"], result["op"]): result for result in baseline["results"]
+    }
+    lines = ["Compared with {}:".format(baseline.get("commit") or "baseline")]
+    for result in report["results"]:
+        old_result = baseline_results.get((result["workload"], result["op"]))
+        if old_result is None:
+            continue
+        lines.append("{:<12} {:<21} ops/sec {:+7.1%}  p99 {:+7.1%}".format(
+            result["workload"],
+            result["op"],
+            result["ops_per_sec"] / old_result["ops_per_sec"] - 1,
+            result["p99_us"] / old_result["p99_us"] - 1
+        ))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="suite")
+    parser.add_argument(
+        "--workloads",
+        nargs="+",
+        choices=WORKLOADS,
+        default=list(WORKLOADS)
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threading", "asyncio"],
+        default="threading"
+    )
+    parser.add_argument(
+        "--transport",
+        choices=["requests", "http", "mux"],
+        default="http"
+    )
+    parser.add_argument(
+        "--client-caches",
+        dest="client_caches",
+        help="Keep the client's attribute and block caches on",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--ops",
+        help="Number of ops to time per op of the metadata, small_files and "
+             "random workloads",
+        type=int,
+        default=2000
+    )
+    parser.add_argument(
+        "--dir-entries",
+        dest="dir_entries",
+        help="Number of files in the metadata workload's directory",
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        "--file-size",
+        dest="file_size",
+        help="Size of the sequential and random workloads' file in MiB",
+        type=int,
+        default=64
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        help="Request size of the sequential workload in KiB",
+        type=int,
+        default=1024
+    )
+    parser.add_argument(
+        "--clients",
+        help="Client processes of the concurrency workload",
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        "--duration",
+        help="Seconds to run the concurrency workload",
+        type=float,
+        default=5
+    )
+    parser.add_argument(
+        "--port",
+        help="Server port, by default any free port",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--output",
+        help="File to write the results to instead of stdout"
+    )
+    parser.add_argument(
+        "--compare",
+        help="Results of an earlier run to compare with"
+    )
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Compares the per-op latency of HttpFsClient's transports
+
+Drives HttpFsClient directly (no FUSE mount) against a local server, with
+the attribute and block caches turned off so every op is a round trip.
+Metadata ops are small, so on a LAN most of their latency is client and
+server overhead rather than the network.
+
+    python benchmarks/transport.py --transports requests http mux --ops 5000
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import httpfs.client.httpfs_client as httpfs_client  # noqa: E402
+from httpfs.client import HttpFsClient  # noqa: E402
+
+# There's no FUSE request to take the caller's context from
+httpfs_client.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server didn't start on port {}".format(port))
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def measure(client, op_name, num_ops, fh):
+    if op_name == "getattr":
+        run_op = lambda: client.getattr("/file")  # noqa: E731
+    elif op_name == "read":
+        run_op = lambda: client.read("/file", 4096, 0, fh)  # noqa: E731
+    else:
+        run_op = lambda: client.write("/file", b"x" * 4096, 0, fh)  # noqa: E731
+
+    # Warm up the connection
+    for _ in range(min(100, num_ops)):
+        run_op()
+
+    latencies = []
+    for _ in range(num_ops):
+        start = time.perf_counter()
+        run_op()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    return {
+        "op": op_name,
+        "ops_per_sec": round(num_ops / sum(latencies), 1),
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 1)
+    }
+
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as fs_root:
+        with open(os.path.join(fs_root, "file"), "wb") as f:
+            f.write(os.urandom(64 * 1024))
+
+        server = subprocess.Popen(
+            [sys.executable, "-m", "httpfs.server", str(args.port), fs_root],
+            cwd=REPO_ROOT,
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            wait_for_port(args.port)
+            for transport in args.transports:
+                client = HttpFsClient(
+                    "127.0.0.1",
+                    args.port,
+                    attr_timeout=0,
+                    negative_timeout=0,
+                    block_cache_size=0,
+                    transport=transport
+                )
+                fh = client.open("/file", os.O_RDWR)
+                for op_name in args.op_names:
+                    result = measure(client, op_name, args.ops, fh)
+                    result["transport"] = transport
+                    results.append(result)
+                client.release("/file", fh)
+        finally:
+            server.terminate()
+            server.wait()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="transport")
+    parser.add_argument(
+        "--transports",
+        nargs="+",
+        choices=["requests", "http", "mux"],
+        default=["requests", "http", "mux"]
+    )
+    parser.add_argument(
+        "--op-names",
+        dest="op_names",
+        help="Ops to measure",
+        nargs="+",
+        choices=["getattr", "read", "write"],
+        default=["getattr", "read", "write"]
+    )
+    parser.add_argument(
+        "--ops",
+        help="Number of ops to time per transport and op",
+        type=int,
+        default=5000
+    )
+    parser.add_argument("--port", type=int, default=8090)
+    args = parser.parse_args()
+
+    for result in run(args):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,109 @@ PARSER.add_argument(
     help="API key if the server uses authentication",
     default=None
 )
+PARSER.add_argument(
+    "--attr-timeout",
+    dest="attr_timeout",
+    help="Seconds to cache file attributes, 0 to disable (default: 1)",
+    type=float,
+    default=1.0
+)
+PARSER.add_argument(
+    "--negative-timeout",
+    dest="negative_timeout",
+    help="Seconds to cache that a path doesn't exist, 0 to disable (default: 1)",
+    type=float,
+    default=1.0
+)
+PARSER.add_argument(
+    "--block-cache-size",
+    dest="block_cache_size",
+    help="MiB of memory for cached file data, 0 to disable (default: 64)",
+    type=int,
+    default=64
+)
+PARSER.add_argument(
+    "--max-read-ahead",
+    dest="max_read_ahead",
+    help="Max KiB to read ahead of sequential reads (default: 4096)",
+    type=int,
+    default=4096
+)
+PARSER.add_argument(
+    "--disk-cache-dir",
+    dest="disk_cache_dir",
+    help="Directory to also cache file data in, kept across remounts",
+    default=None
+)
+PARSER.add_argument(
+    "--disk-cache-size",
+    dest="disk_cache_size",
+    help="MiB of disk space for the disk cache (default: 10240)",
+    type=int,
+    default=10240
+)
+PARSER.add_argument(
+    "--invalidation-events",
+    dest="invalidation_events",
+    help="Listen for changes made by other clients, to drop stale cached "
+         "attributes and data right away",
+    action="store_true"
+)
+PARSER.add_argument(
+    "--write-buffer-size",
+    dest="write_buffer_size",
+    help="KiB of contiguous writes to buffer per open file, 0 to send every "
+         "write right away (default: 0)",
+    type=int,
+    default=0
+)
+PARSER.add_argument(
+    "--write-flush-interval",
+    dest="write_flush_interval",
+    help="Max seconds a buffered write waits before being sent (default: 1)",
+    type=float,
+    default=1.0
+)
+PARSER.add_argument(
+    "--max-connections",
+    dest="max_connections",
+    help="Max concurrent connections to the server (default: 16)",
+    type=int,
+    default=16
+)
+PARSER.add_argument(
+    "--transport",
+    dest="transport",
+    help="HTTP implementation to send requests with, http is leaner and "
+         "mux sends all requests over one connection (default: requests)",
+    choices=["requests", "http", "mux"],
+    default="requests"
+)
+PARSER.add_argument(
+    "--compression",
+    dest="compression",
+    help="Compress request and response bodies, for slow links",
+    action="store_true"
+)
+PARSER.add_argument(
+    "--latency-stats",
+    dest="latency_stats",
+    help="Break down where the time of requests goes per op, logged on unmount",
+    action="store_true"
+)
+PARSER.add_argument(
+    "--slow-request-ms",
+    dest="slow_request_ms",
+    help="Log requests taking longer than this many milliseconds, with "
+         "where their time went",
+    type=float
+)
+PARSER.add_argument(
+    "--trace",
+    dest="trace_file",
+    help="Record every filesystem op to this file, for benchmarks/replay.py",
+    default=None
+)
 PARSER.add_argument(
     "--verbose",
     dest="verbose",
@@ -58,7 +161,29 @@ try:
 
     # Mount the filesystem
     FUSE(
-        HttpFsClient(HOSTNAME, PORT, api_key=ARGS.api_key, ca_file=ARGS.ca_file),
+        HttpFsClient(
+            HOSTNAME,
+            PORT,
+            api_key=ARGS.api_key,
+            ca_file=ARGS.ca_file,
+            attr_timeout=ARGS.attr_timeout,
+            negative_timeout=ARGS.negative_timeout,
+            block_cache_size=ARGS.block_cache_size * 1024**2,
+            max_read_ahead=ARGS.max_read_ahead * 1024,
+            disk_cache_dir=ARGS.disk_cache_dir,
+            disk_cache_size=ARGS.disk_cache_size * 1024**2,
+            write_buffer_size=ARGS.write_buffer_size * 1024,
+            write_flush_interval=ARGS.write_flush_interval,
+            max_connections=ARGS.max_connections,
+            transport=ARGS.transport,
+            compression=ARGS.compression,
+            latency_stats=ARGS.latency_stats,
+            slow_request_time=(
+                ARGS.slow_request_ms / 1000 if ARGS.slow_request_ms is not None else None
+            ),
+            trace_file=ARGS.trace_file,
+            invalidation_events=ARGS.invalidation_events
+        ),
         ARGS.mount,
         foreground=True,
         allow_other=True
@@ -0,0 +1,107 @@
+"""
+Contains a TTL cache for file attributes returned by getattr
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class AttrCache:
+    """
+    Thread-safe cache of getattr results keyed by path
+
+    Entries expire after a TTL. Paths that don't exist are cached too
+    (negative entries) with their own, usually shorter, TTL. The cache is an
+    LRU bounded to max_entries paths.
+    """
+
+    def __init__(self, attr_timeout=1.0, negative_timeout=1.0, max_entries=65536):
+        """
+        :param attr_timeout: Seconds to cache the attributes of a path, 0
+        disables the cache
+        :param negative_timeout: Seconds to remember that a path doesn't
+        exist, 0 disables negative caching
+        :param max_entries: Max number of paths to cache
+        """
+        self._attr_timeout = attr_timeout
+        self._negative_timeout = negative_timeout
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # path -> (expiry time, attrs dict or None if the path doesn't exist)
+        self._entries = OrderedDict()
+
+    def get(self, path):
+        """
+        :param path: Path to look up
+        :return: (True, attrs) on a hit, where attrs is None for a cached
+        ENOENT, or (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return False, None
+
+            expiry, attrs = entry
+            if expiry < time.monotonic():
+                del self._entries[path]
+                return False, None
+
+            self._entries.move_to_end(path)
+            return True, attrs
+
+    def put(self, path, attrs):
+        """
+        Caches the attributes of an existing path
+        :param path: Path the attributes belong to
+        :param attrs: The getattr result dict
+        """
+        if self._attr_timeout > 0:
+            self._put(path, attrs, self._attr_timeout)
+
+    def put_negative(self, path):
+        """
+        Caches that a path doesn't exist
+        :param path: The missing path
+        """
+        if self._negative_timeout > 0:
+            self._put(path, None, self._negative_timeout)
+
+    def invalidate(self, *paths):
+        """
+        Drops the cached entries for the given paths
+        """
+        with self._lock:
+            for path in paths:
+                self._entries.pop(path, None)
+
+    def invalidate_tree(self, path):
+        """
+        Drops the cached entries for a path and everything below it
+        :param path: A directory or file path
+        """
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            self._entries.pop(path, None)
+            for cached_path in [p for p in self._entries if p.startswith(prefix)]:
+                del self._entries[cached_path]
+
+    def invalidate_entry(self, path):
+        """
+        Drops the entries changed by creating or removing path: the path
+        itself and its parent directory, whose mtime and nlink change
+        :param path: The path being created or removed
+        """
+        self.invalidate(path, os.path.dirname(path.rstrip("/")) or "/")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _put(self, path, attrs, timeout):
+        with self._lock:
+            self._entries[path] = (time.monotonic() + timeout, attrs)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,189 @@
+"""
+Contains an in-memory LRU cache of file data blocks
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class FetchToken:
+    """
+    Marks an in-flight fetch of a path's blocks, so data fetched before an
+    invalidation of the path is never cached
+    """
+    __slots__ = ("path", "stale", "version")
+
+    def __init__(self, path, version=None):
+        self.path = path
+        self.stale = False
+        # The path's version in the DiskCache when the fetch started
+        self.version = version
+
+
+class BlockCache:
+    """
+    Thread-safe LRU cache of fixed size file blocks keyed by (path, index)
+
+    A block shorter than block_size is the last block of the file. The total
+    size of the cached blocks never exceeds max_bytes. With a DiskCache,
+    fetched blocks are also stored on disk, and blocks missing from memory
+    are looked up there before they're fetched from the server.
+    """
+    DEFAULT_BLOCK_SIZE = 128 * 1024
+
+    def __init__(self, max_bytes, block_size=DEFAULT_BLOCK_SIZE, disk_cache=None):
+        """
+        :param max_bytes: Memory cap for the cached blocks
+        :param block_size: Size of a block in bytes
+        :param disk_cache: Optional DiskCache with the same block size
+        """
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+        self._disk_cache = disk_cache
+        self._lock = threading.Lock()
+        self._cached_bytes = 0
+        # (path, index) -> block bytes, least recently used first
+        self._blocks = OrderedDict()
+        # path -> set of cached block indexes, for invalidation
+        self._path_blocks = dict()
+        # path -> set of FetchTokens of in-flight fetches
+        self._fetches = dict()
+
+    def get_block_size(self):
+        return self._block_size
+
+    def get(self, path, index):
+        """
+        :param path: Path of the file
+        :param index: Index of the block in the file
+        :return: The block, or None if it isn't cached
+        """
+        key = (path, index)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                return block
+        if self._disk_cache is None:
+            return None
+
+        token = self.begin_fetch(path)
+        try:
+            block = self._disk_cache.get(path, index)
+            if block is not None and len(block) <= self._max_bytes:
+                with self._lock:
+                    if not token.stale:
+                        self._insert(path, index, block)
+            return block
+        finally:
+            self.end_fetch(token)
+
+    def contains(self, path, index):
+        """
+        :return: Whether the block is cached in memory or on disk, without
+        reading it from disk
+        """
+        with self._lock:
+            if (path, index) in self._blocks:
+                return True
+        return self._disk_cache is not None and self._disk_cache.contains(path, index)
+
+    def begin_fetch(self, path):
+        """
+        Registers a fetch of some of path's blocks
+        :param path: Path of the file being read
+        :return: The FetchToken to pass to put() and end_fetch()
+        """
+        version = None
+        if self._disk_cache is not None:
+            version = self._disk_cache.get_version(path)
+        token = FetchToken(path, version)
+        with self._lock:
+            self._fetches.setdefault(path, set()).add(token)
+        return token
+
+    def end_fetch(self, token):
+        with self._lock:
+            path_fetches = self._fetches.get(token.path)
+            if path_fetches is not None:
+                path_fetches.discard(token)
+                if not path_fetches:
+                    del self._fetches[token.path]
+
+    def put(self, token, index, block):
+        """
+        Caches a fetched block, unless its path was invalidated during the
+        fetch
+        :param token: The FetchToken returned by begin_fetch()
+        :param index: Index of the block in the file
+        :param block: The block's bytes
+        """
+        if self._disk_cache is not None and not token.stale:
+            self._disk_cache.put(token.path, token.version, index, block)
+        if len(block) > self._max_bytes:
+            return
+
+        with self._lock:
+            if not token.stale:
+                self._insert(token.path, index, block)
+
+    def invalidate(self, path, changed=True):
+        """
+        Drops path's cached blocks and the results of its in-flight fetches
+        :param path: Path of the file
+        :param changed: Whether the file changed. If it was only reopened,
+        its blocks stay on disk until the DiskCache revalidates them.
+        """
+        with self._lock:
+            for token in self._fetches.get(path, ()):
+                token.stale = True
+
+            for index in self._path_blocks.pop(path, ()):
+                self._cached_bytes -= len(self._blocks.pop((path, index)))
+
+        if self._disk_cache is not None:
+            if changed:
+                self._disk_cache.invalidate(path)
+            else:
+                self._disk_cache.forget(path)
+
+    def invalidate_all(self):
+        """
+        Drops every cached block and the results of all in-flight fetches.
+        Blocks on disk stay until the DiskCache revalidates them.
+        """
+        with self._lock:
+            for path_fetches in self._fetches.values():
+                for token in path_fetches:
+                    token.stale = True
+            self._blocks.clear()
+            self._path_blocks.clear()
+            self._cached_bytes = 0
+
+        if self._disk_cache is not None:
+            self._disk_cache.forget_all()
+
+    def _insert(self, path, index, block):
+        """
+        Adds a block, evicting the least recently used ones if needed, must
+        hold _lock
+        """
+        key = (path, index)
+        old_block = self._blocks.pop(key, None)
+        if old_block is not None:
+            self._cached_bytes -= len(old_block)
+
+        self._blocks[key] = block
+        self._cached_bytes += len(block)
+        self._path_blocks.setdefault(path, set()).add(index)
+
+        while self._cached_bytes > self._max_bytes:
+            (lru_path, lru_index), lru_block = self._blocks.popitem(last=False)
+            self._cached_bytes -= len(lru_block)
+            self._discard_index(lru_path, lru_index)
+
+    def _discard_index(self, path, index):
+        path_blocks = self._path_blocks[path]
+        path_blocks.discard(index)
+        if not path_blocks:
+            del self._path_blocks[path]
@@ -0,0 +1,63 @@
+"""
+Contains a thread-safe pool of keep-alive connections to the server
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of keep-alive HTTP connections to the server
+
+    requests.Session isn't thread-safe, so each thread gets its own session.
+    All sessions share one HTTPAdapter whose urllib3 pool holds at most
+    max_connections connections: a thread checks a connection out for the
+    duration of a request and waits for one when they're all in use.
+    urllib3 checks that a pooled connection is still open before reusing it,
+    and failed connection attempts are retried.
+    """
+    # Connection attempts before giving up on the server
+    _CONNECT_RETRIES = 3
+
+    def __init__(self, max_connections, headers):
+        """
+        :param max_connections: Max number of open connections to the server
+        :param headers: Headers sent with every request
+        """
+        self._headers = headers
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            pool_block=True,
+            # Requests may not be idempotent, so only retry connecting
+            max_retries=Retry(
+                total=ConnectionPool._CONNECT_RETRIES,
+                connect=ConnectionPool._CONNECT_RETRIES,
+                read=0,
+                redirect=0,
+                status=0
+            )
+        )
+        self._local = threading.local()
+
+    def get_session(self):
+        """
+        :return: The calling thread's requests.Session
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update(self._headers)
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+        return session
+
+    def reset(self):
+        """
+        Closes every pooled connection, they're reopened when needed
+        """
+        self._adapter.close()
@@ -0,0 +1,393 @@
+"""
+Contains a persistent on-disk cache of file data blocks
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class DiskCache:
+    """
+    Thread-safe LRU cache of file blocks in a local directory, which keeps
+    them across remounts
+
+    Blocks are stored one per file under blocks/, and indexed in an SQLite
+    database by the path, mtime and size of the file they were read from.
+    A path's blocks are only served after validate() was called with the
+    file's current mtime and size, usually on open, so blocks of a file that
+    changed while unmounted are dropped instead. The total size of the
+    cached blocks never exceeds max_bytes, the least recently used ones are
+    evicted first.
+
+    Only one mount can use a cache directory at a time.
+    """
+    _INDEX_FILE = "index.sqlite"
+    _LOCK_FILE = "lock"
+    _BLOCKS_DIR = "blocks"
+
+    # Number of cache hits whose use time is written to the index together
+    _TOUCH_BATCH = 256
+
+    def __init__(self, cache_dir, max_bytes, block_size):
+        """
+        :param cache_dir: Directory to keep the cache in, created if needed
+        :param max_bytes: Disk space cap for the cached blocks
+        :param block_size: Size of a block in bytes, the cache is emptied if
+        it was filled with a different block size
+        :raise OSError: EBUSY if another mount uses the cache directory
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+        self._guard = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, DiskCache._BLOCKS_DIR), exist_ok=True)
+
+        self._lock_fd = os.open(
+            os.path.join(cache_dir, DiskCache._LOCK_FILE), os.O_CREAT | os.O_RDWR, 0o600
+        )
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self._lock_fd)
+            raise OSError(errno.EBUSY, "Cache directory is in use", cache_dir)
+
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, DiskCache._INDEX_FILE),
+            check_same_thread=False,
+            isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "path TEXT UNIQUE NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blocks (file_id INTEGER NOT NULL, "
+            "block_index INTEGER NOT NULL, length INTEGER NOT NULL, "
+            "last_used REAL NOT NULL, PRIMARY KEY (file_id, block_index))"
+        )
+
+        # path -> (file_id, mtime, size) of the files with cached blocks
+        self._files = dict()
+        # (file_id, block index) -> block length, least recently used first
+        self._blocks = OrderedDict()
+        # file_id -> set of cached block indexes, for invalidation
+        self._file_blocks = dict()
+        self._cached_bytes = 0
+        # path -> (mtime, size) validated since mounting
+        self._current = dict()
+        # (file_id, block index) -> time of the hits not written to the index
+        self._touched = dict()
+        self._load()
+
+    def _load(self):
+        """
+        Reads the index, dropping what doesn't match the blocks on disk
+        """
+        row = self._db.execute(
+            "SELECT value FROM settings WHERE name = 'block_size'"
+        ).fetchone()
+        if row is None or row[0] != self._block_size:
+            if row is not None:
+                logging.info("Block size changed, emptying %s", self._cache_dir)
+            self._db.execute("DELETE FROM blocks")
+            self._db.execute("DELETE FROM files")
+            self._db.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('block_size', ?)",
+                (self._block_size,)
+            )
+
+        self._db.execute(
+            "DELETE FROM files WHERE file_id NOT IN (SELECT file_id FROM blocks)"
+        )
+        for file_id, path, mtime, size in self._db.execute(
+                "SELECT file_id, path, mtime, size FROM files"):
+            self._files[path] = (file_id, mtime, size)
+        for file_id, index, length in self._db.execute(
+                "SELECT file_id, block_index, length FROM blocks ORDER BY last_used"):
+            self._add_block((file_id, index), length)
+
+        # Blocks written by a mount that died before indexing them, or whose
+        # index entries were lost
+        blocks_dir = os.path.join(self._cache_dir, DiskCache._BLOCKS_DIR)
+        on_disk = set()
+        for sub_dir in os.listdir(blocks_dir):
+            for name in os.listdir(os.path.join(blocks_dir, sub_dir)):
+                file_id, _, index = name.partition("-")
+                try:
+                    key = (int(file_id), int(index))
+                except ValueError:
+                    key = None
+                if key in self._blocks:
+                    on_disk.add(key)
+                else:
+                    os.unlink(os.path.join(blocks_dir, sub_dir, name))
+        missing = [key for key in self._blocks if key not in on_disk]
+        for key in missing:
+            self._remove_block(key)
+        self._db.executemany(
+            "DELETE FROM blocks WHERE file_id = ? AND block_index = ?", missing
+        )
+
+        to_delete = self._evict_over_limit()
+        self._delete_block_files(to_delete)
+
+    def validate(self, path, mtime, size):
+        """
+        Makes path's blocks available if they were read from the file with
+        the same mtime and size, and drops them otherwise
+        :param path: Path of the file
+        :param mtime: The file's current st_mtime
+        :param size: The file's current st_size
+        """
+        with self._guard:
+            self._current[path] = (mtime, size)
+            file_row = self._files.get(path)
+            if file_row is None or file_row[1:] == (mtime, size):
+                return
+            to_delete = self._drop_file(path)
+        self._delete_block_files(to_delete)
+
+    def get_version(self, path):
+        """
+        :param path: Path of the file
+        :return: The (mtime, size) path was validated with, None if its
+        blocks can't be used
+        """
+        with self._guard:
+            return self._current.get(path)
+
+    def forget(self, path):
+        """
+        Stops serving path's blocks until it's validated again, e.g. when
+        it's reopened and may have been changed by another client
+        :param path: Path of the file
+        """
+        with self._guard:
+            self._current.pop(path, None)
+
+    def forget_all(self):
+        """
+        Stops serving any blocks until their paths are validated again
+        """
+        with self._guard:
+            self._current.clear()
+
+    def invalidate(self, path):
+        """
+        Drops path's blocks, e.g. when this client changed the file
+        :param path: Path of the file
+        """
+        with self._guard:
+            self._current.pop(path, None)
+            to_delete = self._drop_file(path)
+        self._delete_block_files(to_delete)
+
+    def contains(self, path, index):
+        """
+        :return: Whether the block can be served, without reading it
+        """
+        with self._guard:
+            return self._get_key(path, index) in self._blocks
+
+    def get(self, path, index):
+        """
+        :param path: Path of the file
+        :param index: Index of the block in the file
+        :return: The block, or None if it isn't cached or path isn't validated
+        """
+        with self._guard:
+            key = self._get_key(path, index)
+            length = self._blocks.get(key)
+            if length is None:
+                return None
+            self._blocks.move_to_end(key)
+
+        try:
+            with open(self._get_block_file(key), "rb", buffering=0) as block_file:
+                block = block_file.read()
+        except OSError as e:
+            # Evicted meanwhile, or removed from the cache directory
+            logging.debug("Can't read cached block: %s", e)
+            block = None
+
+        with self._guard:
+            if block is None or len(block) != length:
+                if self._blocks.get(key) == length:
+                    self._remove_block(key)
+                    self._db.execute(
+                        "DELETE FROM blocks WHERE file_id = ? AND block_index = ?", key
+                    )
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= DiskCache._TOUCH_BATCH:
+                self._write_touched()
+        return block
+
+    def put(self, path, version, index, block):
+        """
+        Caches a block read from the server
+        :param path: Path of the file
+        :param version: What get_version() returned before the block was
+        read, the block isn't cached unless the path still has that version
+        :param index: Index of the block in the file
+        :param block: The block's bytes
+        """
+        if version is None or len(block) > self._max_bytes:
+            return
+
+        to_delete = []
+        with self._guard:
+            if self._current.get(path) != version:
+                return
+            file_row = self._files.get(path)
+            if file_row is not None and file_row[1:] != version:
+                to_delete = self._drop_file(path)
+                file_row = None
+            if file_row is None:
+                file_id = self._db.execute(
+                    "INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                    (path,) + version
+                ).lastrowid
+                file_row = self._files[path] = (file_id,) + version
+            key = (file_row[0], index)
+            if key in self._blocks:
+                return
+        self._delete_block_files(to_delete)
+
+        block_file = self._get_block_file(key)
+        temp_file = "{}.{}.tmp".format(block_file, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(block_file), exist_ok=True)
+            with open(temp_file, "wb") as f:
+                f.write(block)
+            os.replace(temp_file, block_file)
+        except OSError as e:
+            logging.warning("Can't write to the disk cache: %s", e)
+            return
+
+        with self._guard:
+            # The file changed or was evicted while the block was written
+            if self._files.get(path, (None,))[0] != key[0] or key in self._blocks:
+                to_delete = [key] if key not in self._blocks else []
+            else:
+                self._add_block(key, len(block))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)",
+                    key + (len(block), time.time())
+                )
+                to_delete = self._evict_over_limit()
+        self._delete_block_files(to_delete)
+
+    def get_cached_bytes(self):
+        """
+        :return: Total size of the cached blocks
+        """
+        return self._cached_bytes
+
+    def close(self):
+        """
+        Writes out the pending use times and releases the cache directory
+        """
+        with self._guard:
+            self._write_touched()
+            self._db.close()
+        os.close(self._lock_fd)
+
+    def _get_key(self, path, index):
+        """
+        :return: The (file_id, index) of a block of a validated path, None
+        otherwise. Must hold _guard.
+        """
+        file_row = self._files.get(path)
+        if file_row is None or self._current.get(path) != file_row[1:]:
+            return None
+        return (file_row[0], index)
+
+    def _get_block_file(self, key):
+        file_id, index = key
+        return os.path.join(
+            self._cache_dir,
+            DiskCache._BLOCKS_DIR,
+            "{:02x}".format(file_id & 0xFF),
+            "{}-{}".format(file_id, index)
+        )
+
+    def _drop_file(self, path):
+        """
+        Removes a path and its blocks from the index, must hold _guard
+        :return: The keys of the block files to delete outside the lock
+        """
+        file_row = self._files.pop(path, None)
+        if file_row is None:
+            return []
+        file_id = file_row[0]
+        keys = [(file_id, index) for index in self._file_blocks.get(file_id, ())]
+        for key in keys:
+            self._remove_block(key)
+        self._db.execute("DELETE FROM blocks WHERE file_id = ?", (file_id,))
+        self._db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+        return keys
+
+    def _evict_over_limit(self):
+        """
+        Removes the least recently used blocks while over max_bytes, must
+        hold _guard
+        :return: The keys of the block files to delete outside the lock
+        """
+        evicted = []
+        while self._cached_bytes > self._max_bytes:
+            key = next(iter(self._blocks))
+            self._remove_block(key)
+            evicted.append(key)
+        if evicted:
+            self._db.executemany(
+                "DELETE FROM blocks WHERE file_id = ? AND block_index = ?", evicted
+            )
+        return evicted
+
+    def _add_block(self, key, length):
+        """
+        Adds a block to the in-memory index, must hold _guard
+        """
+        self._blocks[key] = length
+        self._cached_bytes += length
+        self._file_blocks.setdefault(key[0], set()).add(key[1])
+
+    def _remove_block(self, key):
+        """
+        Removes a block from the in-memory index, must hold _guard
+        """
+        self._cached_bytes -= self._blocks.pop(key)
+        self._touched.pop(key, None)
+        file_blocks = self._file_blocks[key[0]]
+        file_blocks.discard(key[1])
+        if not file_blocks:
+            del self._file_blocks[key[0]]
+
+    def _write_touched(self):
+        """
+        Writes the use times of recent hits to the index, must hold _guard
+        """
+        self._db.executemany(
+            "UPDATE blocks SET last_used = ? WHERE file_id = ? AND block_index = ?",
+            [(used, file_id, index) for (file_id, index), used in self._touched.items()]
+        )
+        self._touched.clear()
+
+    def _delete_block_files(self, keys):
+        for key in keys:
+            try:
+                os.unlink(self._get_block_file(key))
+            except OSError as e:
+                logging.debug("Error deleting cached block: %s", e)
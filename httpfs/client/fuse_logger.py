@@ -2,7 +2,9 @@
 Contains a class for modifying the default FUSE logger
 """
 
+import errno
 import logging
+import time
 
 
 class _FuseLogger:
@@ -14,13 +16,23 @@ class _FuseLogger:
     def __call__(self, operation, path, *args):
         self.log.debug('-> %s %s', operation, path)
         ret = '[Unhandled Exception]'
+        start_time = time.perf_counter()
+        error = errno.EIO
         try:
             ret = getattr(self, operation)(path, *args)
+            if self._trace_recorder is not None and operation == "readdir":
+                # fusepy lists the whole directory anyway, the trace records
+                # the number of entries
+                ret = list(ret)
+            error = 0
             return ret
         except OSError as exception:
             ret = str(exception)
+            error = exception.errno or errno.EIO
             raise
         finally:
+            if self._trace_recorder is not None:
+                self._trace_recorder.record(operation, path, args, ret, error, start_time)
             if isinstance(ret, Exception):
                 self.log.warning('<- %s %s', operation, repr(ret))
             else:
@@ -6,16 +6,34 @@ Contains a class to be passed to fusepy.FUSE to handle filesystem operations
 
 import base64
 import binascii
+import ctypes
 import errno
+import itertools
 import logging
 import os
+import sqlite3
+import stat
 import time
 
+import fuse
 import requests
+import ujson
 from fuse import Operations, FuseOSError, fuse_get_context
 
-from httpfs.common import HttpFsRequest, HttpFsResponse
+from httpfs.common import (
+    HttpFsRequest, HttpFsResponse, HttpFsFrame, HttpFsCompression, HttpFsEvent
+)
+from .attr_cache import AttrCache
+from .block_cache import BlockCache
+from .connection_pool import ConnectionPool
+from .disk_cache import DiskCache
 from .fuse_logger import _FuseLogger
+from .invalidation_listener import InvalidationListener
+from .latency_stats import LatencyStats
+from .read_ahead import ReadAhead
+from .trace_recorder import TraceRecorder
+from .transport import HttpTransport, MuxTransport, RequestsTransport
+from .write_back import WriteBack
 
 
 class HttpFsClient(_FuseLogger, Operations):
@@ -25,12 +43,71 @@ class HttpFsClient(_FuseLogger, Operations):
 
     client_version = 0.1
     _ONE_KILOBYTE = 1024
+    _BYTES_TYPES = (bytes, bytearray, memoryview)
 
-    def __init__(self, hostname, port, api_key=None, ca_file=None):
+    def __init__(
+            self,
+            hostname,
+            port,
+            api_key=None,
+            ca_file=None,
+            binary_frames=True,
+            attr_timeout=1.0,
+            negative_timeout=1.0,
+            readdir_page_size=1024,
+            block_cache_size=64 * 1024**2,
+            max_read_ahead=4 * 1024**2,
+            disk_cache_dir=None,
+            disk_cache_size=10 * 1024**3,
+            write_buffer_size=0,
+            write_flush_interval=1.0,
+            max_connections=16,
+            transport="requests",
+            compression=False,
+            latency_stats=False,
+            slow_request_time=None,
+            trace_file=None,
+            invalidation_events=False
+    ):
         """
         Constructor
         :param server: The server to connect to
         :param ca_file: Optional CA cert file if the server uses HTTPS
+        :param binary_frames: Send read/write data as raw binary frames
+        instead of base64 in JSON, if the server supports it
+        :param attr_timeout: Seconds to cache getattr results, 0 disables
+        the attribute cache
+        :param negative_timeout: Seconds to cache that a path doesn't exist,
+        0 disables negative caching
+        :param readdir_page_size: Number of directory entries to request per
+        readdir page
+        :param block_cache_size: Memory cap in bytes for cached file data, 0
+        disables the block cache and read-ahead
+        :param max_read_ahead: Max number of bytes to fetch ahead of a
+        sequential reader
+        :param disk_cache_dir: Optional directory to also cache file data in,
+        which keeps it across remounts. Needs the block cache.
+        :param disk_cache_size: Disk space cap in bytes for the disk cache
+        :param write_buffer_size: Bytes of contiguous writes to buffer per
+        file handle before sending them, 0 sends every write right away
+        :param write_flush_interval: Max seconds a write stays buffered
+        :param max_connections: Max number of concurrent connections to the
+        server, shared by all FUSE threads
+        :param transport: "requests" to send requests with the requests
+        library, "http" for the leaner HttpTransport, or "mux" to send all
+        requests over one multiplexed connection
+        :param compression: Compress request and response bodies with a
+        coding both sides support, for slow links
+        :param latency_stats: Break down where the time of each request went
+        per op, logged on unmount
+        :param slow_request_time: Seconds after which a request is logged
+        with its breakdown, None to log none
+        :param trace_file: Optional file to record a trace of every FUSE op
+        to, see TraceRecorder
+        :param invalidation_events: Listen for the changes other clients
+        make and drop what they make stale right away, see
+        InvalidationListener. While events arrive, cached file data is kept
+        when files are reopened.
         """
         # Now we can use ipv6 addr
         self.server_hostname = hostname
@@ -38,16 +115,135 @@ class HttpFsClient(_FuseLogger, Operations):
         if ca_file is not None and os.path.exists(ca_file):
             os.environ["REQUESTS_CA_BUNDLE"] = ca_file
             self._server_url += "s"
+        else:
+            ca_file = None
         self._server_url += "://{}:{}".format(hostname, port)
-        self._http_keepalive_session = requests.Session()
-        self._http_keepalive_session.headers.update({
-            "Accept": "application/json",
-            "Accept-Encoding": "identity",
+
+        # The transport decodes responses, requests only what urllib3 supports
+        accept_encoding = HttpFsCompression.IDENTITY
+        if compression:
+            codings = HttpFsCompression.get_codings()
+            if transport == "requests":
+                codings = [
+                    c for c in codings if c in RequestsTransport.DECODED_CODINGS
+                ]
+            accept_encoding = ", ".join(codings) or accept_encoding
+
+        default_headers = {
+            "Accept": "application/json, {}".format(HttpFsFrame.CONTENT_TYPE),
+            "Accept-Encoding": accept_encoding,
             "User-Agent": "HttpFsClient/{}".format(HttpFsClient.client_version),
             "Host": self.server_hostname
-        })
+        }
+        if transport == "http":
+            self._connection_pool = None
+            self._transport = HttpTransport(
+                hostname,
+                port,
+                default_headers,
+                ca_file=ca_file,
+                max_connections=max_connections
+            )
+        elif transport == "mux":
+            self._connection_pool = None
+            self._transport = MuxTransport(
+                hostname,
+                port,
+                default_headers,
+                ca_file=ca_file,
+                max_connections=max_connections
+            )
+        elif transport == "requests":
+            self._connection_pool = ConnectionPool(max_connections, default_headers)
+            self._transport = RequestsTransport(
+                self._server_url, self._connection_pool
+            )
+        else:
+            raise ValueError("Unknown transport '{}'".format(transport))
         self._api_key = api_key
 
+        # Turned off if the server turns out not to understand frames
+        self._binary_frames = binary_frames
+        # Turned off if the server turns out not to implement READDIR_PLUS
+        self._readdir_plus = True
+        # Turned off if the server turns out not to implement COMPOUND
+        self._compound = True
+        self._compression = compression
+        # Coding to compress request bodies with, once the server advertised
+        # one it supports
+        self._request_coding = None
+        self._readdir_page_size = readdir_page_size
+
+        self._disk_cache = None
+        if disk_cache_dir is not None and block_cache_size <= 0:
+            logging.warning("The disk cache needs the block cache, not using it")
+        elif disk_cache_dir is not None:
+            try:
+                self._disk_cache = DiskCache(
+                    disk_cache_dir, disk_cache_size, BlockCache.DEFAULT_BLOCK_SIZE
+                )
+            except (OSError, sqlite3.Error) as e:
+                logging.warning("Not using the disk cache: %s", e)
+
+        if block_cache_size > 0:
+            self._read_ahead = ReadAhead(
+                self._read_remote,
+                BlockCache(block_cache_size, disk_cache=self._disk_cache),
+                max_read_ahead
+            )
+        else:
+            self._read_ahead = None
+
+        if write_buffer_size > 0:
+            self._write_back = WriteBack(
+                self._write_remote,
+                write_buffer_size,
+                flush_interval=write_flush_interval
+            )
+        else:
+            self._write_back = None
+
+        self._attr_cache = AttrCache(attr_timeout, negative_timeout)
+
+        # Request ids are unique per mount, so they can be found in the
+        # server's logs
+        self._request_id_prefix = binascii.hexlify(os.urandom(4)).decode()
+        self._request_ids = itertools.count(1)
+        self._log_latency_stats = latency_stats
+        if latency_stats or slow_request_time is not None:
+            self._latency_stats = LatencyStats(slow_request_time)
+        else:
+            self._latency_stats = None
+
+        if trace_file is not None:
+            self._trace_recorder = TraceRecorder(trace_file)
+        else:
+            self._trace_recorder = None
+
+        self._invalidation_listener = None
+        if invalidation_events:
+            listener_headers = {"User-Agent": default_headers["User-Agent"]}
+            if api_key is not None:
+                listener_headers["Authorization"] = api_key
+            self._invalidation_listener = InvalidationListener(
+                self._server_url,
+                listener_headers,
+                self._on_remote_change,
+                self._on_events_lost,
+                origin=self._request_id_prefix
+            )
+        # libfuse's struct fuse and fuse_invalidate_path(), once mounted, if
+        # this libfuse has it
+        self._fuse = None
+        self._fuse_invalidate_path = None
+
+    @property
+    def _http_keepalive_session(self):
+        """
+        The calling thread's requests.Session
+        """
+        return self._connection_pool.get_session()
+
     # Unimplemented filesystem ops
     bmap = None
     getxattr = None
@@ -56,13 +252,18 @@ class HttpFsClient(_FuseLogger, Operations):
     def _send_request(self, request_type, **kwargs):
         """
         Sends an HttpFsRequest of the given type with the given kwargs
+        Bytes arguments are sent raw in a binary frame when the server
+        supports it, and as base64 strings in JSON otherwise
         :param request_type: The request type to send
         :param kwargs: The arguments for the request
         :return: The HttpFsResponse
         """
+        timings = {"start": time.perf_counter()}
         request = HttpFsRequest(
             request_type,
-            kwargs
+            kwargs,
+            request_id="{}-{:x}".format(self._request_id_prefix, next(self._request_ids)),
+            timing=self._latency_stats is not None
         )
 
         try:
@@ -70,30 +271,64 @@ class HttpFsClient(_FuseLogger, Operations):
             if self._api_key is not None:
                 headers["Authorization"] = self._api_key
 
-            response = self._http_keepalive_session.post(
-                self._server_url,
-                json=request.as_dict(),
-                allow_redirects=False,
-                timeout=10,
-                headers=headers,
-                stream=True
-            )
+            send_frame = self._binary_frames and self._has_bytes(kwargs)
 
-            response.raise_for_status()
+            response = self._post_request(request, headers, send_frame, timings)
 
-            # Minimal server response validation
-            is_json = response.headers.get("Content-Type").startswith(
-                "application/json"
-            )
-            is_httpfs_server = response.headers.get("Server").startswith(
-                "HttpFs"
-            )
-            if not is_json or not is_httpfs_server:
-                logging.error("Server response didn't come from HttpFs")
-                raise FuseOSError(errno.EIO)
+            # Error responses aren't read, closing them is what returns their
+            # connection to the pool
+            try:
+                # Servers without frame support reject the Content-Type before
+                # running the request, so it's safe to resend it as JSON
+                rejection = self._get_rejection(response)
+                if send_frame and rejection == "Incompatible Content-Type":
+                    logging.warning("Server doesn't support binary frames, using JSON")
+                    self._binary_frames = False
+                    # The server didn't read the frame body, so the connection
+                    # can't be reused
+                    response.close()
+                    self._transport.reset()
+                    response = self._post_request(request, headers, False, timings)
+
+                # Older servers don't know newer request types, ENOSYS lets
+                # callers fall back to what those servers support
+                if self._get_rejection(response) == "Method not implemented":
+                    raise FuseOSError(errno.ENOSYS)
+
+                response.raise_for_status()
+
+                # Minimal server response validation
+                content_type = response.headers.get("Content-Type")
+                is_json = content_type.startswith("application/json")
+                is_frame = content_type.startswith(HttpFsFrame.CONTENT_TYPE)
+                is_httpfs_server = response.headers.get("Server").startswith(
+                    "HttpFs"
+                )
+                if not (is_json or is_frame) or not is_httpfs_server:
+                    logging.error("Server response didn't come from HttpFs")
+                    raise FuseOSError(errno.EIO)
+
+                if self._compression and self._request_coding is None:
+                    self._request_coding = HttpFsCompression.choose(
+                        response.headers.get("Accept-Encoding")
+                    )
+
+                # Copy the payloads out, the transport may reuse its buffer
+                if is_frame:
+                    response_obj = HttpFsResponse.from_dict(
+                        HttpFsFrame.unpack(response.content, copy_payloads=True)
+                    )
+                else:
+                    response_obj = HttpFsResponse.from_dict(response.json())
 
-            return HttpFsResponse.from_dict(response.json())
+                if self._latency_stats is not None:
+                    self._record_latency(request, response, timings)
+                return response_obj
+            finally:
+                response.close()
 
+        except FuseOSError:
+            raise
         except requests.exceptions.HTTPError as http_error:
             logging.error(http_error)
             raise FuseOSError(errno.EACCES)
@@ -101,6 +336,266 @@ class HttpFsClient(_FuseLogger, Operations):
             logging.error(exception)
             raise FuseOSError(errno.EIO)
 
+    def _post_request(self, request, headers, send_frame, timings):
+        """
+        POSTs the request to the server, either as a binary frame or as JSON,
+        compressed if the server supports it and it's worth it
+        :param request: The HttpFsRequest to send
+        :param headers: Per-request headers
+        :param send_frame: Whether to send a binary frame
+        :param timings: Dict the times the request was sent and its response
+        received are stored in, as "sent" and "received"
+        :return: The transport's response
+        """
+        if send_frame:
+            content_type = HttpFsFrame.CONTENT_TYPE
+            body = HttpFsFrame.pack_bytes(request.as_dict())
+        else:
+            json_dict = HttpFsRequest(
+                request.get_type(),
+                self._encode_bytes(request.get_args()),
+                request_id=request.get_request_id(),
+                timing=request.is_timing_requested()
+            ).as_dict()
+            # The transport serializes JSON it doesn't have to compress
+            if self._request_coding is None:
+                timings["sent"] = time.perf_counter()
+                response = self._transport.post(headers, json_dict=json_dict)
+                timings["received"] = time.perf_counter()
+                return response
+            content_type = "application/json"
+            body = ujson.dumps(json_dict).encode("utf-8")
+
+        headers = dict(headers, **{"Content-Type": content_type})
+        coding = self._request_coding
+        if coding is not None and HttpFsCompression.is_compressible(len(body), body):
+            headers["Content-Encoding"] = coding
+            body = HttpFsCompression.compress(coding, body)
+        timings["sent"] = time.perf_counter()
+        response = self._transport.post(headers, data=body)
+        timings["received"] = time.perf_counter()
+        return response
+
+    def _record_latency(self, request, response, timings):
+        """
+        Records where the time of a request went, see LatencyStats
+        :param request: The HttpFsRequest
+        :param response: The transport's response
+        :param timings: The times set by _send_request() and _post_request()
+        """
+        end_time = time.perf_counter()
+        server_phases = LatencyStats.parse_server_timing(
+            response.headers.get(HttpFsResponse.SERVER_TIMING_HEADER)
+        )
+        round_trip = timings["received"] - timings["sent"]
+        phases = {
+            "serialize": timings["sent"] - timings["start"],
+            "network": max(0.0, round_trip - sum(server_phases.values())),
+            "deserialize": end_time - timings["received"]
+        }
+        for phase, seconds in server_phases.items():
+            phases[LatencyStats.SERVER_PREFIX + phase] = seconds
+        self._latency_stats.record(
+            request.get_type(), request.get_request_id(), phases
+        )
+
+    def get_latency_stats(self):
+        """
+        :return: The LatencyStats, or None if latency isn't tracked
+        """
+        return self._latency_stats
+
+    @staticmethod
+    def _has_bytes(value):
+        """
+        :param value: Request args, or a value in them
+        :return: Whether value holds a bytes-like value at any depth
+        """
+        if isinstance(value, HttpFsClient._BYTES_TYPES):
+            return True
+        if isinstance(value, dict):
+            return any(HttpFsClient._has_bytes(v) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return any(HttpFsClient._has_bytes(v) for v in value)
+        return False
+
+    @staticmethod
+    def _encode_bytes(value):
+        """
+        :param value: Request args, or a value in them
+        :return: A copy of value with bytes-like values as base64 strings
+        """
+        if isinstance(value, HttpFsClient._BYTES_TYPES):
+            return base64.standard_b64encode(value).decode("utf-8")
+        if isinstance(value, dict):
+            return {k: HttpFsClient._encode_bytes(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [HttpFsClient._encode_bytes(v) for v in value]
+        return value
+
+    @staticmethod
+    def _get_rejection(response):
+        """
+        :param response: The requests.Response to a request
+        :return: The server's message if it rejected the request without
+        running it, None otherwise
+        """
+        if response.status_code != requests.codes.bad_request:
+            return None
+        try:
+            return response.json()["response_data"]["message"]
+        except Exception:
+            return None
+
+    def compound(self, sub_requests, stop_on_error=True):
+        """
+        Runs several requests in one round trip, in order
+        Args of a request can take values from the responses of earlier
+        requests with HttpFsRequest.ref(), e.g. to read from a file opened
+        by the same compound request. Servers without OP_COMPOUND get the
+        requests one by one.
+        :param sub_requests: List of (request type, args dict)
+        :param stop_on_error: Whether to skip the requests after one fails,
+        they get an ECANCELED response. Releases of handles opened by
+        requests that succeeded still run.
+        :return: List of the HttpFsResponses of the requests
+        """
+        if self._compound:
+            try:
+                response_obj = self._send_request(
+                    HttpFsRequest.OP_COMPOUND,
+                    requests=[
+                        HttpFsRequest(request_type, args).as_dict()
+                        for request_type, args in sub_requests
+                    ],
+                    stop_on_error=stop_on_error
+                )
+            except FuseOSError as fuse_error:
+                if fuse_error.errno != errno.ENOSYS:
+                    raise
+                logging.warning("Server doesn't support compound requests")
+                self._compound = False
+            else:
+                if response_obj.is_error():
+                    logging.error(response_obj.get_data()["message"])
+                    raise FuseOSError(response_obj.get_error_no())
+                return [
+                    HttpFsResponse.from_dict(sub_response)
+                    for sub_response in response_obj.get_data()["responses"]
+                ]
+
+        return self._run_requests(sub_requests, stop_on_error)
+
+    def _run_requests(self, sub_requests, stop_on_error):
+        """
+        Sends compound requests one by one, as the server would run them
+        """
+        responses = []
+        for request_type, args in sub_requests:
+            failed = [r for r in responses if r.is_error()]
+            if failed and stop_on_error and request_type != HttpFsRequest.OP_RELEASE:
+                responses.append(HttpFsResponse(
+                    errno.ECANCELED, {"message": "Skipped after an earlier error"}
+                ))
+                continue
+
+            resolved_args = dict()
+            for key, value in args.items():
+                if isinstance(value, dict) and HttpFsRequest.REF_KEY in value:
+                    step, result_key = value[HttpFsRequest.REF_KEY]
+                    if not 0 <= step < len(responses) or responses[step].is_error():
+                        resolved_args = None
+                        break
+                    value = responses[step].get_data()[result_key]
+                resolved_args[key] = value
+
+            if resolved_args is None:
+                responses.append(HttpFsResponse(
+                    errno.ECANCELED, {"message": "Referenced step failed"}
+                ))
+            else:
+                responses.append(self._send_request(request_type, **resolved_args))
+        return responses
+
+    def _invalidate_data(self, path, changed=True):
+        """
+        Drops the cached data of a file changed or reopened by this client
+        :param path: Path of the file
+        :param changed: Whether the file changed. The disk cache keeps the
+        data of reopened files until _validate_data() checks it.
+        """
+        if self._read_ahead is not None:
+            self._read_ahead.invalidate(path, changed)
+
+    def _validate_data(self, path):
+        """
+        Lets the disk cache serve the data it has of a file just opened, if
+        the file's mtime and size didn't change since it was cached
+        :param path: Path of the file
+        """
+        if self._disk_cache is None:
+            return
+        try:
+            attrs = self.getattr(path)
+        except FuseOSError:
+            return
+        if stat.S_ISREG(attrs["st_mode"]):
+            self._disk_cache.validate(path, attrs["st_mtime"], attrs["st_size"])
+
+    def _has_live_events(self):
+        """
+        :return: Whether the changes of other clients are reported right
+        now, so cached data stays valid until one is
+        """
+        return self._invalidation_listener is not None and \
+            self._invalidation_listener.is_live()
+
+    def _on_remote_change(self, event):
+        """
+        Drops what is cached about a path another client changed, including
+        the kernel's attributes and pages, see InvalidationListener
+        :param event: The HttpFsEvent
+        """
+        path = event.get_path()
+        change = event.get_change()
+        if change == HttpFsEvent.TREE:
+            self._attr_cache.invalidate_tree(path)
+        if change in (HttpFsEvent.ENTRY, HttpFsEvent.TREE):
+            self._attr_cache.invalidate_entry(path)
+            self._invalidate_kernel(os.path.dirname(path))
+        else:
+            self._attr_cache.invalidate(path)
+        if change != HttpFsEvent.ATTR:
+            self._invalidate_data(path)
+        self._invalidate_kernel(path)
+
+    def _on_events_lost(self):
+        """
+        Drops everything cached, when changes of other clients may have been
+        missed
+        """
+        logging.info("Missed changes on the server, dropping the caches")
+        self._attr_cache.clear()
+        if self._read_ahead is not None:
+            self._read_ahead.invalidate_all()
+
+    def _invalidate_kernel(self, path):
+        """
+        Makes the kernel drop its cached attributes and pages of a path
+        :param path: Path in the mount
+        """
+        if self._fuse_invalidate_path is not None:
+            # Returns -ENOENT if the kernel doesn't know the path, which is fine
+            self._fuse_invalidate_path(self._fuse, path.encode("utf-8"))
+
+    def _flush_path(self, path):
+        """
+        Sends the buffered writes to path, before an op that must see them
+        :param path: Path of the file
+        """
+        if self._write_back is not None:
+            self._write_back.flush_path(path)
+
     def access(self, path, mode):
         """
         Check file access permissions
@@ -138,6 +633,8 @@ class HttpFsClient(_FuseLogger, Operations):
             uid=uid,
             gid=gid
         )
+        self._attr_cache.invalidate_entry(path)
+        self._invalidate_data(path)
 
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
@@ -159,6 +656,7 @@ class HttpFsClient(_FuseLogger, Operations):
             uid=uid,
             gid=gid
         )
+        self._attr_cache.invalidate(path)
 
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
@@ -180,6 +678,7 @@ class HttpFsClient(_FuseLogger, Operations):
             caller_uid=caller_uid,
             caller_gid=caller_gid
         )
+        self._attr_cache.invalidate(path)
 
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
@@ -195,6 +694,9 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: Optional file handle for the file to flush
         :return:
         """
+        if self._write_back is not None:
+            self._write_back.flush_handle(fh)
+
         response_obj = self._send_request(
             HttpFsRequest.OP_FLUSH,
             file_descriptor=fh
@@ -214,6 +716,9 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: Optional file handle for the file to sync
         :return:
         """
+        if self._write_back is not None:
+            self._write_back.flush_handle(fh)
+
         response_obj = self._send_request(
             HttpFsRequest.OP_FSYNC,
             file_descriptor=fh,
@@ -231,10 +736,22 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: None if the current file isn't open
         :return:
         """
+        self._flush_path(path)
+
+        is_cached, attrs = self._attr_cache.get(path)
+        if is_cached:
+            if attrs is None:
+                raise FuseOSError(errno.ENOENT)
+            return attrs
+
         response_obj = self._send_request(HttpFsRequest.OP_GET_ATTR, path=path)
         if response_obj.get_error_no() == 0:
-            return response_obj.get_data()
+            attrs = response_obj.get_data()
+            self._attr_cache.put(path, attrs)
+            return attrs
 
+        if response_obj.get_error_no() == errno.ENOENT:
+            self._attr_cache.put_negative(path)
         raise FuseOSError(response_obj.get_error_no())
 
     def link(self, target, source):
@@ -246,6 +763,9 @@ class HttpFsClient(_FuseLogger, Operations):
         """
         response_obj = self._send_request(
             HttpFsRequest.OP_LINK, target=target, source=source)
+        # The new link's entry and the original's link count both change
+        self._attr_cache.invalidate_entry(target)
+        self._attr_cache.invalidate_entry(source)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -259,6 +779,7 @@ class HttpFsClient(_FuseLogger, Operations):
         """
         response_obj = self._send_request(
             HttpFsRequest.OP_MKDIR, path=path, mode=mode)
+        self._attr_cache.invalidate_entry(path)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -276,6 +797,7 @@ class HttpFsClient(_FuseLogger, Operations):
         """
         response_obj = self._send_request(
             HttpFsRequest.OP_MKNOD, path=path, mode=mode, dev=dev)
+        self._attr_cache.invalidate_entry(path)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -288,6 +810,9 @@ class HttpFsClient(_FuseLogger, Operations):
         :return:
         """
         uid, gid, _ = fuse_get_context()
+        if self._can_prime(path, flags):
+            return self._open_primed(path, flags, uid, gid)
+
         response_obj = self._send_request(
             HttpFsRequest.OP_OPEN,
             path=path,
@@ -295,13 +820,81 @@ class HttpFsClient(_FuseLogger, Operations):
             uid=uid,
             gid=gid
         )
+        if flags & (os.O_CREAT | os.O_TRUNC):
+            self._attr_cache.invalidate_entry(path)
+        # Another client may have changed the file since it was cached,
+        # unless that would have been reported
+        if flags & os.O_TRUNC or not self._has_live_events():
+            self._invalidate_data(path, changed=bool(flags & os.O_TRUNC))
 
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
 
+        if flags & os.O_ACCMODE != os.O_WRONLY:
+            self._validate_data(path)
         return response_obj.get_data()["file_descriptor"]
 
+    def _can_prime(self, path, flags):
+        """
+        :return: Whether to read a file along with opening it, which is done
+        for files opened read-only that fit in one cached block
+        """
+        if self._read_ahead is None or not self._compound:
+            return False
+        if flags & os.O_ACCMODE != os.O_RDONLY or flags & os.O_TRUNC:
+            return False
+
+        _, attrs = self._attr_cache.get(path)
+        if attrs is None or not stat.S_ISREG(attrs["st_mode"]) or not (
+                0 < attrs["st_size"] <= self._read_ahead.get_block_size()):
+            return False
+
+        # No need to read what is cached, if the file didn't change
+        if self._has_live_events() and self._read_ahead.contains(path, 0):
+            return False
+        return self._disk_cache is None or not (
+            self._disk_cache.get_version(path) == (attrs["st_mtime"], attrs["st_size"])
+            and self._disk_cache.contains(path, 0)
+        )
+
+    def _open_primed(self, path, flags, uid, gid):
+        """
+        Opens a small file and reads it into the block cache in one round
+        trip, so the reads that usually follow are served from the cache
+        """
+        # Buffered writes must reach the server before the file is read
+        self._flush_path(path)
+        if not self._has_live_events():
+            self._invalidate_data(path, changed=False)
+        self._validate_data(path)
+
+        token = self._read_ahead.begin_prime(path)
+        data = None
+        try:
+            open_response, read_response = self.compound([
+                (HttpFsRequest.OP_OPEN, dict(
+                    path=path, flags=flags, uid=uid, gid=gid
+                )),
+                (HttpFsRequest.OP_READ, dict(
+                    file_descriptor=HttpFsRequest.ref(0),
+                    size=self._read_ahead.get_block_size(),
+                    offset=0,
+                    uid=uid,
+                    gid=gid
+                ))
+            ])
+            if not read_response.is_error():
+                data = self._decode_bytes(read_response.get_data()["bytes_read"])
+        finally:
+            self._read_ahead.end_prime(token, data)
+
+        if open_response.is_error():
+            logging.error(open_response.get_data()["message"])
+            raise FuseOSError(open_response.get_error_no())
+
+        return open_response.get_data()["file_descriptor"]
+
     def read(self, path, size, offset, fh=None):
         """
         Read at most size bytes from the file at path or fh. Start reading
@@ -312,6 +905,17 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: Optional file handle
         :return:
         """
+        self._flush_path(path)
+
+        if self._read_ahead is not None:
+            return self._read_ahead.read(path, size, offset, fh)
+
+        return self._read_remote(path, size, offset, fh)
+
+    def _read_remote(self, path, size, offset, fh):
+        """
+        Reads from the server, bypassing the block cache
+        """
         uid, gid, _ = fuse_get_context()
         response_obj = self._send_request(
             HttpFsRequest.OP_READ,
@@ -330,8 +934,19 @@ class HttpFsClient(_FuseLogger, Operations):
             )
             raise FuseOSError(response_obj.get_error_no())
 
+        return self._decode_bytes(response_obj.get_data()["bytes_read"])
+
+    @staticmethod
+    def _decode_bytes(value):
+        """
+        :param value: Bytes from a response, raw or as a base64 string
+        :return: The bytes
+        """
+        if not isinstance(value, str):
+            return bytes(value)
+
         try:
-            return base64.standard_b64decode(response_obj.get_data()["bytes_read"])
+            return base64.standard_b64decode(value)
         except binascii.Error as encoding_error:
             logging.error("Error decoding read data: '%s'", encoding_error)
             raise FuseOSError(errno.EIO)
@@ -339,21 +954,82 @@ class HttpFsClient(_FuseLogger, Operations):
     def readdir(self, path, fh=None):
         """
         Return the directory listing at path
+        The listing is fetched one page at a time as it is iterated, so huge
+        directories are never held in memory
         :param path: Path to directory to list
         :param fh: Optional file handle for the directory
-        :return: List of directory entries
+        :return: Iterator over the directory entries
         """
         uid, gid, _ = fuse_get_context()
-        response_obj = self._send_request(
-            HttpFsRequest.OP_READDIR,
+
+        # Fetch the first page now so errors are raised by readdir itself
+        response_obj = self._send_readdir(
             path=path,
             uid=uid,
-            gid=gid
+            gid=gid,
+            page_size=self._readdir_page_size
         )
-        if response_obj.get_error_no() == 0:
-            return response_obj.get_data()["dir_listing"]
+        return self._iter_dir_pages(path, response_obj, uid, gid)
 
-        raise FuseOSError(response_obj.get_error_no())
+    def _iter_dir_pages(self, path, response_obj, uid, gid):
+        """
+        Yields the entries of a directory listing page by page
+        :param path: Path of the listed directory
+        :param response_obj: The response holding the first page
+        :param uid: The uid the directory is listed as
+        :param gid: The gid the directory is listed as
+        """
+        parent_path = path.rstrip("/")
+        while True:
+            response_data = response_obj.get_data()
+
+            # Answer the getattr calls that usually follow a listing from cache
+            for name, attrs in response_data.get("dir_attrs", {}).items():
+                self._attr_cache.put("{}/{}".format(parent_path, name), attrs)
+
+            yield from response_data["dir_listing"]
+
+            # Servers without pagination send everything in one page
+            cursor = response_data.get("cursor")
+            if cursor is None:
+                return
+
+            # The server only continues listings for the user that started them
+            response_obj = self._send_readdir(
+                cursor=cursor,
+                uid=uid,
+                gid=gid,
+                page_size=self._readdir_page_size
+            )
+
+    def _send_readdir(self, **kwargs):
+        """
+        Sends a READDIR_PLUS request, or READDIR if the server doesn't
+        support it
+        :param kwargs: The arguments for the request
+        :return: The successful HttpFsResponse
+        """
+        response_obj = None
+
+        if self._readdir_plus:
+            try:
+                response_obj = self._send_request(
+                    HttpFsRequest.OP_READDIR_PLUS, **kwargs
+                )
+            except FuseOSError as fuse_error:
+                if fuse_error.errno != errno.ENOSYS:
+                    raise
+                logging.warning("Server doesn't support readdir_plus, using readdir")
+                self._readdir_plus = False
+
+        if response_obj is None:
+            response_obj = self._send_request(HttpFsRequest.OP_READDIR, **kwargs)
+
+        if response_obj.is_error():
+            logging.error(response_obj.get_data()["message"])
+            raise FuseOSError(response_obj.get_error_no())
+
+        return response_obj
 
     def readlink(self, link):
         """
@@ -375,12 +1051,26 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: Optional file handle
         :return:
         """
+        write_back_error = None
+        if self._write_back is not None:
+            try:
+                self._write_back.release(fh)
+            except FuseOSError as fuse_error:
+                # The fd is closed regardless
+                write_back_error = fuse_error
+
+        if self._read_ahead is not None:
+            self._read_ahead.release(fh)
+
         response_obj = self._send_request(
             HttpFsRequest.OP_RELEASE, file_descriptor=fh)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
 
+        if write_back_error is not None:
+            raise write_back_error
+
     def rename(self, old, new):
         """
         Move file at path old to path new
@@ -396,6 +1086,13 @@ class HttpFsClient(_FuseLogger, Operations):
             uid=uid,
             gid=gid
         )
+        self._invalidate_data(old)
+        self._invalidate_data(new)
+        # Renaming a directory moves every path below it too
+        self._attr_cache.invalidate_tree(old)
+        self._attr_cache.invalidate_tree(new)
+        self._attr_cache.invalidate_entry(old)
+        self._attr_cache.invalidate_entry(new)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -412,6 +1109,8 @@ class HttpFsClient(_FuseLogger, Operations):
             HttpFsRequest.OP_RM_DIR,
             path=path
         )
+        self._attr_cache.invalidate_tree(path)
+        self._attr_cache.invalidate_entry(path)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -441,6 +1140,8 @@ class HttpFsClient(_FuseLogger, Operations):
             target=target,
             source=source
         )
+        self._attr_cache.invalidate_entry(target)
+        self._attr_cache.invalidate_entry(source)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -453,11 +1154,15 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: Optional file handle
         :return:
         """
+        self._flush_path(path)
+
         response_obj = self._send_request(
             HttpFsRequest.OP_TRUNCATE,
             path=path,
             length=length
         )
+        self._attr_cache.invalidate(path)
+        self._invalidate_data(path)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -477,6 +1182,8 @@ class HttpFsClient(_FuseLogger, Operations):
             uid=uid,
             gid=gid
         )
+        self._attr_cache.invalidate_entry(path)
+        self._invalidate_data(path)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -504,6 +1211,7 @@ class HttpFsClient(_FuseLogger, Operations):
             uid=uid,
             gid=gid
         )
+        self._attr_cache.invalidate(path)
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
             raise FuseOSError(response_obj.get_error_no())
@@ -517,21 +1225,35 @@ class HttpFsClient(_FuseLogger, Operations):
         :param fh: Optional file handle
         :return: The number of bytes actually written
         """
+        if self._write_back is not None:
+            # The cached size is stale as soon as the write is accepted
+            self._attr_cache.invalidate(path)
+            self._invalidate_data(path)
+            return self._write_back.write(path, data, offset, fh)
+
+        return self._write_remote(path, data, offset, fh)
+
+    def _write_remote(self, path, data, offset, fh):
+        """
+        Writes to the server, bypassing the write-back buffer
+        """
         start_time = time.time()
         uid, gid, _ = fuse_get_context()
 
         response_obj = self._send_request(
             HttpFsRequest.OP_WRITE,
             file_descriptor=fh,
-            data=base64.standard_b64encode(data).decode("utf-8"),
+            data=data,
             offset=offset,
             uid=uid,
             gid=gid
         )
+        self._attr_cache.invalidate(path)
+        self._invalidate_data(path)
 
         if response_obj.is_error():
             logging.error(response_obj.get_data()["message"])
-            return FuseOSError(response_obj.get_error_no())
+            raise FuseOSError(response_obj.get_error_no())
 
         bytes_written = response_obj.get_data()["bytes_written"]
         elapsed_time = time.time() - start_time
@@ -546,3 +1268,35 @@ class HttpFsClient(_FuseLogger, Operations):
         )
 
         return bytes_written
+
+    def init(self, path):
+        """
+        Called on mount, starts listening for the changes of other clients
+        :param path: The mount point
+        """
+        # The same way fusepy's fuse_exit() finds the struct fuse
+        libfuse = getattr(fuse, "_libfuse", None)
+        if libfuse is not None and hasattr(libfuse, "fuse_invalidate_path"):
+            self._fuse = ctypes.c_void_p(libfuse.fuse_get_context().contents.fuse)
+            self._fuse_invalidate_path = libfuse.fuse_invalidate_path
+        if self._invalidation_listener is not None:
+            self._invalidation_listener.start()
+
+    def destroy(self, path):
+        """
+        Called on unmount, sends any buffered writes
+        :param path: The mount point
+        """
+        if self._invalidation_listener is not None:
+            self._invalidation_listener.stop()
+        if self._write_back is not None:
+            self._write_back.flush_all()
+        if self._log_latency_stats:
+            logging.warning(
+                "Request latency per op:\n%s",
+                self._latency_stats.format_breakdown()
+            )
+        if self._trace_recorder is not None:
+            self._trace_recorder.close()
+        if self._disk_cache is not None:
+            self._disk_cache.close()
@@ -0,0 +1,129 @@
+"""
+Contains a class listening for the changes other clients make on the server
+"""
+
+import logging
+import threading
+
+import requests
+
+from httpfs.common import HttpFsEvent
+
+
+class InvalidationListener:
+    """
+    Long-polls the server's GET /events endpoint on a thread of its own and
+    reports the changes other clients made, so cached attributes and data
+    can be dropped as soon as they're stale
+
+    A poll returns as soon as there are changes, so changes are usually
+    reported within a round trip. If the server lost track of what this
+    client saw, e.g. because it restarted or the client was disconnected
+    for long, on_reset is called instead and everything cached must be
+    dropped.
+    """
+    # Seconds to wait before polling again after an error, doubled up to
+    # _MAX_RETRY_DELAY while the server stays unreachable
+    _RETRY_DELAY = 1
+    _MAX_RETRY_DELAY = 30
+
+    def __init__(self, server_url, headers, on_change, on_reset, origin=None,
+                 subtree="/", poll_timeout=30):
+        """
+        :param server_url: URL of the server
+        :param headers: Headers sent with every poll
+        :param on_change: Called with each HttpFsEvent
+        :param on_reset: Called when changes may have been missed
+        :param origin: This client's request id prefix, the changes it made
+        itself aren't reported
+        :param subtree: Only report changes to this path and below it
+        :param poll_timeout: Seconds the server holds a poll without changes
+        """
+        self._events_url = server_url + HttpFsEvent.URL_PATH
+        self._on_change = on_change
+        self._on_reset = on_reset
+        self._params = {"path": subtree, "timeout": poll_timeout}
+        if origin is not None:
+            self._params["origin"] = origin
+        self._poll_timeout = poll_timeout
+        self._session = requests.Session()
+        self._session.headers.update(headers)
+        self._stopped = threading.Event()
+        self._is_live = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts polling in the background
+        """
+        self._thread = threading.Thread(
+            target=self._run, name="httpfs-invalidation", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops polling, a poll in progress is abandoned
+        """
+        self._stopped.set()
+        self._is_live = False
+
+    def is_live(self):
+        """
+        :return: Whether the last poll succeeded, i.e. changes made by other
+        clients are being reported
+        """
+        return self._is_live
+
+    def _run(self):
+        retry_delay = InvalidationListener._RETRY_DELAY
+        while not self._stopped.is_set():
+            try:
+                is_supported = self._poll()
+                retry_delay = InvalidationListener._RETRY_DELAY
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                if self._is_live:
+                    logging.warning("Lost the server's change events: %s", e)
+                self._is_live = False
+                self._stopped.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, InvalidationListener._MAX_RETRY_DELAY)
+                continue
+
+            if not is_supported:
+                logging.warning("The server doesn't send change events")
+                self._is_live = False
+                return
+
+    def _poll(self):
+        """
+        Waits for one batch of changes and reports them
+        :return: False if the server doesn't support change events
+        :raise requests.exceptions.RequestException: On connection errors
+        :raise ValueError, KeyError: If the server sent an invalid response
+        """
+        response = self._session.get(
+            self._events_url,
+            params=self._params,
+            timeout=self._poll_timeout + 10
+        )
+        # Older servers take it for a malformed request
+        if response.status_code in (requests.codes.not_found, requests.codes.bad_request):
+            return False
+        response.raise_for_status()
+        response_dict = response.json()
+        events = [HttpFsEvent.from_dict(event) for event in response_dict["events"]]
+
+        if self._stopped.is_set():
+            return True
+        try:
+            if response_dict["reset"]:
+                self._on_reset()
+            for event in events:
+                self._on_change(event)
+        except Exception as e:
+            logging.error("Error handling change events: %s", e)
+
+        self._params["log"] = response_dict["log"]
+        self._params["since"] = response_dict["next"]
+        self._is_live = True
+        return True
@@ -0,0 +1,134 @@
+"""
+Contains a class for breaking down the latency of requests per op
+"""
+
+import logging
+import threading
+
+from httpfs.common import HttpFsRequest
+
+
+class LatencyStats:
+    """
+    Where the time of each request went, aggregated per op
+
+    The client measures serialize (building the request body), network (the
+    round trip, less the time the server reports) and deserialize (parsing
+    the response). The server reports its own phases in a Server-Timing
+    header, they're recorded as server_<phase>. Requests slower than
+    slow_request_time are logged with their id and breakdown, so they can be
+    matched with the server's slow request log.
+    """
+    CLIENT_PHASES = ("serialize", "network", "deserialize")
+
+    # Prefix of the phases reported by the server
+    SERVER_PREFIX = "server_"
+
+    def __init__(self, slow_request_time=None):
+        """
+        :param slow_request_time: Seconds after which a request is logged,
+        None to log none
+        """
+        self._slow_request_time = slow_request_time
+        self._guard = threading.Lock()
+        # op name -> {"count", "total", "max", "phases": {phase: seconds}}
+        self._ops = dict()
+
+    @staticmethod
+    def parse_server_timing(header):
+        """
+        :param header: A Server-Timing header value, or None
+        :return: Dict of phase -> seconds
+        """
+        phases = dict()
+        if not header:
+            return phases
+        for metric in header.split(","):
+            name, _, params = metric.partition(";")
+            for param in params.split(";"):
+                key, _, value = param.partition("=")
+                if key.strip() == "dur":
+                    try:
+                        phases[name.strip()] = float(value) / 1000
+                    except ValueError:
+                        pass
+        return phases
+
+    def record(self, op_type, request_id, phases):
+        """
+        Adds a request's breakdown to its op's totals
+        :param op_type: The HttpFsRequest type
+        :param request_id: The request's id, for the slow request log
+        :param phases: Dict of phase -> seconds
+        """
+        op_name = HttpFsRequest.get_op_name(op_type)
+        total = sum(phases.values())
+
+        with self._guard:
+            op_stats = self._ops.get(op_name)
+            if op_stats is None:
+                op_stats = self._ops[op_name] = {
+                    "count": 0, "total": 0.0, "max": 0.0, "phases": dict()
+                }
+            op_stats["count"] += 1
+            op_stats["total"] += total
+            op_stats["max"] = max(op_stats["max"], total)
+            for phase, seconds in phases.items():
+                op_stats["phases"][phase] = op_stats["phases"].get(phase, 0.0) + seconds
+
+        if self._slow_request_time is not None and total >= self._slow_request_time:
+            logging.warning(
+                "Slow %s request %s took %.1fms: %s",
+                op_name,
+                request_id,
+                total * 1000,
+                LatencyStats._format_phases(phases)
+            )
+
+    def get_breakdown(self):
+        """
+        :return: Dict of op name -> {"count", "mean", "max", "phases"} where
+        times are in seconds and phases holds the mean of each phase
+        """
+        with self._guard:
+            return {
+                op_name: {
+                    "count": op_stats["count"],
+                    "mean": op_stats["total"] / op_stats["count"],
+                    "max": op_stats["max"],
+                    "phases": {
+                        phase: seconds / op_stats["count"]
+                        for phase, seconds in op_stats["phases"].items()
+                    }
+                }
+                for op_name, op_stats in self._ops.items()
+            }
+
+    def format_breakdown(self):
+        """
+        :return: The breakdown as one line per op, the ops that took the
+        most time in total first
+        """
+        breakdown = self.get_breakdown()
+        ops = sorted(
+            breakdown.items(),
+            key=lambda item: item[1]["mean"] * item[1]["count"],
+            reverse=True
+        )
+        return "\n".join(
+            "{} count={} mean={:.2f}ms max={:.2f}ms: {}".format(
+                op_name,
+                op_stats["count"],
+                op_stats["mean"] * 1000,
+                op_stats["max"] * 1000,
+                LatencyStats._format_phases(op_stats["phases"])
+            )
+            for op_name, op_stats in ops
+        )
+
+    @staticmethod
+    def _format_phases(phases):
+        return ", ".join(
+            "{} {:.2f}ms".format(phase, seconds * 1000)
+            for phase, seconds in phases.items()
+        )
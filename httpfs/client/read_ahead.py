@@ -0,0 +1,315 @@
+"""
+Contains a class serving reads through a block cache with read-ahead
+"""
+
+import concurrent.futures
+import logging
+import threading
+
+
+class _HandleState:
+    """
+    Sequential access tracking for one open file handle
+    """
+    __slots__ = (
+        "path", "next_offset", "window", "prefetched_to", "eof_index", "futures"
+    )
+
+    def __init__(self, path):
+        self.path = path
+        # Offset a sequential reader would read next
+        self.next_offset = 0
+        # Number of blocks to keep prefetched ahead of the reader
+        self.window = 0
+        # Index of the first block not prefetched yet
+        self.prefetched_to = 0
+        # Index of the first block past the end of the file, once seen
+        self.eof_index = None
+        self.futures = set()
+
+
+class ReadAhead:
+    """
+    Serves reads from a BlockCache and fetches blocks ahead of sequential
+    readers in the background
+
+    Each file handle has a read-ahead window that doubles on every sequential
+    read up to max_window bytes and is reset by a random read.
+    """
+    # Max blocks fetched by one read-ahead request
+    _MAX_FETCH_BLOCKS = 8
+
+    def __init__(self, fetch, block_cache, max_window, max_workers=4):
+        """
+        :param fetch: Called as fetch(path, size, offset, fh) to read from the
+        server, returns the bytes read
+        :param block_cache: The BlockCache to keep fetched blocks in
+        :param max_window: Max number of bytes to read ahead of a reader
+        :param max_workers: Number of background fetch threads
+        """
+        self._fetch = fetch
+        self._block_cache = block_cache
+        self._block_size = block_cache.get_block_size()
+        self._max_window = max(1, max_window // self._block_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="httpfs-read-ahead"
+        )
+        # Reentrant because done callbacks of finished futures run inline
+        self._lock = threading.RLock()
+        # (path, block index) -> Future of the background fetch
+        self._pending = dict()
+        # file handle -> _HandleState
+        self._handles = dict()
+
+    def read(self, path, size, offset, fh):
+        """
+        Reads at most size bytes at offset, as HttpFsClient.read
+        """
+        if size <= 0:
+            return b""
+
+        block_size = self._block_size
+        first = offset // block_size
+        last = (offset + size - 1) // block_size
+
+        if fh is not None:
+            self._read_ahead(path, fh, offset, size, last)
+
+        blocks = []
+        index = first
+        while index <= last:
+            block = self._get_block(path, index)
+            if block is None:
+                # Fetch the run of blocks nobody has fetched yet in one request
+                run_end = index + 1
+                while run_end <= last and not self._is_available(path, run_end):
+                    run_end += 1
+                _, _, fetched = self._fetch_blocks(path, fh, index, run_end - index)
+                blocks.extend(fetched)
+                if self._is_eof(fetched, run_end - index):
+                    self._set_eof(fh, index + len(fetched))
+                    break
+                index = run_end
+                continue
+
+            blocks.append(block)
+            if len(block) < block_size:
+                self._set_eof(fh, index + (1 if block else 0))
+                break
+            index += 1
+
+        start = offset - first * block_size
+        return b"".join(blocks)[start:start + size]
+
+    def get_block_size(self):
+        return self._block_size
+
+    def begin_prime(self, path):
+        """
+        Starts reading the beginning of a file outside of read(), e.g. along
+        with opening it
+        :param path: Path of the file
+        :return: The FetchToken to pass to end_prime()
+        """
+        return self._block_cache.begin_fetch(path)
+
+    def end_prime(self, token, data):
+        """
+        Caches data read from the beginning of a file, unless the file was
+        invalidated since begin_prime()
+        :param token: The FetchToken from begin_prime()
+        :param data: The bytes read from offset 0, None if the read failed
+        """
+        try:
+            if data is None:
+                return
+            block_size = self._block_size
+            for index, start in enumerate(range(0, len(data), block_size)):
+                self._block_cache.put(token, index, data[start:start + block_size])
+        finally:
+            self._block_cache.end_fetch(token)
+
+    def release(self, fh):
+        """
+        Forgets a file handle, waiting for its background fetches so none of
+        them reads through the handle after the server closed it
+        :param fh: The released file handle
+        """
+        with self._lock:
+            state = self._handles.pop(fh, None)
+        if state is not None:
+            concurrent.futures.wait(list(state.futures))
+
+    def invalidate(self, path, changed=True):
+        """
+        Drops the cached and in-flight blocks of a changed or reopened file
+        :param path: Path of the file
+        :param changed: Whether the file changed, see BlockCache.invalidate()
+        """
+        self._block_cache.invalidate(path, changed)
+        with self._lock:
+            for state in self._handles.values():
+                if state.path == path:
+                    state.eof_index = None
+
+    def invalidate_all(self):
+        """
+        Drops the cached and in-flight blocks of every file
+        """
+        self._block_cache.invalidate_all()
+        with self._lock:
+            for state in self._handles.values():
+                state.eof_index = None
+
+    def contains(self, path, index):
+        """
+        :return: Whether the block is cached, in memory or on disk
+        """
+        return self._block_cache.contains(path, index)
+
+    def _read_ahead(self, path, fh, offset, size, last):
+        """
+        Updates the handle's window and starts fetching the blocks in it
+        """
+        # Looked up outside the lock since it may be read from disk
+        last_block = self._block_cache.get(path, last)
+        with self._lock:
+            state = self._handles.get(fh)
+            if state is None:
+                state = self._handles[fh] = _HandleState(path)
+
+            if offset == state.next_offset:
+                state.window = min(max(state.window * 2, 1), self._max_window)
+            else:
+                state.window = 0
+                state.prefetched_to = 0
+            state.next_offset = offset + size
+
+            # A cached short block, e.g. from another handle, ends the file
+            if state.eof_index is None:
+                if last_block is not None and len(last_block) < self._block_size:
+                    state.eof_index = last + 1
+
+            # Top the window up once half of it has been read, so read-ahead
+            # requests stay large instead of one block per read
+            if state.prefetched_to - (last + 1) > state.window // 2:
+                return
+
+            start = max(last + 1, state.prefetched_to)
+            end = last + 1 + state.window
+            if state.eof_index is not None:
+                end = min(end, state.eof_index)
+            if start >= end:
+                return
+            state.prefetched_to = end
+
+            index = start
+            while index < end:
+                if self._is_available(path, index):
+                    index += 1
+                    continue
+
+                run_end = index + 1
+                while (run_end < end
+                       and run_end - index < ReadAhead._MAX_FETCH_BLOCKS
+                       and not self._is_available(path, run_end)):
+                    run_end += 1
+
+                self._start_fetch(path, fh, state, index, run_end - index)
+                index = run_end
+
+    def _set_eof(self, fh, eof_index):
+        with self._lock:
+            state = self._handles.get(fh)
+            if state is not None:
+                state.eof_index = eof_index
+
+    def _is_eof(self, fetched, count):
+        """
+        :return: Whether fetching count blocks got the file's last block
+        """
+        return len(fetched) < count or (
+            len(fetched) > 0 and len(fetched[-1]) < self._block_size
+        )
+
+    def _start_fetch(self, path, fh, state, first, count):
+        """
+        Fetches count blocks from first in the background, must hold _lock
+        """
+        future = self._executor.submit(self._fetch_blocks, path, fh, first, count)
+        keys = [(path, index) for index in range(first, first + count)]
+        for key in keys:
+            self._pending[key] = future
+        state.futures.add(future)
+
+        def on_done(done_future):
+            with self._lock:
+                for key in keys:
+                    if self._pending.get(key) is done_future:
+                        del self._pending[key]
+                state.futures.discard(done_future)
+            if done_future.exception() is not None:
+                logging.debug(
+                    "Read-ahead of %s failed: %s", path, done_future.exception()
+                )
+                return
+
+            token, _, fetched = done_future.result()
+            if not token.stale and self._is_eof(fetched, count):
+                with self._lock:
+                    state.eof_index = first + len(fetched)
+
+        future.add_done_callback(on_done)
+
+    def _is_available(self, path, index):
+        """
+        :return: Whether the block is cached or being fetched
+        """
+        with self._lock:
+            if (path, index) in self._pending:
+                return True
+        return self._block_cache.contains(path, index)
+
+    def _get_block(self, path, index):
+        """
+        :return: The block from the cache or a background fetch, b"" if it
+        is past the end of the file, or None if it has to be fetched
+        """
+        block = self._block_cache.get(path, index)
+        if block is not None:
+            return block
+
+        with self._lock:
+            future = self._pending.get((path, index))
+        if future is None:
+            return None
+
+        try:
+            token, fetched_first, fetched = future.result()
+        except Exception:
+            # Retried in the foreground, which reports the error
+            return None
+        if token.stale:
+            return None
+
+        position = index - fetched_first
+        return fetched[position] if position < len(fetched) else b""
+
+    def _fetch_blocks(self, path, fh, first, count):
+        """
+        Reads count blocks from block first and caches them
+        :return: (FetchToken, first, list of the blocks read), fewer than
+        count blocks at the end of the file
+        """
+        block_size = self._block_size
+        token = self._block_cache.begin_fetch(path)
+        try:
+            data = self._fetch(path, count * block_size, first * block_size, fh)
+            blocks = [
+                data[i:i + block_size] for i in range(0, len(data), block_size)
+            ]
+            for i, block in enumerate(blocks):
+                self._block_cache.put(token, first + i, block)
+            return token, first, blocks
+        finally:
+            self._block_cache.end_fetch(token)
@@ -0,0 +1,165 @@
+"""
+Contains a class for recording a compact trace of the FUSE ops a mount serves
+"""
+
+import collections
+import hashlib
+import struct
+import threading
+import time
+
+TraceRecord = collections.namedtuple(
+    "TraceRecord",
+    ["time", "latency", "op", "errno", "path_hash", "fh", "offset", "size"]
+)
+
+
+class TraceRecorder:
+    """
+    Writes one fixed size binary record per FUSE op to a file, to replay the
+    op mix of a real workload later (see benchmarks/replay.py)
+
+    Paths are stored as 64 bit hashes, so traces don't reveal file names but
+    still tell which ops hit the same file. Each record holds:
+      - time: Seconds since the trace started, when the op was called
+      - latency: Microseconds the op took
+      - op: The FUSE op, an index into OPS
+      - errno: The errno the op failed with, 0 if it succeeded
+      - path_hash: Hash of the op's path
+      - fh: The file handle the op used or returned, 0 for none
+      - offset: The offset of reads and writes, the length of truncates, and
+        the hash of the second path of links, renames and symlinks
+      - size: The size of reads and writes, the flags of opens, the mode of
+        creates, mkdirs, mknods, chmods and accesses, and the number of
+        entries readdir returned
+    """
+    MAGIC = b"HFSTRACE"
+    VERSION = 1
+
+    # Magic, version and the wall clock time the trace started at
+    _HEADER = struct.Struct("<8sHd")
+    # time, latency, op, errno, path_hash, fh, offset, size
+    _RECORD = struct.Struct("<dIBBQQQI")
+
+    # The ops that are traced, a record's op is an index into this
+    OPS = (
+        "access", "chmod", "chown", "create", "flush", "fsync", "getattr",
+        "link", "mkdir", "mknod", "open", "read", "readdir", "readlink",
+        "release", "rename", "rmdir", "statfs", "symlink", "truncate",
+        "unlink", "utimens", "write"
+    )
+    _OP_INDEXES = {op: index for index, op in enumerate(OPS)}
+
+    # Ops whose second argument is another path
+    _TWO_PATH_OPS = ("link", "rename", "symlink")
+    # Ops whose second argument is a mode or flags, stored as the size
+    _MODE_OPS = ("access", "chmod", "create", "mkdir", "mknod", "open")
+
+    def __init__(self, trace_file):
+        """
+        :param trace_file: Path of the file to write the trace to, replaced
+        if it exists
+        """
+        self._guard = threading.Lock()
+        self._start = time.perf_counter()
+        self._file = open(trace_file, "wb")
+        self._file.write(TraceRecorder._HEADER.pack(
+            TraceRecorder.MAGIC, TraceRecorder.VERSION, time.time()
+        ))
+
+    @staticmethod
+    def hash_path(path):
+        """
+        :param path: A path
+        :return: The path's 64 bit hash
+        """
+        return int.from_bytes(
+            hashlib.blake2b(
+                path.encode("utf-8", "surrogateescape"), digest_size=8
+            ).digest(),
+            "little"
+        )
+
+    def record(self, operation, path, args, result, error, start_time):
+        """
+        Adds a record for an op, ops not in OPS are ignored
+        :param operation: The FUSE op's name
+        :param path: The op's path
+        :param args: The op's other arguments
+        :param result: What the op returned
+        :param error: The errno the op failed with, 0 if it succeeded
+        :param start_time: time.perf_counter() when the op was called
+        """
+        end_time = time.perf_counter()
+        op_index = TraceRecorder._OP_INDEXES.get(operation)
+        if op_index is None:
+            return
+
+        fh = 0
+        offset = 0
+        size = 0
+        if operation in ("read", "write"):
+            # read(path, size, offset, fh), write(path, data, offset, fh)
+            size = args[0] if operation == "read" else len(args[0])
+            offset = args[1]
+            fh = args[2] if len(args) > 2 else 0
+        elif operation in TraceRecorder._TWO_PATH_OPS:
+            offset = TraceRecorder.hash_path(args[0])
+        elif operation == "truncate":
+            offset = args[0]
+            fh = args[1] if len(args) > 1 else 0
+        elif operation in TraceRecorder._MODE_OPS:
+            size = args[0]
+            if operation in ("create", "open") and not error:
+                fh = result
+        elif operation in ("flush", "fsync", "release"):
+            fh = args[-1] if args else 0
+        elif operation == "readdir" and not error:
+            size = len(result)
+
+        record = TraceRecorder._RECORD.pack(
+            start_time - self._start,
+            min(int((end_time - start_time) * 1e6), 0xFFFFFFFF),
+            op_index,
+            min(error, 0xFF),
+            TraceRecorder.hash_path(path),
+            (fh or 0) & 0xFFFFFFFFFFFFFFFF,
+            offset & 0xFFFFFFFFFFFFFFFF,
+            size & 0xFFFFFFFF
+        )
+        with self._guard:
+            if not self._file.closed:
+                self._file.write(record)
+
+    def close(self):
+        """
+        Writes out the records still buffered and closes the trace file
+        """
+        with self._guard:
+            self._file.close()
+
+    @staticmethod
+    def read_trace(trace_file):
+        """
+        :param trace_file: Path of a trace written by a TraceRecorder
+        :return: (wall clock time the trace started at, list of TraceRecords
+        in the order the ops ended)
+        :raise ValueError: If the file isn't a trace
+        """
+        with open(trace_file, "rb") as f:
+            header = f.read(TraceRecorder._HEADER.size)
+            if len(header) < TraceRecorder._HEADER.size:
+                raise ValueError("Not an HttpFs trace: {}".format(trace_file))
+            magic, version, start_time = TraceRecorder._HEADER.unpack(header)
+            if magic != TraceRecorder.MAGIC or version != TraceRecorder.VERSION:
+                raise ValueError("Not an HttpFs trace: {}".format(trace_file))
+            data = f.read()
+
+        # A client that didn't unmount cleanly can leave a partial record
+        end = len(data) - len(data) % TraceRecorder._RECORD.size
+        records = []
+        for fields in TraceRecorder._RECORD.iter_unpack(data[:end]):
+            record = TraceRecord._make(fields)
+            records.append(record._replace(op=TraceRecorder.OPS[record.op]))
+        return start_time, records
+
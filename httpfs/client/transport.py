@@ -0,0 +1,691 @@
+"""
+Contains the transports HttpFsClient sends its requests with
+"""
+
+import io
+import itertools
+import logging
+import queue
+import select
+import socket
+import ssl
+import threading
+
+import requests
+import ujson
+from urllib3.util.request import ACCEPT_ENCODING
+
+from httpfs.common import HttpFsCompression, HttpFsMuxFrame
+
+
+class RequestsTransport:
+    """
+    Sends requests with the requests library, over a ConnectionPool
+    """
+    # Content codings urllib3 decodes responses from
+    DECODED_CODINGS = [c.strip() for c in ACCEPT_ENCODING.split(",")]
+
+    def __init__(self, server_url, connection_pool):
+        """
+        :param server_url: URL of the server
+        :param connection_pool: The ConnectionPool to get sessions from
+        """
+        self._server_url = server_url
+        self._connection_pool = connection_pool
+
+    def post(self, headers, json_dict=None, data=None):
+        """
+        POSTs a request to the server
+        :param headers: Per-request headers
+        :param json_dict: Request body to send as JSON
+        :param data: Raw request body, if json_dict is None
+        :return: The requests.Response
+        """
+        session = self._connection_pool.get_session()
+        post_kwargs = dict(
+            allow_redirects=False,
+            timeout=10,
+            headers=headers,
+            stream=True
+        )
+        if json_dict is not None:
+            post_kwargs["json"] = json_dict
+        else:
+            post_kwargs["data"] = data
+
+        # Not resent on errors: the server may have run the request before
+        # the connection dropped. urllib3 already skips pooled connections
+        # the server closed and retries failed connection attempts.
+        return session.post(self._server_url, **post_kwargs)
+
+    def reset(self):
+        """
+        Closes every pooled connection
+        """
+        self._connection_pool.reset()
+
+
+class _HttpHeaders(dict):
+    """
+    Response headers with case-insensitive get()
+    """
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+
+class _HttpResponse:
+    """
+    A fully read response, with the parts of requests.Response HttpFsClient
+    uses
+    """
+    __slots__ = ("status_code", "headers", "content")
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return ujson.loads(bytes(self.content))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                "{} Error for HttpFs request".format(self.status_code)
+            )
+
+    def close(self):
+        pass
+
+
+class _HttpConnection:
+    """
+    One keep-alive connection to the server
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def is_dropped(self):
+        """
+        :return: Whether the server closed the idle connection, which makes
+        it readable
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+def _serialize_headers(start_line, headers):
+    """
+    :return: The start line and header lines of an HTTP message
+    """
+    lines = [start_line]
+    lines.extend("{}: {}".format(k, v) for k, v in headers.items())
+    return "".join(line + "\r\n" for line in lines).encode("latin-1")
+
+
+def _serialize_request(header_prefix, headers, json_dict, data):
+    """
+    Builds an HTTP request
+    :param header_prefix: Serialized request line and fixed headers
+    :param headers: Per-request headers
+    :param json_dict: Request body to send as JSON
+    :param data: Raw request body, if json_dict is None
+    :return: (request head bytes, body bytes)
+    """
+    if json_dict is not None:
+        body = ujson.dumps(json_dict).encode("utf-8")
+        content_type = "application/json"
+    else:
+        body = data
+        content_type = None
+
+    header_parts = [header_prefix]
+    for name, value in headers.items():
+        if name == "Content-Type":
+            content_type = value
+        else:
+            header_parts.append(
+                "{}: {}\r\n".format(name, value).encode("latin-1")
+            )
+    header_parts.append(
+        "Content-Type: {}\r\nContent-Length: {}\r\n\r\n".format(
+            content_type, len(body)
+        ).encode("latin-1")
+    )
+    return b"".join(header_parts), body
+
+
+class _BodyBuffers(threading.local):
+    """
+    A reusable buffer per thread for reading large response bodies, so
+    large reads don't allocate a new bytes object for every response
+    """
+    # Bodies larger than this get a buffer of their own
+    _MAX_REUSED_SIZE = 16 * 1024 * 1024
+
+    def get(self, size):
+        """
+        :param size: Size of the body
+        :return: A writable memoryview of size bytes, which is overwritten
+        by the thread's next get()
+        """
+        if size > _BodyBuffers._MAX_REUSED_SIZE:
+            return memoryview(bytearray(size))
+
+        buffer = getattr(self, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            # A new buffer instead of resizing, views of the old one may
+            # still be around
+            buffer = self.buffer = bytearray(size)
+        return memoryview(buffer)[:size]
+
+
+def _read_response(reader, body_buffers=None):
+    """
+    Reads an HTTP response with just what the HttpFs server sends: a status
+    line, headers and a Content-Length body
+    :param reader: Buffered binary file to read from
+    :param body_buffers: Optional _BodyBuffers to read large bodies into,
+    the response is then only valid until the thread's next response
+    :return: The _HttpResponse
+    """
+    status_code, headers = _read_head(reader)
+
+    content_length = int(headers.get("content-length", 0))
+    if body_buffers is not None and content_length >= 64 * 1024:
+        content = body_buffers.get(content_length)
+        read_size = 0
+        while read_size < content_length:
+            chunk_size = reader.readinto(content[read_size:])
+            if not chunk_size:
+                break
+            read_size += chunk_size
+    else:
+        content = reader.read(content_length)
+        read_size = len(content)
+    if read_size < content_length:
+        raise ConnectionResetError("Response body is truncated")
+
+    return _HttpResponse(status_code, headers, content)
+
+
+def _read_head(reader):
+    """
+    Reads the status line and headers of an HTTP response
+    :param reader: Buffered binary file to read from
+    :return: (status code, _HttpHeaders)
+    """
+    status_line = reader.readline(65537)
+    if not status_line:
+        raise ConnectionResetError("Server closed the connection")
+    status_code = int(status_line.split(None, 2)[1])
+
+    headers = _HttpHeaders()
+    while True:
+        line = reader.readline(65537)
+        if line in (b"\r\n", b"\n"):
+            break
+        if not line:
+            raise ConnectionResetError("Server closed the connection")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    return status_code, headers
+
+
+def _decode_content(response):
+    """
+    Decompresses a response body sent with a Content-Encoding
+    :param response: The _HttpResponse, updated in place
+    :return: The response
+    :raise ValueError: If the coding is unknown or the body is invalid
+    """
+    coding = response.headers.get("content-encoding")
+    if coding is not None:
+        response.content = HttpFsCompression.decompress(coding, response.content)
+    return response
+
+
+class _NoResponseError(ConnectionError):
+    """
+    A reused connection failed before the server sent any of its response,
+    i.e. the server closed it as idle and never ran the request
+    """
+
+
+class HttpTransport:
+    """
+    Lean HTTP/1.1 transport for the client hot path
+
+    Requests are written straight to pooled sockets with the headers that
+    never change serialized once up front, and responses are parsed with
+    just what the HttpFs server sends: a status line, headers and a
+    Content-Length body. This skips the per-request work of the requests
+    library (hooks, adapters, header merging, redirect handling).
+    """
+    # Errors meaning a keep-alive connection was closed by the server
+    _STALE_ERRORS = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+    def __init__(
+            self,
+            hostname,
+            port,
+            headers,
+            ca_file=None,
+            max_connections=16,
+            timeout=10
+    ):
+        """
+        :param hostname: The server's hostname
+        :param port: The server's port
+        :param headers: Headers sent with every request
+        :param ca_file: CA cert file if the server uses HTTPS
+        :param max_connections: Max number of open connections
+        :param timeout: Socket timeout in seconds
+        """
+        self._address = (hostname, int(port))
+        self._timeout = timeout
+
+        if ca_file is not None:
+            self._ssl_context = ssl.create_default_context(cafile=ca_file)
+        else:
+            self._ssl_context = None
+
+        self._header_prefix = _serialize_headers(
+            "POST / HTTP/1.1", dict(headers, Connection="keep-alive")
+        )
+
+        self._idle_connections = queue.LifoQueue()
+        self._connection_slots = threading.BoundedSemaphore(max_connections)
+        self._body_buffers = _BodyBuffers()
+
+    def post(self, headers, json_dict=None, data=None):
+        """
+        POSTs a request to the server, as RequestsTransport.post
+        :return: The response, fully read. A large body is read into a
+        buffer that's reused by the thread's next request.
+        """
+        request_head, body = _serialize_request(
+            self._header_prefix, headers, json_dict, data
+        )
+
+        with self._connection_slots:
+            connection, is_reused = self._checkout()
+            try:
+                try:
+                    response = self._exchange(connection, request_head, body)
+                except _NoResponseError as stale_error:
+                    # Once the server answered, it may have run the request
+                    # and it mustn't run twice
+                    if not is_reused:
+                        raise
+                    logging.debug("Retrying request: %s", stale_error)
+                    connection.close()
+                    connection = self._connect()
+                    response = self._exchange(connection, request_head, body)
+            except BaseException:
+                connection.close()
+                raise
+
+            if response.headers.get("connection", "").lower() == "close":
+                connection.close()
+            else:
+                self._idle_connections.put(connection)
+
+        return response
+
+    def reset(self):
+        """
+        Closes every idle connection
+        """
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _checkout(self):
+        """
+        :return: (connection, whether it was used before)
+        """
+        while True:
+            try:
+                connection = self._idle_connections.get_nowait()
+            except queue.Empty:
+                return self._connect(), False
+            if not connection.is_dropped():
+                return connection, True
+            connection.close()
+
+    def _connect(self):
+        sock = socket.create_connection(self._address, self._timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._ssl_context is not None:
+            sock = self._ssl_context.wrap_socket(
+                sock, server_hostname=self._address[0]
+            )
+        return _HttpConnection(sock)
+
+    def _exchange(self, connection, request_head, body):
+        """
+        Sends a request and reads its response
+        :raise _NoResponseError: If the connection failed before the first
+        byte of the response
+        """
+        try:
+            # One send for small requests, so they go out in one packet
+            if len(body) < 64 * 1024:
+                connection.sock.sendall(request_head + bytes(body))
+            else:
+                connection.sock.sendall(request_head)
+                connection.sock.sendall(body)
+
+            if not connection.reader.peek(1):
+                raise _NoResponseError("Server closed the connection")
+        except HttpTransport._STALE_ERRORS as stale_error:
+            raise _NoResponseError(stale_error)
+
+        return _decode_content(
+            _read_response(connection.reader, self._body_buffers)
+        )
+
+
+def _parse_response(message):
+    """
+    :param message: A whole HTTP response
+    :return: The _HttpResponse, whose content is a view into message
+    """
+    reader = io.BytesIO(message)
+    status_code, headers = _read_head(reader)
+
+    content = memoryview(message)[reader.tell():]
+    if len(content) < int(headers.get("content-length", 0)):
+        raise ConnectionResetError("Response body is truncated")
+    return _HttpResponse(status_code, headers, content)
+
+
+class _UnsentRequestError(ConnectionError):
+    """
+    A request couldn't be sent, so the server never ran it and it can be
+    retried
+    """
+
+
+class _PendingResponse:
+    """
+    A request in flight on a _MultiplexedConnection
+    """
+    __slots__ = ("done", "response", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class _MultiplexedConnection:
+    """
+    One connection switched to the multiplexed protocol, with a thread
+    reading the responses off it
+    """
+
+    def __init__(self, sock, reader):
+        self._sock = sock
+        self._reader = reader
+        # Held while registering requests and closing the connection
+        self._lock = threading.Lock()
+        # Held while writing a frame
+        self._write_lock = threading.Lock()
+        # stream id -> _PendingResponse
+        self._pending = dict()
+        self._stream_ids = itertools.count()
+        # Why the connection was closed, None while it's open
+        self._error = None
+
+        threading.Thread(
+            target=self._read_responses,
+            name="httpfs-mux-reader",
+            daemon=True
+        ).start()
+
+    def is_closed(self):
+        return self._error is not None
+
+    def exchange(self, request_head, body, timeout):
+        """
+        Sends a request and waits for its response
+        :param request_head: The request line and headers
+        :param body: The request body
+        :param timeout: Seconds to wait for the response
+        :return: The _HttpResponse
+        :raise _UnsentRequestError: If the request couldn't be sent
+        """
+        pending = _PendingResponse()
+        with self._lock:
+            if self._error is not None:
+                raise _UnsentRequestError(self._error)
+            stream_id = next(self._stream_ids) % HttpFsMuxFrame.MAX_STREAM_ID
+            self._pending[stream_id] = pending
+
+        frame_head = HttpFsMuxFrame.pack_header(
+            stream_id, len(request_head) + len(body)
+        ) + request_head
+        try:
+            with self._write_lock:
+                # One send for small requests, so they go out in one packet
+                if len(body) < 64 * 1024:
+                    self._sock.sendall(frame_head + bytes(body))
+                else:
+                    self._sock.sendall(frame_head)
+                    self._sock.sendall(body)
+        except OSError as send_error:
+            # A partly sent frame leaves the connection unusable
+            self.close(send_error)
+            raise _UnsentRequestError(send_error)
+
+        if not pending.done.wait(timeout):
+            with self._lock:
+                self._pending.pop(stream_id, None)
+            raise socket.timeout("Timed out waiting for the response")
+        if pending.error is not None:
+            raise pending.error
+        # Decompressed here rather than on the reader thread, which every
+        # response goes through
+        return _decode_content(pending.response)
+
+    def close(self, error):
+        """
+        Closes the connection, failing the requests waiting on it
+        :param error: Why the connection is closed
+        """
+        with self._lock:
+            if self._error is None:
+                self._error = error
+            pending_responses = list(self._pending.values())
+            self._pending.clear()
+
+        for pending in pending_responses:
+            pending.error = ConnectionResetError(
+                "Connection lost: {}".format(error)
+            )
+            pending.done.set()
+
+        # Wakes the reader thread, which closes the socket
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _read_responses(self):
+        try:
+            while True:
+                frame = HttpFsMuxFrame.read(self._reader)
+                if frame is None:
+                    raise ConnectionResetError("Server closed the connection")
+
+                stream_id, message = frame
+                response = _parse_response(message)
+                with self._lock:
+                    pending = self._pending.pop(stream_id, None)
+                # Responses to timed out requests are dropped
+                if pending is not None:
+                    pending.response = response
+                    pending.done.set()
+        except (OSError, ValueError) as read_error:
+            logging.debug("Multiplexed connection closed: %s", read_error)
+            self.close(read_error)
+        finally:
+            self._reader.close()
+            self._sock.close()
+
+
+class MuxTransport:
+    """
+    Sends every request over one multiplexed connection, see HttpFsMuxFrame
+
+    Requests from all FUSE threads are in flight on the connection at once
+    and the server answers each one as soon as it's done, so concurrent ops
+    share one TCP/TLS handshake and a slow request doesn't hold up the
+    others. A reader thread hands the responses to the waiting threads.
+    Servers that can't multiplex, like older servers and the asyncio
+    engine, refuse the upgrade and the requests go through an HttpTransport
+    instead.
+    """
+
+    def __init__(
+            self,
+            hostname,
+            port,
+            headers,
+            ca_file=None,
+            max_connections=16,
+            timeout=10
+    ):
+        """
+        :param hostname: The server's hostname
+        :param port: The server's port
+        :param headers: Headers sent with every request
+        :param ca_file: CA cert file if the server uses HTTPS
+        :param max_connections: Max number of open connections if the
+        server can't multiplex
+        :param timeout: Seconds to wait for a response
+        """
+        self._address = (hostname, int(port))
+        self._headers = headers
+        self._ca_file = ca_file
+        self._max_connections = max_connections
+        self._timeout = timeout
+
+        if ca_file is not None:
+            self._ssl_context = ssl.create_default_context(cafile=ca_file)
+        else:
+            self._ssl_context = None
+
+        self._header_prefix = _serialize_headers("POST / HTTP/1.1", headers)
+
+        # Held while checking or replacing the connection
+        self._lock = threading.Lock()
+        self._connection = None
+        # The HttpTransport used if the server refused to multiplex
+        self._fallback = None
+
+    def post(self, headers, json_dict=None, data=None):
+        """
+        POSTs a request to the server, as RequestsTransport.post
+        :return: The response, fully read
+        """
+        request_head, body = _serialize_request(
+            self._header_prefix, headers, json_dict, data
+        )
+
+        # A request that couldn't be sent is retried once on a new connection
+        for attempt in range(2):
+            connection = self._get_connection()
+            if connection is None:
+                return self._fallback.post(headers, json_dict=json_dict, data=data)
+            try:
+                return connection.exchange(request_head, body, self._timeout)
+            except _UnsentRequestError as unsent_error:
+                if attempt > 0:
+                    raise
+                logging.debug("Retrying request: %s", unsent_error)
+
+    def reset(self):
+        """
+        Closes the fallback transport's idle connections. The multiplexed
+        connection is kept, its frames are always read whole so it never
+        holds unread data.
+        """
+        if self._fallback is not None:
+            self._fallback.reset()
+
+    def _get_connection(self):
+        """
+        :return: The open multiplexed connection, or None if the server
+        refused to multiplex
+        """
+        with self._lock:
+            if self._fallback is not None:
+                return None
+            if self._connection is None or self._connection.is_closed():
+                self._connection = self._connect()
+            return self._connection
+
+    def _connect(self):
+        """
+        Opens a connection and asks the server to multiplex it
+        :return: The _MultiplexedConnection, or None if the server refused
+        """
+        sock = socket.create_connection(self._address, self._timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._ssl_context is not None:
+            sock = self._ssl_context.wrap_socket(
+                sock, server_hostname=self._address[0]
+            )
+        reader = sock.makefile("rb")
+
+        try:
+            sock.sendall(_serialize_headers(
+                "GET / HTTP/1.1",
+                dict(
+                    self._headers,
+                    Upgrade=HttpFsMuxFrame.UPGRADE_TOKEN,
+                    Connection="Upgrade"
+                )
+            ) + b"\r\n")
+            response = _read_response(reader)
+        except BaseException:
+            reader.close()
+            sock.close()
+            raise
+
+        if response.status_code != 101:
+            reader.close()
+            sock.close()
+            logging.warning(
+                "Server doesn't support multiplexed connections, "
+                "using one connection per request"
+            )
+            self._fallback = HttpTransport(
+                self._address[0],
+                self._address[1],
+                self._headers,
+                ca_file=self._ca_file,
+                max_connections=self._max_connections,
+                timeout=self._timeout
+            )
+            return None
+
+        # The reader thread waits for responses for as long as it takes
+        sock.settimeout(None)
+        return _MultiplexedConnection(sock, reader)
@@ -0,0 +1,228 @@
+"""
+Contains a class buffering and coalescing writes per file handle
+"""
+
+import errno
+import logging
+import threading
+import time
+
+from fuse import FuseOSError
+
+
+class _HandleBuffer:
+    """
+    Buffered contiguous writes of one open file handle
+    """
+    __slots__ = ("path", "lock", "offset", "chunks", "size", "since", "error_no")
+
+    def __init__(self, path):
+        self.path = path
+        # Held while the buffer is appended to or flushed
+        self.lock = threading.Lock()
+        # File offset of the first buffered byte
+        self.offset = 0
+        self.chunks = []
+        self.size = 0
+        # time.monotonic() of the oldest buffered write
+        self.since = None
+        # errno of a failed flush, reported by the next flush/fsync/release
+        self.error_no = 0
+
+
+class WriteBack:
+    """
+    Buffers writes per file handle and sends runs of contiguous writes to the
+    server as one request
+
+    A handle's buffer is sent when a write isn't contiguous with it, when it
+    reaches buffer_size bytes, when it's been buffered for flush_interval
+    seconds, when the buffered bytes of all handles exceed max_buffered, and on
+    flush, fsync and release. Errors of writes sent in the background are
+    reported by the next flush, fsync or release of the handle.
+    """
+
+    def __init__(
+            self,
+            send_write,
+            buffer_size,
+            max_buffered=None,
+            flush_interval=1.0
+    ):
+        """
+        :param send_write: Called as send_write(path, data, offset, fh) to
+        write to the server, returns the number of bytes written and raises
+        FuseOSError on errors
+        :param buffer_size: Max bytes buffered per file handle
+        :param max_buffered: Max bytes buffered for all handles, defaults to
+        16 handles' worth
+        :param flush_interval: Max seconds a write stays buffered
+        """
+        self._send_write = send_write
+        self._buffer_size = buffer_size
+        self._max_buffered = max_buffered or 16 * buffer_size
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # fh -> _HandleBuffer
+        self._buffers = dict()
+        self._buffered_bytes = 0
+        self._flusher = None
+
+    def write(self, path, data, offset, fh):
+        """
+        Buffers a write, as HttpFsClient.write
+        :return: The number of bytes written
+        """
+        handle_buffer = self._get_buffer(path, fh)
+
+        with handle_buffer.lock:
+            is_contiguous = offset == handle_buffer.offset + handle_buffer.size
+            if handle_buffer.size > 0 and not is_contiguous:
+                self._flush_locked(handle_buffer, fh)
+
+            if handle_buffer.size == 0:
+                handle_buffer.offset = offset
+                handle_buffer.since = time.monotonic()
+            handle_buffer.chunks.append(bytes(data))
+            handle_buffer.size += len(data)
+            with self._lock:
+                self._buffered_bytes += len(data)
+                is_over_limit = self._buffered_bytes > self._max_buffered
+
+            if handle_buffer.size >= self._buffer_size:
+                self._flush_locked(handle_buffer, fh)
+
+        if is_over_limit:
+            self.flush_all()
+
+        return len(data)
+
+    def flush_handle(self, fh):
+        """
+        Sends the handle's buffered writes
+        :param fh: The file handle
+        :raise FuseOSError: If this or an earlier background flush failed
+        """
+        with self._lock:
+            handle_buffer = self._buffers.get(fh)
+        if handle_buffer is None:
+            return
+
+        with handle_buffer.lock:
+            self._flush_locked(handle_buffer, fh)
+            error_no = handle_buffer.error_no
+            handle_buffer.error_no = 0
+
+        if error_no != 0:
+            raise FuseOSError(error_no)
+
+    def flush_path(self, path):
+        """
+        Sends the buffered writes of every handle open on path, so reads and
+        getattr see them. Errors are kept for the handles' next flush.
+        :param path: Path of the file
+        """
+        with self._lock:
+            path_buffers = [
+                (fh, b) for fh, b in self._buffers.items()
+                if b.path == path and b.size > 0
+            ]
+
+        for fh, handle_buffer in path_buffers:
+            with handle_buffer.lock:
+                self._flush_locked(handle_buffer, fh)
+
+    def flush_all(self, older_than=None):
+        """
+        Sends the buffered writes of every handle
+        :param older_than: Only flush buffers holding writes at least this
+        many seconds old
+        """
+        with self._lock:
+            all_buffers = list(self._buffers.items())
+
+        now = time.monotonic()
+        for fh, handle_buffer in all_buffers:
+            with handle_buffer.lock:
+                if handle_buffer.size == 0:
+                    continue
+                is_recent = older_than is not None and (
+                    now - handle_buffer.since < older_than
+                )
+                if is_recent:
+                    continue
+                self._flush_locked(handle_buffer, fh)
+
+    def release(self, fh):
+        """
+        Sends the handle's buffered writes and forgets the handle
+        :param fh: The released file handle
+        :raise FuseOSError: If this or an earlier background flush failed
+        """
+        try:
+            self.flush_handle(fh)
+        finally:
+            with self._lock:
+                self._buffers.pop(fh, None)
+
+    def _get_buffer(self, path, fh):
+        with self._lock:
+            handle_buffer = self._buffers.get(fh)
+            if handle_buffer is None:
+                handle_buffer = self._buffers[fh] = _HandleBuffer(path)
+
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically,
+                    name="httpfs-write-back",
+                    daemon=True
+                )
+                self._flusher.start()
+
+            return handle_buffer
+
+    def _flush_locked(self, handle_buffer, fh):
+        """
+        Sends a buffer's writes, must hold handle_buffer.lock
+        """
+        if handle_buffer.size == 0:
+            return
+
+        data = b"".join(handle_buffer.chunks)
+        offset = handle_buffer.offset
+        handle_buffer.chunks = []
+        handle_buffer.offset += handle_buffer.size
+        handle_buffer.size = 0
+        with self._lock:
+            self._buffered_bytes -= len(data)
+
+        try:
+            bytes_written = 0
+            while bytes_written < len(data):
+                written = self._send_write(
+                    handle_buffer.path,
+                    memoryview(data)[bytes_written:],
+                    offset + bytes_written,
+                    fh
+                )
+                if written <= 0:
+                    raise FuseOSError(errno.EIO)
+                bytes_written += written
+        except FuseOSError as fuse_error:
+            logging.error(
+                "Buffered write of %d bytes to %s failed: %s",
+                len(data),
+                handle_buffer.path,
+                fuse_error
+            )
+            # Keep the first error, it's the one the application missed
+            if handle_buffer.error_no == 0:
+                handle_buffer.error_no = fuse_error.errno or errno.EIO
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self._flush_interval / 2)
+            try:
+                self.flush_all(older_than=self._flush_interval)
+            except Exception as exception:
+                logging.error("Periodic write-back flush failed: %s", exception)
@@ -0,0 +1,231 @@
+import collections
+import math
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class HttpFsCompression:
+    """
+    Content codings for compressing request and response bodies
+
+    zlib's "deflate" is always available, faster codecs are registered when
+    their packages are installed. A server lists the codings it can decode
+    in an Accept-Encoding response header, so a client only compresses
+    request bodies for servers that advertised a coding. Responses are
+    compressed with the coding the client prefers from its Accept-Encoding
+    request header.
+    """
+    IDENTITY = "identity"
+
+    # Bodies smaller than this are sent uncompressed, they'd barely shrink
+    MIN_SIZE = 1024
+
+    # Bytes at the start of a body sampled to guess if it compresses
+    SAMPLE_SIZE = 1024
+
+    # Bits of entropy per byte above which a sample looks like compressed or
+    # encrypted data. Random bytes score about 7.8 on a 1 KiB sample, text
+    # and JSON 4 to 6.
+    MAX_ENTROPY = 7.0
+
+    # zlib trades some ratio for speed, large reads go through it
+    ZLIB_LEVEL = 1
+
+    # coding -> (compress, decompress), in increasing order of preference
+    _codecs = dict()
+
+    @staticmethod
+    def register(coding, compress, decompress):
+        """
+        Registers a coding, preferred over the ones registered before it
+        :param coding: The Content-Encoding token
+        :param compress: Called as compress(data), returns the bytes
+        :param decompress: Called as decompress(data, max_size), returns the
+        bytes. It may stop early once there are more than max_size, which is
+        None for no limit.
+        """
+        HttpFsCompression._codecs.pop(coding, None)
+        HttpFsCompression._codecs[coding] = (compress, decompress)
+
+    @staticmethod
+    def get_codings():
+        """
+        :return: The registered codings, most preferred first
+        """
+        return list(reversed(HttpFsCompression._codecs))
+
+    @staticmethod
+    def get_accept_encoding():
+        """
+        :return: An Accept-Encoding header value listing the registered codings
+        """
+        return ", ".join(HttpFsCompression.get_codings())
+
+    @staticmethod
+    def choose(accept_encoding):
+        """
+        :param accept_encoding: An Accept-Encoding header value, or None
+        :return: The most preferred registered coding the header accepts, or
+        None if it accepts none of them
+        """
+        if not accept_encoding:
+            return None
+
+        accepted = set()
+        refused = set()
+        for item in accept_encoding.split(","):
+            coding, _, params = item.partition(";")
+            coding = coding.strip().lower()
+            quality = 1.0
+            for param in params.split(";"):
+                name, _, value = param.partition("=")
+                if name.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if quality > 0:
+                accepted.add(coding)
+            else:
+                refused.add(coding)
+
+        for coding in HttpFsCompression.get_codings():
+            if coding in accepted or ("*" in accepted and coding not in refused):
+                return coding
+        return None
+
+    @staticmethod
+    def is_compressible(size, sample):
+        """
+        :param size: Size of the body
+        :param sample: The start of the body, only SAMPLE_SIZE bytes are used
+        :return: Whether the body is worth compressing
+        """
+        if size < HttpFsCompression.MIN_SIZE:
+            return False
+        sample = sample[:HttpFsCompression.SAMPLE_SIZE]
+        return HttpFsCompression.get_entropy(sample) <= HttpFsCompression.MAX_ENTROPY
+
+    @staticmethod
+    def get_entropy(sample):
+        """
+        :param sample: Bytes-like sample
+        :return: Shannon entropy of the sample in bits per byte
+        """
+        total = len(sample)
+        if total == 0:
+            return 0.0
+        return -sum(
+            count / total * math.log2(count / total)
+            for count in collections.Counter(bytes(sample)).values()
+        )
+
+    @staticmethod
+    def compress(coding, data):
+        """
+        :param coding: A registered coding
+        :param data: Bytes-like data
+        :return: The compressed bytes
+        :raise ValueError: If the coding isn't registered
+        """
+        return HttpFsCompression._get_codec(coding)[0](data)
+
+    @staticmethod
+    def decompress(coding, data, max_size=None):
+        """
+        :param coding: The Content-Encoding of the data
+        :param data: Bytes-like compressed data
+        :param max_size: Max size of the decompressed data, decompression
+        stops past it. None for no limit, only for data from a trusted peer.
+        :return: The decompressed bytes
+        :raise ValueError: If the coding isn't registered, the data is
+        invalid or it decompresses to more than max_size bytes
+        """
+        if coding == HttpFsCompression.IDENTITY:
+            return data
+        decompress = HttpFsCompression._get_codec(coding)[1]
+        try:
+            decompressed = decompress(data, max_size)
+        except Exception as e:
+            raise ValueError("Invalid {} data: {}".format(coding, e))
+        if max_size is not None and len(decompressed) > max_size:
+            raise ValueError(
+                "{} data decompresses to more than {} bytes".format(coding, max_size)
+            )
+        return decompressed
+
+    @staticmethod
+    def _get_codec(coding):
+        codec = HttpFsCompression._codecs.get(coding.strip().lower())
+        if codec is None:
+            raise ValueError("Unsupported Content-Encoding '{}'".format(coding))
+        return codec
+
+
+def _is_truncated(decompressor, decompressed, max_size):
+    """
+    :return: Whether a decompressor stopped before the end of its stream
+    because the data ran out, rather than because max_size was passed
+    """
+    return not decompressor.eof and (max_size is None or len(decompressed) <= max_size)
+
+
+def _inflate(data, max_size):
+    # Decompressing in one go would inflate a small body without limit
+    decompressor = zlib.decompressobj()
+    if max_size is None:
+        decompressed = decompressor.decompress(data)
+    else:
+        decompressed = decompressor.decompress(data, max_size + 1)
+    if _is_truncated(decompressor, decompressed, max_size):
+        raise ValueError("Truncated data")
+    return decompressed
+
+
+HttpFsCompression.register(
+    "deflate",
+    lambda data: zlib.compress(data, HttpFsCompression.ZLIB_LEVEL),
+    _inflate
+)
+
+if lz4 is not None:
+    def _lz4_decompress(data, max_size):
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        decompressed = decompressor.decompress(
+            data, -1 if max_size is None else max_size + 1
+        )
+        if _is_truncated(decompressor, decompressed, max_size):
+            raise ValueError("Truncated data")
+        return decompressed
+
+    HttpFsCompression.register("lz4", lz4.frame.compress, _lz4_decompress)
+
+if zstandard is not None:
+    def _zstd_decompress(data, max_size):
+        # Frames from other encoders may not record their size, so the
+        # frame is read until it ends or max_size is passed
+        chunks = []
+        size = 0
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            while max_size is None or size <= max_size:
+                chunk = reader.read(zstandard.DECOMPRESSION_RECOMMENDED_OUTPUT_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+        return b"".join(chunks)
+
+    HttpFsCompression.register(
+        "zstd",
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        _zstd_decompress
+    )
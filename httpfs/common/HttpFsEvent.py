@@ -0,0 +1,66 @@
+class HttpFsEvent:
+    """
+    Class representing a change made through the server, as sent to the
+    clients long-polling GET /events, with JSON serialization/deserialization
+    methods
+    """
+    # URL path of the long-poll endpoint for change events
+    URL_PATH = "/events"
+
+    # The file's contents changed
+    DATA = "data"
+    # Only the attributes changed: mode, owner, link count or times
+    ATTR = "attr"
+    # The path was created or removed, which also changes its directory
+    ENTRY = "entry"
+    # The path was renamed, along with everything below it
+    TREE = "tree"
+
+    CHANGES = (DATA, ATTR, ENTRY, TREE)
+
+    def __init__(self, path, change):
+        """
+        :param path: The changed path, relative to the server's root and
+        starting with "/"
+        :param change: One of the change types above
+        """
+        self._path = path
+        self._change = change
+
+    def get_path(self):
+        return self._path
+
+    def get_change(self):
+        return self._change
+
+    def is_below(self, subtree):
+        """
+        :param subtree: A directory path starting with "/"
+        :return: Whether the change affects subtree or a path below it
+        """
+        prefix = subtree.rstrip("/") + "/"
+        if self._path == subtree or self._path.startswith(prefix):
+            return True
+        # Renaming a directory moves everything below it
+        return self._change == HttpFsEvent.TREE and prefix.startswith(
+            self._path.rstrip("/") + "/"
+        )
+
+    @staticmethod
+    def from_dict(json_dict):
+        try:
+            for k in ["path", "change"]:
+                if not isinstance(json_dict.get(k), str):
+                    raise ValueError("Key '{}' should be a {}".format(k, str))
+            if json_dict["change"] not in HttpFsEvent.CHANGES:
+                raise ValueError("Unknown change '{}'".format(json_dict["change"]))
+
+            return HttpFsEvent(json_dict["path"], json_dict["change"])
+        except Exception as e:
+            raise ValueError("Invalid JSON for {}: '{}'".format(__class__, e))
+
+    def as_dict(self):
+        return {
+            "path": self._path,
+            "change": self._change
+        }
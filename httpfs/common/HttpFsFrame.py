@@ -0,0 +1,124 @@
+import struct
+
+import ujson
+
+
+class HttpFsFrame:
+    """
+    Binary framing for requests and responses that carry raw file data.
+
+    A frame is a 4 byte big-endian header length, a JSON header, then the raw
+    payloads back to back. Any bytes-like value in the framed dict is moved
+    out of the JSON header into the payload section and its location is
+    recorded in the header, so OP_READ/OP_WRITE data never has to be base64
+    encoded. Dicts without bytes values frame as a bare JSON header.
+    """
+    CONTENT_TYPE = "application/octet-stream"
+
+    _HEADER_LEN = struct.Struct("!I")
+    _PAYLOADS_KEY = "payloads"
+    _BYTES_TYPES = (bytes, bytearray, memoryview)
+
+    @staticmethod
+    def pack(frame_dict, payload_types=()):
+        """
+        Serializes the given dict into a frame
+        :param frame_dict: HttpFsRequest or HttpFsResponse dict, may contain
+        bytes-like values at any depth
+        :param payload_types: Other types of values to send as payloads,
+        they must support len() and are returned as chunks as they are
+        :return: List of bytes-like chunks making up the frame, so large
+        payloads are never copied into one buffer
+        """
+        payloads = []
+        header = HttpFsFrame._extract_payloads(
+            frame_dict, [], payloads, HttpFsFrame._BYTES_TYPES + tuple(payload_types)
+        )
+
+        if payloads:
+            header[HttpFsFrame._PAYLOADS_KEY] = [
+                [path, len(payload)] for path, payload in payloads
+            ]
+
+        header_bytes = ujson.dumps(header).encode("utf-8")
+        chunks = [HttpFsFrame._HEADER_LEN.pack(len(header_bytes)), header_bytes]
+        chunks.extend(payload for _, payload in payloads)
+        return chunks
+
+    @staticmethod
+    def pack_bytes(frame_dict):
+        """
+        Same as pack(), joined into a single bytes object
+        """
+        return b"".join(HttpFsFrame.pack(frame_dict))
+
+    @staticmethod
+    def unpack(frame_bytes, copy_payloads=False):
+        """
+        Parses a frame produced by pack()
+        :param frame_bytes: The raw frame
+        :param copy_payloads: Restore payloads as bytes copies, so
+        frame_bytes can be reused afterwards
+        :return: The framed dict, with payloads restored as memoryviews
+        into frame_bytes unless copy_payloads is set
+        """
+        frame_view = memoryview(frame_bytes)
+        header_len_size = HttpFsFrame._HEADER_LEN.size
+        if len(frame_view) < header_len_size:
+            raise ValueError("Frame is too short")
+
+        (header_len,) = HttpFsFrame._HEADER_LEN.unpack(frame_view[:header_len_size])
+        payload_start = header_len_size + header_len
+        if len(frame_view) < payload_start:
+            raise ValueError("Frame header is truncated")
+
+        header = ujson.loads(
+            bytes(frame_view[header_len_size:payload_start]).decode("utf-8")
+        )
+        if not isinstance(header, dict):
+            raise ValueError("Frame header is not a JSON object")
+
+        for path, length in header.pop(HttpFsFrame._PAYLOADS_KEY, []):
+            payload_end = payload_start + length
+            if len(frame_view) < payload_end:
+                raise ValueError("Frame payload is truncated")
+            payload = frame_view[payload_start:payload_end]
+            if copy_payloads:
+                payload = bytes(payload)
+            HttpFsFrame._set_path(header, path, payload)
+            payload_start = payload_end
+
+        return header
+
+    @staticmethod
+    def _extract_payloads(value, path, payloads, payload_types):
+        """
+        Copies the dict/list structure of value, replacing values of
+        payload_types with None and appending (path, payload) to payloads
+        """
+        if isinstance(value, payload_types):
+            payloads.append((path, value))
+            return None
+        if isinstance(value, dict):
+            return {
+                k: HttpFsFrame._extract_payloads(
+                    v, path + [k], payloads, payload_types
+                )
+                for k, v in value.items()
+            }
+        if isinstance(value, (list, tuple)):
+            return [
+                HttpFsFrame._extract_payloads(
+                    v, path + [i], payloads, payload_types
+                )
+                for i, v in enumerate(value)
+            ]
+        return value
+
+    @staticmethod
+    def _set_path(container, path, value):
+        if not path:
+            raise ValueError("Frame payload path is empty")
+        for key in path[:-1]:
+            container = container[key]
+        container[path[-1]] = value
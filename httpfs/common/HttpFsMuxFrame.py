@@ -0,0 +1,51 @@
+import struct
+
+
+class HttpFsMuxFrame:
+    """
+    Framing for multiplexed connections, which carry many requests at once
+
+    A client switches a connection to multiplexing with a GET request with
+    "Upgrade: httpfs-mux" and "Connection: Upgrade" headers, which the server
+    answers with 101 Switching Protocols. After that every HTTP/1.1 request
+    and response on the connection is sent as one frame: a 4 byte
+    big-endian stream id, a 4 byte big-endian length, then the HTTP message.
+    A response has the stream id of its request. Requests run concurrently
+    on the server, so responses can come back in any order.
+    """
+    UPGRADE_TOKEN = "httpfs-mux"
+
+    _HEADER = struct.Struct("!II")
+
+    # Stream ids wrap around at this value
+    MAX_STREAM_ID = 2**32
+
+    @staticmethod
+    def pack_header(stream_id, length):
+        """
+        :param stream_id: Id of the request the frame belongs to
+        :param length: Length of the HTTP message that follows
+        :return: The frame header bytes
+        """
+        return HttpFsMuxFrame._HEADER.pack(stream_id, length)
+
+    @staticmethod
+    def read(reader):
+        """
+        Reads one frame
+        :param reader: Buffered binary file of the connection
+        :return: (stream id, HTTP message bytes), or None if the connection
+        was closed between frames
+        :raise ConnectionResetError: If the connection was closed mid-frame
+        """
+        header = reader.read(HttpFsMuxFrame._HEADER.size)
+        if not header:
+            return None
+        if len(header) < HttpFsMuxFrame._HEADER.size:
+            raise ConnectionResetError("Frame header is truncated")
+
+        stream_id, length = HttpFsMuxFrame._HEADER.unpack(header)
+        message = reader.read(length)
+        if len(message) < length:
+            raise ConnectionResetError("Frame is truncated")
+        return stream_id, message
@@ -26,18 +26,79 @@ class HttpFsRequest:
     OP_WRITE = 20
     OP_CHOWN = 21
     OP_CHMOD = 22
+    OP_READDIR_PLUS = 23
+    OP_COMPOUND = 24
 
-    def __init__(self, op_type, args_dict, api_key=None):
+    # Operation type -> name, see get_op_name()
+    _OP_NAMES = {
+        OP_ACCESS: "access",
+        OP_CREATE: "create",
+        OP_FLUSH: "flush",
+        OP_FSYNC: "fsync",
+        OP_GET_ATTR: "getattr",
+        OP_LINK: "link",
+        OP_MKDIR: "mkdir",
+        OP_MKNOD: "mknod",
+        OP_OPEN: "open",
+        OP_READ: "read",
+        OP_READDIR: "readdir",
+        OP_READLINK: "readlink",
+        OP_RELEASE: "release",
+        OP_RENAME: "rename",
+        OP_RM_DIR: "rmdir",
+        OP_STAT_FS: "statfs",
+        OP_SYMLINK: "symlink",
+        OP_TRUNCATE: "truncate",
+        OP_UNLINK: "unlink",
+        OP_UTIMENS: "utimens",
+        OP_WRITE: "write",
+        OP_CHOWN: "chown",
+        OP_CHMOD: "chmod",
+        OP_READDIR_PLUS: "readdir_plus",
+        OP_COMPOUND: "compound"
+    }
+
+    # Key of an OP_COMPOUND sub-request arg referring to an earlier result
+    REF_KEY = "$ref"
+
+    def __init__(self, op_type, args_dict, api_key=None, request_id=None,
+                 timing=False):
         """
         Class cooresponding to the schema
         https://raw.githubusercontent.com/httpfs/httpfs/master/HttpFsRequest.schema.json
         :param op_type: One of the operation types above
         :param args_dict: Arguments for the operation
         :param api_key: API key for authentication with the server
+        :param request_id: Optional id the server logs the request with and
+        echoes in its response
+        :param timing: Ask the server for the time it spent in each phase of
+        the request, in a Server-Timing response header
         """
         self._type = op_type
         self._args = args_dict
         self._api_key = api_key
+        self._request_id = request_id
+        self._timing = timing
+
+    @staticmethod
+    def ref(step, key="file_descriptor"):
+        """
+        Builds an OP_COMPOUND sub-request arg that takes its value from the
+        response of an earlier sub-request
+        :param step: Index of the earlier sub-request
+        :param key: Key of the value in that sub-request's response data
+        :return: The arg value
+        """
+        return {HttpFsRequest.REF_KEY: [step, key]}
+
+    @staticmethod
+    def get_op_name(op_type):
+        """
+        :param op_type: One of the operation types above
+        :return: The operation's name in logs, metrics and latency stats, the
+        same on the client and the server
+        """
+        return HttpFsRequest._OP_NAMES.get(op_type, str(op_type))
 
     def get_type(self):
         return self._type
@@ -45,6 +106,12 @@ class HttpFsRequest:
     def get_args(self):
         return self._args
 
+    def get_request_id(self):
+        return self._request_id
+
+    def is_timing_requested(self):
+        return self._timing
+
     @staticmethod
     def from_dict(json_dict):
         try:
@@ -54,17 +121,27 @@ class HttpFsRequest:
             for k, t in [("type", int), ("args", dict)]:
                 if not isinstance(json_dict[k], t):
                     raise ValueError("Key '{}' should be a {}".format(k, t))
+            for k, t in [("id", str), ("timing", bool)]:
+                if k in json_dict and not isinstance(json_dict[k], t):
+                    raise ValueError("Key '{}' should be a {}".format(k, t))
 
             return HttpFsRequest(
                 json_dict["type"],
-                json_dict["args"]
+                json_dict["args"],
+                request_id=json_dict.get("id"),
+                timing=json_dict.get("timing", False)
             )
         except Exception as e:
             raise ValueError("Invalid JSON for {}: '{}'".format(__class__, e))
 
     def as_dict(self):
         # See HttpFsRequest.schema.json
-        return {
+        request_dict = {
             "type": self._type,
             "args": self._args
         }
+        if self._request_id is not None:
+            request_dict["id"] = self._request_id
+        if self._timing:
+            request_dict["timing"] = True
+        return request_dict
@@ -5,6 +5,13 @@ class HttpFsResponse:
     """
     ERR_NONE = 0
 
+    # Response header echoing the id of the request, see HttpFsRequest
+    REQUEST_ID_HEADER = "X-HttpFs-Request-Id"
+
+    # Response header with the server's time per phase of the request, when
+    # the request asked for it
+    SERVER_TIMING_HEADER = "Server-Timing"
+
     def __init__(self, error_no=ERR_NONE, response_data=dict()):
         """
         Class cooresponding to the schema
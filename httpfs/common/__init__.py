@@ -1,3 +1,7 @@
 from .HttpFsRequest import HttpFsRequest
 from .HttpFsResponse import HttpFsResponse
+from .HttpFsFrame import HttpFsFrame
+from .HttpFsMuxFrame import HttpFsMuxFrame
+from .HttpFsCompression import HttpFsCompression
+from .HttpFsEvent import HttpFsEvent
 from httpfs.common.credentials.TextCredStore import TextCredStore
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import os
+import socket
+import ssl
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from httpfs.common import HttpFsEvent
+from ._BufferedRequestHandler import _BufferedRequestHandler
+from ._FileRegion import _FileRegion
+from ._HttpFsServerMixin import _HttpFsServerMixin
+from ._InvalidationLog import _InvalidationLog
+
+
+class AsyncHttpFsServer(_HttpFsServerMixin):
+    """
+    HttpFs server that multiplexes client connections on an asyncio event
+    loop instead of using one thread per connection
+
+    Connections are read and written on the event loop. Each complete request
+    is run through the same _HttpFsRequestHandler logic as HttpFsServer on a
+    bounded thread pool, so blocking filesystem calls never stall the loop
+    and the number of threads doesn't grow with the number of clients.
+    GET /events long polls wait for changes on the loop, and only take a
+    thread once there is something to send. File data is streamed from the
+    file in bounded chunks read on the thread pool.
+    """
+
+    # Largest request line + headers accepted, like http.server's limits
+    _max_header_bytes = 64 * 1024
+
+    def __init__(self, port, fs_root, cred_store_file=None, tls_key=None,
+                 tls_cert=None, executor_threads=32, worker_group=None,
+                 slow_request_time=None):
+        """
+        :param port: Port to run the server on
+        :param fs_root: The HttpFS filesystem root on the server
+        :param tls_key: Optional key file for HTTPS
+        :param tls_cert: Optional cert file for HTTPS
+        :param executor_threads: Max threads running requests at once
+        :param worker_group: Optional _WorkerGroup, which makes the server
+        share its port with the other workers using SO_REUSEPORT
+        :param slow_request_time: Seconds after which a request is logged
+        with the time spent in each phase, None to log none
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if worker_group is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(("", port))
+        self.socket.listen(socket.SOMAXCONN)
+        self.server_address = self.socket.getsockname()
+
+        self._ssl_context = None
+        has_tls_key = tls_key is not None and os.path.exists(tls_key)
+        has_tls_crt = tls_cert is not None and os.path.exists(tls_cert)
+        if has_tls_key and has_tls_crt:
+            self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self._ssl_context.load_cert_chain(tls_cert, keyfile=tls_key)
+
+        self._init_httpfs(fs_root, cred_store_file, worker_group, slow_request_time)
+        self._configure_socket(self.socket)
+
+        self._executor_threads = executor_threads
+        self._loop = None
+        self._stop_event = None
+        self._shutdown_requested = threading.Event()
+        # Futures of the long polls waiting for changes, on the loop
+        self._event_waiters = set()
+        # Whether a wake-up of the waiters is scheduled, so a burst of
+        # changes wakes them once
+        self._wake_scheduled = False
+        self.get_invalidation_log().add_listener(self._on_changes_published)
+
+    def serve_forever(self):
+        """
+        Runs the event loop until shutdown() is called
+        """
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        """
+        Stops serve_forever(), safe to call from any thread
+        """
+        self._shutdown_requested.set()
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    def server_close(self):
+        self.socket.close()
+
+    def get_max_event_wait(self):
+        # Long polls already waited on the loop, see _wait_for_events()
+        return 0
+
+    async def _serve(self):
+        self._stop_event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._shutdown_requested.is_set():
+            self._stop_event.set()
+
+        with ThreadPoolExecutor(
+            max_workers=self._executor_threads,
+            thread_name_prefix="httpfs-executor"
+        ) as executor:
+            server = await asyncio.start_server(
+                lambda reader, writer: self._serve_connection(reader, writer, executor),
+                sock=self.socket,
+                ssl=self._ssl_context,
+                limit=AsyncHttpFsServer._max_header_bytes
+            )
+            async with server:
+                await self._stop_event.wait()
+
+        self._loop = None
+
+    async def _serve_connection(self, reader, writer, executor):
+        """
+        Serves keep-alive requests on one connection until either side
+        closes it
+        """
+        client_address = writer.get_extra_info("peername")
+        metrics = self.get_metrics()
+        metrics.add("httpfs_connections_total")
+
+        try:
+            while True:
+                raw_request = await AsyncHttpFsServer._read_request(reader)
+                if raw_request is None:
+                    break
+                await self._wait_for_events(raw_request)
+
+                response_parts, close_connection = await self._loop.run_in_executor(
+                    executor,
+                    self._handle_request,
+                    raw_request,
+                    client_address
+                )
+
+                is_sent = await self._write_response(writer, response_parts, executor)
+                if close_connection or not is_sent:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError) as e:
+            logging.debug("Closing connection from %s: %s", client_address, e)
+        except asyncio.CancelledError:
+            # Open connections are cancelled when the server shuts down
+            pass
+        except Exception as e:
+            logging.error("Error serving %s: %s", client_address, e)
+        finally:
+            writer.close()
+            metrics.add("httpfs_connections_closed")
+
+    async def _write_response(self, writer, response_parts, executor):
+        """
+        Writes a response from _BufferedRequestHandler.get_response_parts()
+        and closes its _FileRegions
+        :return: False if a _FileRegion came up short because its file was
+        truncated, the response is then shorter than its Content-Length and
+        the connection must be closed
+        """
+        try:
+            for part in response_parts:
+                if not isinstance(part, _FileRegion):
+                    writer.write(part)
+                    continue
+
+                sent_size = 0
+                chunks = part.iter_chunks()
+                while True:
+                    chunk = await self._loop.run_in_executor(executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+                    sent_size += len(chunk)
+                if sent_size < len(part):
+                    logging.error(
+                        "File shrank while being sent to %s, closing the connection",
+                        writer.get_extra_info("peername")[0]
+                    )
+                    return False
+            await writer.drain()
+            return True
+        finally:
+            for part in response_parts:
+                if isinstance(part, _FileRegion):
+                    part.close()
+
+    async def _wait_for_events(self, raw_request):
+        """
+        Holds a GET /events request until there are changes to send it or
+        its timeout passes, returns right away for other requests
+        """
+        request_line = raw_request[:raw_request.find(b"\r\n")].decode("latin-1")
+        method, _, target = request_line.partition(" ")
+        url = urllib.parse.urlsplit(target.rpartition(" ")[0])
+        if method != "GET" or url.path != HttpFsEvent.URL_PATH:
+            return
+
+        invalidation_log = self.get_invalidation_log()
+        query = _InvalidationLog.parse_query(url.query)
+        deadline = self._loop.time() + query.timeout
+        while not invalidation_log.has_events(query):
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                return
+            waiter = self._loop.create_future()
+            self._event_waiters.add(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return
+            finally:
+                self._event_waiters.discard(waiter)
+
+    def _on_changes_published(self):
+        """
+        Wakes the waiting long polls, called from the thread that published
+        """
+        loop = self._loop
+        if loop is not None and not self._wake_scheduled:
+            self._wake_scheduled = True
+            loop.call_soon_threadsafe(self._wake_event_waiters)
+
+    def _wake_event_waiters(self):
+        self._wake_scheduled = False
+        for waiter in self._event_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._event_waiters.clear()
+
+    def _handle_request(self, raw_request, client_address):
+        """
+        Runs one request through the request handler, on an executor thread
+        :return: (response parts, whether to close the connection)
+        """
+        handler = _BufferedRequestHandler(raw_request, client_address, self)
+        return handler.get_response_parts(), handler.close_connection
+
+    @staticmethod
+    async def _read_request(reader):
+        """
+        Reads one HTTP request, using Content-Length to find its end
+        :return: The request bytes, or None if the client closed the
+        connection between requests
+        """
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+
+        content_len = 0
+        for header_line in head.split(b"\r\n")[1:]:
+            name, _, value = header_line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                content_len = int(value.strip())
+                break
+
+        if content_len <= 0:
+            return head
+        if content_len > _BufferedRequestHandler.max_request_size:
+            raise ValueError("Request body of {} bytes is too large".format(content_len))
+        return head + await reader.readexactly(content_len)
@@ -1,14 +1,14 @@
 import os
 import socket
-import threading
 import ssl
+from concurrent.futures import ThreadPoolExecutor
 from http.server import ThreadingHTTPServer
 
 from ._HttpFsRequestHandler import _HttpFsRequestHandler
-from ..common.credentials.TextCredStore import TextCredStore
+from ._HttpFsServerMixin import _HttpFsServerMixin
 
 
-class HttpFsServer(ThreadingHTTPServer):
+class HttpFsServer(_HttpFsServerMixin, ThreadingHTTPServer):
     """
     Server that implements the HttpFsRequestHandler methods
     """
@@ -17,19 +17,26 @@ class HttpFsServer(ThreadingHTTPServer):
     # the port after shutting down
     allow_reuse_address = True
 
-    # TCP keepAlive activates after 1 second of idle connection,
-    # sends a ping every 3 seconds, and closes after 1 failed ping
-    _tcp_keepidle_secs = 1
-    _tcp_keep_interval_secs = 3
-    _tcp_keep_max_fails = 1
+    # The socketserver default of 5 drops connections when many clients
+    # connect at once
+    request_queue_size = socket.SOMAXCONN
 
-    def __init__(self, port, fs_root, cred_store_file=None, tls_key=None, tls_cert=None):
+    def __init__(self, port, fs_root, cred_store_file=None, tls_key=None,
+                 tls_cert=None, worker_group=None, executor_threads=32,
+                 slow_request_time=None):
         """
         :param port: Port to run the server on
         :param fs_root: The HttpFS filesystem root on the server
         :param tls_key: Optional key file for HTTPS
         :param tls_cert: Optional cert file for HTTPS
+        :param worker_group: Optional _WorkerGroup, which makes the server
+        share its port with the other workers using SO_REUSEPORT
+        :param executor_threads: Max threads running the requests of
+        multiplexed connections at once
+        :param slow_request_time: Seconds after which a request is logged
+        with the time spent in each phase, None to log none
         """
+        self._reuse_port = worker_group is not None
         super().__init__(("", port), _HttpFsRequestHandler)
 
         has_tls_key = tls_key is not None and os.path.exists(tls_key)
@@ -42,45 +49,30 @@ class HttpFsServer(ThreadingHTTPServer):
                 server_side=True
             )
 
-        self._fs_root = os.path.realpath(fs_root)
-        self._fs_lock = threading.Lock()
+        self._init_httpfs(fs_root, cred_store_file, worker_group, slow_request_time)
+        self._configure_socket(self.socket)
 
-        if cred_store_file is not None:
-            self._cred_store = TextCredStore(cred_store_file)
-        else:
-            self._cred_store = None
-
-        # This line fixes the HTTP/1.1 keep-alive delay
-        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-        # These options configure TCP keep-alive, which is different
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        self.socket.setsockopt(
-            socket.IPPROTO_TCP,
-            socket.TCP_KEEPIDLE,
-            HttpFsServer._tcp_keepidle_secs
-        )
-        self.socket.setsockopt(
-            socket.IPPROTO_TCP,
-            socket.TCP_KEEPINTVL,
-            HttpFsServer._tcp_keep_interval_secs
-        )
-        self.socket.setsockopt(
-            socket.IPPROTO_TCP,
-            socket.TCP_KEEPCNT,
-            HttpFsServer._tcp_keep_max_fails
+        self._mux_executor = ThreadPoolExecutor(
+            max_workers=executor_threads,
+            thread_name_prefix="httpfs-executor"
         )
 
-        if not os.path.exists(self._fs_root):
-            raise RuntimeError(
-                "Filesystem root '{}' doesn't exist".format(self._fs_root)
-            )
+    def server_bind(self):
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
-    def get_fs_root(self):
-        return self._fs_root
+    def process_request_thread(self, request, client_address):
+        metrics = self.get_metrics()
+        metrics.add("httpfs_connections_total")
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            metrics.add("httpfs_connections_closed")
 
-    def get_fs_lock(self):
-        return self._fs_lock
+    def server_close(self):
+        super().server_close()
+        self._mux_executor.shutdown(wait=False)
 
-    def get_cred_store(self):
-        return self._cred_store
+    def get_mux_executor(self):
+        return self._mux_executor
@@ -0,0 +1,109 @@
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+
+from ._WorkerGroup import _WorkerGroup
+from ._WorkerPeerServer import _WorkerPeerServer
+
+
+class HttpFsWorkers:
+    """
+    Runs several forked HttpFs server processes that share one port with
+    SO_REUSEPORT, so request handling isn't limited to the one core a
+    single Python process can use
+
+    Each worker has its own file descriptor table. Handles returned by open
+    and create encode the worker that owns them, and requests that reach a
+    different worker are forwarded to the owner over a Unix socket.
+    """
+
+    def __init__(self, num_workers, server_factory):
+        """
+        :param num_workers: Number of worker processes to fork
+        :param server_factory: Called in each worker as
+        server_factory(worker_group=group) to create its server, usually a
+        functools.partial of HttpFsServer or AsyncHttpFsServer
+        """
+        self._num_workers = num_workers
+        self._server_factory = server_factory
+        self._worker_pids = dict()
+        self._run_dir = None
+
+    def serve_forever(self):
+        """
+        Forks the workers and waits for them to exit
+        """
+        self._run_dir = tempfile.mkdtemp(prefix="httpfs-workers-")
+
+        # Stop the workers on SIGTERM too, not just Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            for index in range(self._num_workers):
+                pid = os.fork()
+                if pid == 0:
+                    self._run_worker(index)
+                self._worker_pids[pid] = index
+
+            while self._worker_pids:
+                pid, status = os.wait()
+                index = self._worker_pids.pop(pid, None)
+                if index is not None and status != 0:
+                    logging.error(
+                        "Worker %d exited with status %d, its open files are lost",
+                        index,
+                        status
+                    )
+        finally:
+            self.shutdown()
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+
+    def shutdown(self):
+        """
+        Stops every worker, in-flight requests are not waited for
+        """
+        for pid in list(self._worker_pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+            self._worker_pids.pop(pid, None)
+
+    def _run_worker(self, index):
+        """
+        Body of a forked worker, never returns
+        """
+        exit_status = 0
+        try:
+            # Ctrl+C reaches the whole process group, the parent stops workers
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+            worker_group = _WorkerGroup(index, self._num_workers, self._run_dir)
+            server = self._server_factory(worker_group=worker_group)
+            peer_server = _WorkerPeerServer(
+                worker_group.get_socket_path(index), server
+            )
+            threading.Thread(target=peer_server.serve_forever, daemon=True).start()
+
+            # shutdown() blocks until serve_forever() returns, so it can't
+            # run in the signal handler on the serving thread
+            signal.signal(
+                signal.SIGTERM,
+                lambda signum, frame: threading.Thread(target=server.shutdown).start()
+            )
+
+            logging.debug("Worker %d serving as pid %d", index, os.getpid())
+            server.serve_forever()
+            peer_server.shutdown()
+        except Exception as e:
+            logging.error("Worker %d failed: %s", index, e)
+            exit_status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_status)
@@ -0,0 +1,48 @@
+import io
+
+from ._FileRegion import _FileRegion
+from ._HttpFsRequestHandler import _HttpFsRequestHandler
+
+
+class _BufferedRequestHandler(_HttpFsRequestHandler):
+    """
+    Runs the _HttpFsRequestHandler logic for one HTTP request that has
+    already been read off the connection, and buffers the response instead
+    of writing it to a socket. Used by engines that do their own connection
+    I/O, like AsyncHttpFsServer.
+
+    It is constructed like any socketserver handler, except that the request
+    is the raw bytes of the full HTTP request, including the body. _FileRegion
+    payloads aren't read into the buffer, the engine streams them when it
+    sends the response.
+    """
+
+    def setup(self):
+        self.rfile = io.BytesIO(self.request)
+        self.wfile = io.BytesIO()
+        # The response before wfile, as bytes and _FileRegions
+        self._response_parts = []
+
+    def handle(self):
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+    def write_payload(self, chunk):
+        # The handler closes its regions once the response is written, the
+        # engine gets regions of its own
+        if isinstance(chunk, _FileRegion):
+            self._response_parts.append(self.wfile.getvalue())
+            self._response_parts.append(chunk.dup())
+            self.wfile = io.BytesIO()
+            return None
+        return super().write_payload(chunk)
+
+    def get_response_parts(self):
+        """
+        :return: The buffered HTTP response, as a list of bytes and
+        _FileRegions. The caller sends the regions and closes them.
+        """
+        parts = self._response_parts + [self.wfile.getvalue()]
+        return [part for part in parts if len(part) > 0]
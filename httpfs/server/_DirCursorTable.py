@@ -0,0 +1,88 @@
+import itertools
+import threading
+import time
+
+
+class _DirCursorTable:
+    """
+    Open os.scandir() iterators of paginated directory listings
+
+    Each page of a listing hands its iterator back with put() and the
+    client continues from the returned cursor id, so a listing is never held
+    in memory as a whole. Iterators are taken out of the table while a page is
+    read, which keeps two requests from advancing the same one at once.
+    Like file handles, a cursor can only be continued by the client and user
+    that started the listing, cursor ids are easy to guess and the access
+    check only runs for the first page.
+    Cursors that aren't continued within idle_timeout seconds are closed, and
+    the oldest cursors are closed when there are more than max_cursors.
+    """
+
+    def __init__(self, idle_timeout=60, max_cursors=1024):
+        """
+        :param idle_timeout: Seconds before an unused cursor is closed
+        :param max_cursors: Max number of open cursors
+        """
+        self._idle_timeout = idle_timeout
+        self._max_cursors = max_cursors
+        self._guard = threading.Lock()
+        self._next_id = itertools.count(1)
+        # cursor id -> (expiry time, scandir iterator, owner, uid), oldest
+        # first
+        self._cursors = dict()
+
+    def put(self, dir_iterator, owner, uid):
+        """
+        Stores a partially read iterator
+        :param dir_iterator: The os.scandir() iterator
+        :param owner: Id of the client listing the directory
+        :param uid: The uid the directory is listed as
+        :return: The cursor id to continue the listing with
+        """
+        now = time.monotonic()
+        with self._guard:
+            cursor_id = next(self._next_id)
+            self._cursors[cursor_id] = (
+                now + self._idle_timeout, dir_iterator, owner, uid
+            )
+            stale_iterators = self._pop_stale(now)
+
+        for stale_iterator in stale_iterators:
+            stale_iterator.close()
+        return cursor_id
+
+    def take(self, cursor_id, owner, uid):
+        """
+        Removes an iterator from the table to read its next page
+        :param cursor_id: An id returned by put()
+        :param owner: Id of the client continuing the listing
+        :param uid: The uid it's continued as
+        :return: The iterator, or None if the cursor expired, never existed
+        or belongs to another client or user
+        """
+        with self._guard:
+            cursor = self._cursors.get(cursor_id)
+            # Left in place, so guessing ids doesn't end others' listings
+            if cursor is None or cursor[2:] != (owner, uid):
+                return None
+            expiry, dir_iterator, _, _ = self._cursors.pop(cursor_id)
+
+        if dir_iterator is not None and expiry < time.monotonic():
+            dir_iterator.close()
+            return None
+        return dir_iterator
+
+    def _pop_stale(self, now):
+        """
+        Removes expired cursors and the oldest cursors over max_cursors
+        :return: The removed iterators, to be closed outside the lock
+        """
+        # Every cursor gets the same timeout, so the dict is ordered by expiry
+        stale_ids = []
+        for cursor_id, (expiry, _, _, _) in self._cursors.items():
+            live_count = len(self._cursors) - len(stale_ids)
+            if expiry >= now and live_count <= self._max_cursors:
+                break
+            stale_ids.append(cursor_id)
+
+        return [self._cursors.pop(cursor_id)[1] for cursor_id in stale_ids]
@@ -0,0 +1,354 @@
+import collections
+import contextlib
+import errno
+import itertools
+import logging
+import os
+import resource
+import threading
+import time
+
+
+class _OpenFile:
+    """
+    A file a client opened, with its fd while it has one
+    """
+    __slots__ = (
+        "path", "flags", "owner", "uid", "gid", "mode", "file_key", "fd",
+        "users", "last_used", "is_released"
+    )
+
+    def __init__(self, file_descriptor, path, flags, owner, uid, gid, mode):
+        self.path = path
+        self.flags = flags
+        self.owner = owner
+        # The opener and the access mode bits they were granted
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+        file_stats = os.fstat(file_descriptor)
+        # Identifies the file when it's reopened by path
+        self.file_key = (file_stats.st_dev, file_stats.st_ino)
+        # None while the file is parked
+        self.fd = file_descriptor
+        # Number of requests using the fd right now
+        self.users = 0
+        self.last_used = time.monotonic()
+        # Set when the handle is closed while requests still use the fd, the
+        # last one closes it
+        self.is_released = False
+
+
+class _FileHandleTable:
+    """
+    The files clients have open, behind opaque handle ids
+
+    Clients get a handle id from open and create instead of a raw fd, and
+    only the client that opened a file can use its handle. A client is its
+    API key on servers that require one and its IP address otherwise.
+
+    Clients can have more files open than the process has fds: when
+    max_open_fds fds are open, the least recently used files are parked by
+    closing their fd, and reopened by path with the same flags the next time
+    they're used. Positional reads and writes don't depend on the fd's
+    offset, so this is invisible to the client, unless the file was renamed
+    or removed in between and the handle becomes stale. Files whose path no
+    longer leads to them are never parked.
+
+    Handles unused for idle_timeout seconds are closed, which frees the files
+    of clients that went away without releasing them. The table looks for
+    them whenever a handle is added, used or closed.
+
+    Files are reopened and stat'ed without holding the table's lock, so a
+    slow disk only holds up the requests for its own files.
+    """
+    # Flags that mustn't be repeated when a parked file is reopened
+    _CREATE_FLAGS = os.O_CREAT | os.O_EXCL | os.O_TRUNC
+
+    # Fds left for sockets and everything else when max_open_fds is derived
+    # from the fd limit
+    _RESERVED_FDS = 256
+
+    # Seconds between two scans for idle handles
+    _REAP_INTERVAL = 60
+
+    def __init__(self, file_locks, max_open_fds=None, idle_timeout=24 * 3600):
+        """
+        :param file_locks: The _FileLockTable to register open fds with
+        :param max_open_fds: Max number of fds kept open for handles, by
+        default three quarters of the process's fd limit
+        :param idle_timeout: Seconds before an unused handle is closed, 0
+        keeps handles until they're released
+        """
+        if max_open_fds is None:
+            max_open_fds = _FileHandleTable.get_default_max_open_fds()
+        self._file_locks = file_locks
+        self._max_open_fds = max_open_fds
+        self._idle_timeout = idle_timeout
+        self._guard = threading.Lock()
+        self._next_id = itertools.count(1)
+        # handle id -> _OpenFile, least recently used first
+        self._handles = collections.OrderedDict()
+        # handle id -> _OpenFile of the files with an fd that can be parked,
+        # least recently used first
+        self._parkable = collections.OrderedDict()
+        self._open_fds = 0
+        self._last_reap = time.monotonic()
+
+    @staticmethod
+    def get_default_max_open_fds():
+        """
+        :return: Three quarters of the soft fd limit, less the fds reserved
+        for everything else
+        """
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY:
+            soft_limit = 65536
+        return max(16, soft_limit * 3 // 4 - _FileHandleTable._RESERVED_FDS)
+
+    def add(self, file_descriptor, path, flags, owner, uid, gid, mode):
+        """
+        Takes over a newly opened fd, which the table closes from now on
+        :param file_descriptor: The fd returned by os.open()
+        :param path: Absolute path the file was opened with
+        :param flags: The flags it was opened with
+        :param owner: Id of the client opening it
+        :param uid: The opener's uid
+        :param gid: The opener's gid
+        :param mode: The access mode bits the opener was granted
+        :return: The handle id
+        """
+        open_file = _OpenFile(file_descriptor, path, flags, owner, uid, gid, mode)
+        self._file_locks.track(file_descriptor, flags)
+
+        with self._guard:
+            handle_id = next(self._next_id)
+            self._handles[handle_id] = open_file
+            self._parkable[handle_id] = open_file
+            self._open_fds += 1
+            to_close = self._pop_idle()
+
+        self._close_fds(to_close)
+        self._park_over_limit()
+        return handle_id
+
+    @contextlib.contextmanager
+    def use(self, handle_id, owner):
+        """
+        Context manager for using a handle's fd, reopening it if it was
+        parked. The fd stays open until the block exits.
+        :param handle_id: The handle id
+        :param owner: Id of the client using it
+        :return: The _OpenFile, whose fd is set
+        :raise OSError: EBADF if the client has no such handle, ESTALE if
+        the file can't be reopened
+        """
+        with self._guard:
+            open_file = self._handles.get(handle_id)
+            if open_file is None or open_file.owner != owner:
+                raise OSError(errno.EBADF, "Unknown file handle")
+            # In use before others are parked, so it isn't parked itself
+            open_file.users += 1
+            is_parked = open_file.fd is None
+            open_file.last_used = time.monotonic()
+            self._handles.move_to_end(handle_id)
+            if handle_id in self._parkable:
+                self._parkable.move_to_end(handle_id)
+            to_close = self._pop_idle()
+
+        try:
+            self._close_fds(to_close)
+            if is_parked:
+                self._unpark(handle_id, open_file)
+            self._park_over_limit()
+            yield open_file
+        finally:
+            with self._guard:
+                open_file.users -= 1
+                # Closing the fd under another request could hand its number
+                # to a different file mid-read
+                if open_file.users == 0 and open_file.is_released:
+                    to_close = [open_file.fd]
+                    open_file.fd = None
+                else:
+                    to_close = []
+            self._close_fds(to_close)
+
+    def close(self, handle_id, owner):
+        """
+        Closes a handle the client released
+        :param handle_id: The handle id
+        :param owner: Id of the client releasing it
+        :raise OSError: EBADF if the client has no such handle
+        """
+        with self._guard:
+            open_file = self._handles.get(handle_id)
+            if open_file is None or open_file.owner != owner:
+                raise OSError(errno.EBADF, "Unknown file handle")
+            to_close = self._remove(handle_id) + self._pop_idle()
+
+        self._close_fds(to_close)
+
+    def get_open_fds(self):
+        """
+        :return: Number of fds currently open for handles
+        """
+        return self._open_fds
+
+    def __len__(self):
+        return len(self._handles)
+
+    def _unpark(self, handle_id, open_file):
+        """
+        Gives a parked file an fd again. The file is reopened without
+        holding _guard, the fd is dropped if another request reopened it
+        first.
+        :raise OSError: ESTALE if the file can't be reopened, EBADF if the
+        handle was closed meanwhile
+        """
+        try:
+            file_descriptor = os.open(
+                open_file.path, open_file.flags & ~_FileHandleTable._CREATE_FLAGS
+            )
+        except OSError as e:
+            raise OSError(errno.ESTALE, "Can't reopen parked file: {}".format(e))
+
+        try:
+            file_stats = os.fstat(file_descriptor)
+        except OSError:
+            os.close(file_descriptor)
+            raise
+        if (file_stats.st_dev, file_stats.st_ino) != open_file.file_key:
+            os.close(file_descriptor)
+            raise OSError(errno.ESTALE, "Parked file was replaced")
+        self._file_locks.track(file_descriptor, open_file.flags)
+
+        with self._guard:
+            is_closed = self._handles.get(handle_id) is not open_file
+            if open_file.fd is None and not is_closed:
+                open_file.fd = file_descriptor
+                self._parkable[handle_id] = open_file
+                self._open_fds += 1
+                return
+
+        self._close_fds([file_descriptor])
+        if is_closed:
+            raise OSError(errno.EBADF, "Unknown file handle")
+
+    def _park_over_limit(self):
+        """
+        Parks the least recently used files while too many fds are open.
+        Candidates are picked under _guard, stat'ed without it, then checked
+        again under _guard since another request may have used them meanwhile
+        """
+        with self._guard:
+            candidates = []
+            skipped = []
+            excess = self._open_fds - self._max_open_fds
+            while len(candidates) < excess and self._parkable:
+                handle_id, open_file = self._parkable.popitem(last=False)
+                if open_file.users > 0:
+                    skipped.append((handle_id, open_file))
+                else:
+                    candidates.append((handle_id, open_file))
+
+            # Files in use stay the least recently used ones
+            for handle_id, open_file in reversed(skipped):
+                self._parkable[handle_id] = open_file
+                self._parkable.move_to_end(handle_id, last=False)
+
+        if not candidates:
+            return
+
+        # Files unlinked while open can't be reopened, they keep their fd
+        linked = [
+            (handle_id, open_file)
+            for handle_id, open_file in candidates
+            if self._still_linked(open_file)
+        ]
+
+        to_close = []
+        with self._guard:
+            for handle_id, open_file in linked:
+                if self._handles.get(handle_id) is not open_file or open_file.fd is None:
+                    continue
+                if open_file.users > 0:
+                    # Used meanwhile, it's now the most recently used file
+                    self._parkable[handle_id] = open_file
+                    continue
+                if self._open_fds <= self._max_open_fds:
+                    self._parkable[handle_id] = open_file
+                    self._parkable.move_to_end(handle_id, last=False)
+                    continue
+                to_close.append(open_file.fd)
+                open_file.fd = None
+                self._open_fds -= 1
+
+        self._close_fds(to_close)
+
+    @staticmethod
+    def _still_linked(open_file):
+        """
+        :return: Whether the file's path still leads to it
+        """
+        try:
+            file_stats = os.stat(open_file.path)
+        except OSError:
+            return False
+        return (file_stats.st_dev, file_stats.st_ino) == open_file.file_key
+
+    def _pop_idle(self):
+        """
+        Removes the handles unused for idle_timeout, at most once every
+        _REAP_INTERVAL seconds, must hold _guard
+        :return: The fds to close outside the lock
+        """
+        now = time.monotonic()
+        if self._idle_timeout <= 0 or now - self._last_reap < _FileHandleTable._REAP_INTERVAL:
+            return []
+        self._last_reap = now
+
+        # _handles is ordered by last use
+        idle = []
+        for handle_id, open_file in self._handles.items():
+            if now - open_file.last_used < self._idle_timeout:
+                break
+            if open_file.users == 0:
+                idle.append(handle_id)
+
+        if idle:
+            logging.info(
+                "Closing %d file handles unused for %ds",
+                len(idle),
+                self._idle_timeout
+            )
+        to_close = []
+        for handle_id in idle:
+            to_close.extend(self._remove(handle_id))
+        return to_close
+
+    def _remove(self, handle_id):
+        """
+        Removes a handle from the table, must hold _guard
+        :return: The fds to close outside the lock
+        """
+        open_file = self._handles.pop(handle_id)
+        self._parkable.pop(handle_id, None)
+        if open_file.fd is None:
+            return []
+
+        self._open_fds -= 1
+        if open_file.users > 0:
+            open_file.is_released = True
+            return []
+        file_descriptor = open_file.fd
+        open_file.fd = None
+        return [file_descriptor]
+
+    def _close_fds(self, file_descriptors):
+        for file_descriptor in file_descriptors:
+            self._file_locks.untrack(file_descriptor)
+            try:
+                os.close(file_descriptor)
+            except OSError as e:
+                logging.debug("Error closing file: %s", e)
@@ -0,0 +1,70 @@
+import os
+import threading
+
+
+class _FileLockTable:
+    """
+    Per-file locks for the file descriptors that still need ordered writes
+
+    Reads and writes use positional I/O, so most file descriptors never need
+    a lock. O_APPEND descriptors ignore the write offset and instead depend on
+    the order writes reach the file, so their writes are serialized with a
+    lock shared by every O_APPEND descriptor open on the same file.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        # fd -> (st_dev, st_ino) of the file, only for O_APPEND fds
+        self._fd_files = dict()
+        # (st_dev, st_ino) -> [lock, number of fds using it]
+        self._file_locks = dict()
+
+    def track(self, file_descriptor, flags):
+        """
+        Registers a newly opened file descriptor
+        :param file_descriptor: The fd returned by os.open()
+        :param flags: The flags the fd was opened with
+        """
+        if not flags & os.O_APPEND:
+            return
+
+        file_stats = os.fstat(file_descriptor)
+        file_key = (file_stats.st_dev, file_stats.st_ino)
+
+        with self._guard:
+            self._fd_files[file_descriptor] = file_key
+            lock_entry = self._file_locks.setdefault(
+                file_key, [threading.Lock(), 0]
+            )
+            lock_entry[1] += 1
+
+    def untrack(self, file_descriptor):
+        """
+        Forgets a file descriptor that is about to be closed
+        :param file_descriptor: The fd passed to os.close()
+        """
+        with self._guard:
+            file_key = self._fd_files.pop(file_descriptor, None)
+            if file_key is None:
+                return
+
+            lock_entry = self._file_locks[file_key]
+            lock_entry[1] -= 1
+            if lock_entry[1] == 0:
+                del self._file_locks[file_key]
+
+    def get_lock(self, file_descriptor):
+        """
+        :param file_descriptor: An open fd
+        :return: The lock for the fd's file, or None if positional I/O
+        doesn't need one
+        """
+        # Lock-free fast path for the common non-O_APPEND case
+        if file_descriptor not in self._fd_files:
+            return None
+
+        with self._guard:
+            file_key = self._fd_files.get(file_descriptor)
+            if file_key is None:
+                return None
+            return self._file_locks[file_key][0]
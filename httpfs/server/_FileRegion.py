@@ -0,0 +1,129 @@
+import os
+import select
+import ssl
+import threading
+
+
+class _FileRegion:
+    """
+    A range of an open file sent as a response payload straight from the
+    file, without reading it into a bytes object first
+
+    The region holds a duplicate of the file descriptor, so it stays valid
+    if the client releases the file while the response is being sent.
+    """
+    # Size of the per-thread buffer used where sendfile can't be, like TLS
+    _BUFFER_SIZE = 1024 * 1024
+
+    _local = threading.local()
+
+    def __init__(self, file_descriptor, offset, size):
+        """
+        :param file_descriptor: The open file
+        :param offset: Offset of the region in the file
+        :param size: Size of the region, which must not extend past the end
+        of the file
+        """
+        self._fd = os.dup(file_descriptor)
+        self._offset = offset
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=None):
+        """
+        :param size: Max number of bytes to read from the start of the
+        region, None to read all of it
+        :return: The region's bytes, fewer than len() if the file has been
+        truncated since
+        """
+        chunks = []
+        offset = self._offset
+        end = self._offset + self._size
+        if size is not None:
+            end = min(end, self._offset + size)
+        while offset < end:
+            chunk = os.pread(self._fd, end - offset, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return b"".join(chunks)
+
+    def iter_chunks(self, chunk_size=_BUFFER_SIZE):
+        """
+        Reads the region chunk by chunk, for connections sendfile can't be
+        used on
+        :param chunk_size: Max size of a chunk
+        :return: Iterator over the region's bytes, which ends early if the
+        file has been truncated since
+        """
+        offset = self._offset
+        end = self._offset + self._size
+        while offset < end:
+            chunk = os.pread(self._fd, min(chunk_size, end - offset), offset)
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
+
+    def dup(self):
+        """
+        :return: A _FileRegion of the same range with a descriptor of its
+        own, to send it after this one is closed
+        """
+        return _FileRegion(self._fd, self._offset, self._size)
+
+    def send(self, sock):
+        """
+        Sends the region on a socket, with sendfile unless it's a TLS socket
+        :param sock: The connected socket
+        :return: The number of bytes sent, fewer than len() if the file has
+        been truncated since
+        """
+        if isinstance(sock, ssl.SSLSocket):
+            return self._send_buffered(sock)
+        return self._sendfile(sock)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _sendfile(self, sock):
+        offset = self._offset
+        end = self._offset + self._size
+        while offset < end:
+            try:
+                sent = os.sendfile(sock.fileno(), self._fd, offset, end - offset)
+            except BlockingIOError:
+                # Sockets with a timeout are non-blocking underneath
+                select.select([], [sock], [])
+                continue
+            if sent == 0:
+                break
+            offset += sent
+        return offset - self._offset
+
+    def _send_buffered(self, sock):
+        """
+        Reads the region into this thread's buffer chunk by chunk, so the
+        only copies are the ones TLS needs to encrypt it
+        """
+        buffer = getattr(_FileRegion._local, "buffer", None)
+        if buffer is None:
+            buffer = _FileRegion._local.buffer = memoryview(
+                bytearray(_FileRegion._BUFFER_SIZE)
+            )
+
+        offset = self._offset
+        end = self._offset + self._size
+        while offset < end:
+            chunk = buffer[:min(len(buffer), end - offset)]
+            read_size = os.preadv(self._fd, [chunk], offset)
+            if read_size == 0:
+                break
+            sock.sendall(chunk[:read_size])
+            offset += read_size
+        return offset - self._offset
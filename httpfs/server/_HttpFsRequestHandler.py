@@ -1,13 +1,23 @@
 import base64
+import email.utils
 import errno
 import http
+import http.client
+import itertools
+import json
 import logging
 import os
+import re
 import stat
 import time
+import urllib.parse
 
-from httpfs.common import HttpFsRequest, HttpFsResponse
+from httpfs.common import HttpFsRequest, HttpFsResponse, HttpFsMuxFrame, HttpFsEvent
+from ._FileRegion import _FileRegion
+from ._InvalidationLog import _InvalidationLog
 from ._JSONRequestHandler import _JSONRequestHandler
+from ._ServerMetrics import _ServerMetrics
+from ._WorkerGroup import _WorkerGroup
 
 
 class _HttpFsRequestHandler(_JSONRequestHandler):
@@ -35,6 +45,28 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         'st_uid'
     ]
 
+    _BYTES_TYPES = (bytes, bytearray, memoryview)
+
+    # Reads at least this large are sent straight from the file
+    MIN_FILE_REGION_SIZE = 64 * 1024
+
+    frame_payload_types = (_FileRegion,)
+
+    # Upper bound on the entries sent in one page of a directory listing
+    MAX_READDIR_PAGE_SIZE = 4096
+
+    # Request args holding handles that only exist in the worker process
+    # that returned them
+    _HANDLE_ARGS = ("file_descriptor", "cursor")
+
+    # URL prefix of the GET endpoint for file contents
+    FILES_URL_PREFIX = "/files/"
+
+    # URL path of the GET endpoint for Prometheus metrics
+    METRICS_URL_PATH = "/metrics"
+
+    _RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
     server_version = "HttpFs/0.1"
     sys_version = ""
 
@@ -47,27 +79,444 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         client_path = client_path.lstrip("/")
         return os.path.join(self.server.get_fs_root(), client_path)
 
-    def get_fs_lock(self):
-        return self.server.get_fs_lock()
+    def get_file_locks(self):
+        return self.server.get_file_locks()
 
-    def on_valid_request(self, request_dict):
+    def get_file_handles(self):
+        return self.server.get_file_handles()
+
+    def get_dir_cursors(self):
+        return self.server.get_dir_cursors()
+
+    def get_permissions(self):
+        return self.server.get_permissions()
+
+    def get_metrics(self):
+        return self.server.get_metrics()
+
+    def check_access(self, path, uid, gid, mode):
         """
-        Called when a valid JSON request has been sent from a client
-        :param request_dict: JSON request converted to dict object
+        Checks the caller's access to a path, see _PermissionCache.check()
+        """
+        with self._timer.measure("auth"):
+            return self.get_permissions().check(path, uid, gid, mode)
+
+    def check_file_access(self, open_file, uid, gid, mode):
+        """
+        Checks the caller's access to an open file, see
+        _PermissionCache.check_file()
+        """
+        with self._timer.measure("auth"):
+            return self.get_permissions().check_file(open_file, uid, gid, mode)
+
+    def get_client_host(self):
+        """
+        :return: Address of the client, also for requests forwarded by
+        another worker
+        """
+        if self.client_address == _WorkerGroup.PEER_ADDRESS:
+            return self.headers.get(_WorkerGroup.FORWARDED_FOR_HEADER)
+        return self.client_address[0]
+
+    def get_client_id(self):
+        """
+        :return: Who owns the files the request opens: its API key when the
+        server requires one, its address otherwise
+        """
+        if self.server.get_cred_store() is not None:
+            return self.headers.get("Authorization")
+        return self.get_client_host()
+
+    def get_client_path(self, abs_path):
+        """
+        :param abs_path: A path under the server's root
+        :return: The path as clients see it
+        """
+        client_path = os.path.relpath(abs_path, self.server.get_fs_root())
+        return "/" if client_path == "." else "/" + client_path
+
+    def publish_changes(self, *changes):
+        """
+        Tells the clients polling GET /events about paths the request changed
+        :param changes: (absolute path, HttpFsEvent change type) pairs
+        """
+        # HttpFsClient prefixes the ids of its requests with its mount's id
+        origin = None
+        if self._request_id is not None:
+            origin = self._request_id.partition("-")[0]
+        self.server.publish_changes(
+            [(self.get_client_path(path), change) for path, change in changes], origin
+        )
+
+    def to_handle(self, local_id):
+        return self.server.get_worker_group().to_handle(local_id)
+
+    def from_handle(self, handle):
+        return self.server.get_worker_group().from_handle(handle)
+
+    def _use_file(self, httpfs_request_args):
+        """
+        :param httpfs_request_args: Args of a request on an open file
+        :return: Context manager giving the request's _OpenFile, see
+        _FileHandleTable.use()
+        :raise OSError: If the client has no such open file
+        """
+        return self.get_file_handles().use(
+            self.from_handle(httpfs_request_args["file_descriptor"]),
+            self.get_client_id()
+        )
+
+    def do_GET(self):
+        """
+        Called when a GET request comes in, which may ask for a file's
+        contents, the server's metrics, changes made by other clients or to
+        switch the connection to the multiplexed protocol
+        """
+        if self.path.startswith(_HttpFsRequestHandler.FILES_URL_PREFIX):
+            return self._serve_file(send_body=True)
+        url_path = urllib.parse.urlsplit(self.path).path
+        if url_path == _HttpFsRequestHandler.METRICS_URL_PATH:
+            return self._serve_metrics()
+        if url_path == HttpFsEvent.URL_PATH:
+            return self._serve_events()
+
+        upgrade = self.headers.get("Upgrade", "").lower()
+        if upgrade == HttpFsMuxFrame.UPGRADE_TOKEN:
+            executor = self.server.get_mux_executor()
+            if executor is not None:
+                return self._serve_mux(executor)
+        return super().do_GET()
+
+    def do_POST(self):
+        """
+        Called when a POST request comes in, which is an HttpFsRequest unless
+        another worker sends the changes made through it
+        """
+        if self.path == HttpFsEvent.URL_PATH and \
+                self.client_address == _WorkerGroup.PEER_ADDRESS:
+            return self._receive_peer_changes()
+        return super().do_POST()
+
+    def do_HEAD(self):
+        """
+        Called when a HEAD request comes in, only files have one
+        """
+        if self.path.startswith(_HttpFsRequestHandler.FILES_URL_PREFIX):
+            return self._serve_file(send_body=False)
+        return self._send_status(http.HTTPStatus.NOT_FOUND)
+
+    def _serve_file(self, send_body):
+        """
+        Serves GET /files/<path>, the contents of a file without opening it
+        first. Supports single byte ranges and conditional requests with
+        If-None-Match, If-Modified-Since and If-Range. Requests don't carry
+        a uid, so only world-readable files are served.
+        :param send_body: False for HEAD requests
+        """
+        if not self.is_authorized():
+            return self._send_status(http.HTTPStatus.UNAUTHORIZED)
+
+        url_path = urllib.parse.urlsplit(self.path).path
+        client_path = urllib.parse.unquote(
+            url_path[len(_HttpFsRequestHandler.FILES_URL_PREFIX):]
+        )
+
+        # Symlinks must not lead out of the served directory
+        fs_root = self.server.get_fs_root()
+        real_path = os.path.realpath(self.get_abs_path(client_path))
+        if os.path.commonpath([fs_root, real_path]) != fs_root:
+            return self._send_status(http.HTTPStatus.NOT_FOUND)
+
+        try:
+            file_descriptor = os.open(real_path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError as e:
+            if e.errno == errno.EACCES:
+                return self._send_status(http.HTTPStatus.FORBIDDEN)
+            return self._send_status(http.HTTPStatus.NOT_FOUND)
+
+        try:
+            file_stats = os.fstat(file_descriptor)
+            if not stat.S_ISREG(file_stats.st_mode):
+                return self._send_status(http.HTTPStatus.NOT_FOUND)
+            if not file_stats.st_mode & stat.S_IROTH:
+                return self._send_status(http.HTTPStatus.FORBIDDEN)
+
+            etag = '"{:x}-{:x}-{:x}"'.format(
+                file_stats.st_ino, file_stats.st_size, file_stats.st_mtime_ns
+            )
+            validators = {
+                "ETag": etag,
+                "Last-Modified": email.utils.formatdate(
+                    file_stats.st_mtime, usegmt=True
+                ),
+                "Accept-Ranges": "bytes",
+                # Caches may keep the file but must check it hasn't changed
+                "Cache-Control": "no-cache"
+            }
+
+            if self._is_not_modified(etag, file_stats.st_mtime):
+                return self._send_status(http.HTTPStatus.NOT_MODIFIED, validators)
+
+            file_size = file_stats.st_size
+            byte_range = self._get_byte_range(etag, file_size)
+            if byte_range is None:
+                status = http.HTTPStatus.OK
+                start, end = 0, file_size
+            elif byte_range is False:
+                return self._send_status(
+                    http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                    {"Content-Range": "bytes */{}".format(file_size)}
+                )
+            else:
+                status = http.HTTPStatus.PARTIAL_CONTENT
+                start, end = byte_range
+                validators["Content-Range"] = "bytes {}-{}/{}".format(
+                    start, end - 1, file_size
+                )
+
+            self.send_response(status)
+            for name, value in validators.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", end - start)
+            self.send_header("Connection", "keep-alive")
+            self.end_headers()
+
+            if send_body and end > start:
+                file_region = _FileRegion(file_descriptor, start, end - start)
+                try:
+                    self.write_payload(file_region)
+                finally:
+                    file_region.close()
+        finally:
+            os.close(file_descriptor)
+
+    def _serve_metrics(self):
+        """
+        Serves GET /metrics in the Prometheus text format. With several
+        workers, the worker that gets the scrape collects the metrics of the
+        others and labels each sample with its worker. Workers send each
+        other their snapshot as JSON.
+        """
+        if not self.is_authorized():
+            return self._send_status(http.HTTPStatus.UNAUTHORIZED)
+
+        snapshot = self.server.get_metrics_snapshot()
+        if self.client_address == _WorkerGroup.PEER_ADDRESS:
+            return self._send_body(
+                http.HTTPStatus.OK,
+                "application/json",
+                [json.dumps(snapshot).encode()]
+            )
+
+        worker_group = self.server.get_worker_group()
+        if worker_group.get_count() == 1:
+            snapshots = [((), snapshot)]
+        else:
+            snapshots = []
+            for index in range(worker_group.get_count()):
+                if index == worker_group.get_index():
+                    worker_snapshot = snapshot
+                else:
+                    worker_snapshot = self._get_worker_metrics(worker_group, index)
+                    if worker_snapshot is None:
+                        continue
+                snapshots.append(((("worker", str(index)),), worker_snapshot))
+
+        self._send_body(
+            http.HTTPStatus.OK,
+            _ServerMetrics.CONTENT_TYPE,
+            [_ServerMetrics.render(snapshots).encode()]
+        )
+
+    def _serve_events(self):
+        """
+        Serves GET /events, a long poll for the changes made through the
+        server since the last one the client saw, see _InvalidationLog. It
+        returns as soon as there are changes the client didn't make itself
+        under the path it watches, and without any after its timeout.
+        """
+        if not self.is_authorized():
+            return self._send_status(http.HTTPStatus.UNAUTHORIZED)
+
+        invalidation_log = self.server.get_invalidation_log()
+        query = _InvalidationLog.parse_query(urllib.parse.urlsplit(self.path).query)
+        wait_time = min(query.timeout, self.server.get_max_event_wait())
+        if wait_time > 0:
+            invalidation_log.wait(query, wait_time)
+
+        events, next_seq, reset = invalidation_log.get_events(query)
+        self._send_body(
+            http.HTTPStatus.OK,
+            "application/json",
+            [json.dumps({
+                "log": invalidation_log.get_log_id(),
+                "next": next_seq,
+                "reset": reset,
+                "events": [event.as_dict() for event in events]
+            }).encode()]
+        )
+
+    def _receive_peer_changes(self):
+        """
+        Publishes the changes made through another worker, see
+        _HttpFsServerMixin.publish_changes()
+        """
+        content_len = int(self.headers.get("Content-Length", 0))
+        batches = json.loads(self.rfile.read(content_len))
+        invalidation_log = self.server.get_invalidation_log()
+        for batch in batches:
+            invalidation_log.publish(
+                [tuple(change) for change in batch["changes"]], batch["origin"]
+            )
+        self._send_status(http.HTTPStatus.NO_CONTENT)
+
+    def _get_worker_metrics(self, worker_group, index):
+        """
+        :return: Another worker's metrics snapshot, or None if it can't be
+        reached
+        """
+        headers = dict()
+        if "Authorization" in self.headers:
+            headers["Authorization"] = self.headers["Authorization"]
+        try:
+            status, _, body = worker_group.forward(
+                index,
+                headers,
+                None,
+                self.get_client_host(),
+                method="GET",
+                path=_HttpFsRequestHandler.METRICS_URL_PATH
+            )
+        except (OSError, http.client.HTTPException) as e:
+            logging.warning("Can't get the metrics of worker %d: %s", index, e)
+            return None
+        if status != http.HTTPStatus.OK:
+            logging.warning("Can't get the metrics of worker %d: %d", index, status)
+            return None
+        return json.loads(body)
+
+    def _is_not_modified(self, etag, mtime):
+        """
+        :return: Whether the client's cached copy of the file is current
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            client_etags = [tag.strip() for tag in if_none_match.split(",")]
+            # Weak comparison, as the RFC asks for If-None-Match
+            return "*" in client_etags or etag in [
+                tag[2:] if tag.startswith("W/") else tag for tag in client_etags
+            ]
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+
+        return False
+
+    def _get_byte_range(self, etag, file_size):
+        """
+        :return: (start, end) of the requested range, None to send the
+        whole file, or False if the range can't be satisfied
+        """
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            return None
+
+        # A range of an older version of the file is useless to the client
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            return None
+
+        # Multiple ranges are allowed to be answered with the whole file
+        match = _HttpFsRequestHandler._RANGE_PATTERN.match(range_header.strip())
+        if match is None:
+            return None
+
+        first, last = match.groups()
+        if not first:
+            if not last:
+                return None
+            # The last bytes of the file
+            start = max(0, file_size - int(last))
+            end = file_size
+        else:
+            start = int(first)
+            end = file_size if not last else min(file_size, int(last) + 1)
+            if last and int(last) < start:
+                return None
+
+        if start >= file_size:
+            return False
+        return start, end
+
+    def _send_status(self, status, headers=None):
+        """
+        Sends a response without a body
+        :param status: The HTTP status
+        :param headers: Optional dict of headers to send
+        """
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        # A 304's Content-Length would be taken as the file's
+        if status != http.HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Length", 0)
+        self.send_header("Connection", "keep-alive")
+        self.end_headers()
+
+    def _serve_mux(self, executor):
+        """
+        Switches the connection to the multiplexed protocol and serves it
+        until the client closes it. Every request on it is authorized on
+        its own, like requests on a plain keep-alive connection.
+        :param executor: Executor to run the connection's requests on
+        """
+        # Imported here because it's built on this module
+        from ._MuxConnection import _MuxConnection
+
+        logging.debug("Multiplexing connection from %s", self.client_address[0])
+        self.send_response(http.HTTPStatus.SWITCHING_PROTOCOLS)
+        self.send_header("Upgrade", HttpFsMuxFrame.UPGRADE_TOKEN)
+        self.send_header("Connection", "Upgrade")
+        self.end_headers()
+        self.wfile.flush()
+
+        _MuxConnection(
+            self.connection, self.rfile, self.client_address, self.server, executor
+        ).serve()
+        self.close_connection = True
+
+    def is_authorized(self):
+        """
+        :return: Whether the request has a valid API key, or the server
+        doesn't require one
         """
         cred_store = self.server.get_cred_store()
         auth_enabled = cred_store is not None
         has_auth_header = auth_enabled and "Authorization" in self.headers
-        is_authorized = not auth_enabled or (
+        return not auth_enabled or (
             has_auth_header and cred_store.has_cred(
                 self.headers["Authorization"]
             )
         )
 
+    def on_valid_request(self, request_dict):
+        """
+        Called when a valid JSON request has been sent from a client
+        :param request_dict: JSON request converted to dict object
+        """
+        is_authorized = self.is_authorized()
+
         if "User-Agent" not in self.headers or not self.headers["User-Agent"].startswith("HttpFsClient"):
             raise RuntimeError(
                 "Invalid User-Agent header: Client is not an HttpFsClient"
             )
+        self._timer.lap("auth")
         if not is_authorized:
             logging.error("{} is not authorized".format(self.client_address[0]))
             response = HttpFsResponse(errno.EACCES, {"message": "Invalid API key"})
@@ -77,119 +526,238 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         else:
             try:
                 request = HttpFsRequest.from_dict(request_dict)
+                self._request_id = request.get_request_id()
+                self._send_server_timing = request.is_timing_requested()
                 self._delegate_request(request)
             except Exception as e:
                 response = HttpFsResponse(errno.EIO, {"message": str(e)})
                 self.send_json_response(
                     http.HTTPStatus.BAD_REQUEST, response.as_dict())
 
+    @classmethod
+    def register_op(cls, op_type, op_name, handler):
+        """
+        Registers the handler for a request type, replacing any existing one
+        Handlers are called as handler(request_handler, httpfs_request_args)
+        and return the HttpFsResponse to send back to the client
+        :param op_type: The HttpFsRequest type
+        :param op_name: Short name used in logs
+        :param handler: The handler function
+        """
+        # Registering on a subclass must not change the parent's table
+        if "_op_handlers" not in cls.__dict__:
+            cls._op_handlers = dict(cls._op_handlers)
+        cls._op_handlers[op_type] = (op_name, handler)
+
     def _delegate_request(self, httpFsRequest):
         """
         Delegates the given request to the correct handler method
         :param httpfs_request_args: HttpFsRequest object
         """
-        client = self.client_address[0]
-
-        if httpFsRequest.get_type() == HttpFsRequest.OP_ACCESS:
-            logging.debug("Received access request from {}".format(client))
-            return self.on_access(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_CREATE:
-            logging.debug("Received create request from {}".format(client))
-            return self.on_create(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_CHMOD:
-            logging.debug("Received chmod request from {}".format(client))
-            return self.on_chmod(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_CHOWN:
-            logging.debug("Received chown request from {}".format(client))
-            return self.on_chown(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_FLUSH:
-            logging.debug("Received flush request from {}".format(client))
-            return self.on_flush(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_FSYNC:
-            logging.debug("Received fsync request from {}".format(client))
-            return self.on_fsync(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_GET_ATTR:
-            logging.debug("Received getattr request from {}".format(client))
-            return self.on_getattr(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_LINK:
-            logging.debug("Received link request from {}".format(client))
-            return self.on_link(httpFsRequest.get_args())
+        op_handler = self._op_handlers.get(httpFsRequest.get_type())
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_MKDIR:
-            logging.debug("Received mkdir request from {}".format(client))
-            return self.on_mkdir(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_MKNOD:
-            logging.debug("Received mknod request from {}".format(client))
-            return self.on_mknod(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_OPEN:
-            logging.debug("Received open request from {}".format(client))
-            return self.on_open(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_READ:
-            logging.debug("Received read request from {}".format(client))
-            return self.on_read(httpFsRequest.get_args())
-
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_READDIR:
-            logging.debug("Received readdir request from {}".format(client))
-            return self.on_readdir(httpFsRequest.get_args())
+        if op_handler is None:
+            logging.warning(
+                "Recieved unknown request from %s", self.client_address[0]
+            )
+            response_obj = HttpFsResponse(
+                errno.EIO, {"message": "Method not implemented"})
+            return self.send_json_response(
+                http.HTTPStatus.BAD_REQUEST,
+                response_obj.as_dict()
+            )
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_READLINK:
-            logging.debug("Received readlink request from {}".format(client))
-            return self.on_readlink(httpFsRequest.get_args())
+        op_name, handler = op_handler
+        logging.debug(
+            "Received %s request from %s", op_name, self.client_address[0]
+        )
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_RELEASE:
-            logging.debug("Received release request from {}".format(client))
-            return self.on_release(httpFsRequest.get_args())
+        # Requests for another worker's file descriptors or directory
+        # cursors must run there
+        owner = self._get_remote_owner(httpFsRequest)
+        if owner is not None:
+            return self._forward_to_worker(owner)
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_RENAME:
-            logging.debug("Received rename request from {}".format(client))
-            return self.on_rename(httpFsRequest.get_args())
+        metrics = self.get_metrics()
+        metrics.add("httpfs_requests_started")
+        error_no = errno.EIO
+        self._timer.lap("dispatch")
+        try:
+            response_obj = handler(self, httpFsRequest.get_args())
+            # Besides the permission checks, which are auth
+            self._timer.lap("syscall")
+            error_no = response_obj.get_error_no()
+            return self.send_httpfs_response(response_obj)
+        finally:
+            elapsed = self._timer.get_elapsed()
+            labels = (("op", op_name),)
+            metrics.add("httpfs_requests_finished")
+            metrics.add("httpfs_requests_total", labels=labels)
+            if error_no != HttpFsResponse.ERR_NONE:
+                metrics.add("httpfs_request_errors_total", labels=labels + (
+                    ("errno", errno.errorcode.get(error_no, str(error_no))),
+                ))
+            metrics.observe("httpfs_request_duration_seconds", elapsed, labels)
+
+            slow_request_time = self.server.get_slow_request_time()
+            if slow_request_time is not None and elapsed >= slow_request_time:
+                logging.warning(
+                    "Slow %s request %s from %s took %.1fms: %s",
+                    op_name,
+                    self._request_id or "-",
+                    self.get_client_host(),
+                    elapsed * 1000,
+                    self._timer.get_server_timing()
+                )
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_RM_DIR:
-            logging.debug("Received rmdir request from {}".format(client))
-            return self.on_rmdir(httpFsRequest.get_args())
+    def _get_remote_owner(self, httpFsRequest):
+        """
+        :param httpFsRequest: HttpFsRequest object
+        :return: Index of the worker owning a handle the request uses, or
+        None if every handle it uses belongs to this worker
+        """
+        worker_group = self.server.get_worker_group()
+        if worker_group.get_count() == 1:
+            return None
+
+        if httpFsRequest.get_type() == HttpFsRequest.OP_COMPOUND:
+            all_args = [
+                sub_request.get("args", {})
+                for sub_request in httpFsRequest.get_args().get("requests", [])
+                if isinstance(sub_request, dict)
+            ]
+        else:
+            all_args = [httpFsRequest.get_args()]
+
+        for args in all_args:
+            for handle_arg in _HttpFsRequestHandler._HANDLE_ARGS:
+                handle = args.get(handle_arg)
+                if isinstance(handle, int):
+                    owner = worker_group.get_handle_owner(handle)
+                    if owner != worker_group.get_index():
+                        return owner
+        return None
+
+    def _forward_to_worker(self, worker_index):
+        """
+        Runs the current request in another worker process and relays its
+        response to the client
+        :param worker_index: The worker to forward the request to
+        """
+        logging.debug(
+            "Forwarding request from %s to worker %d",
+            self.client_address[0],
+            worker_index
+        )
+        status, headers, body = self.server.get_worker_group().forward(
+            worker_index, self.headers, self._request_body, self.get_client_host()
+        )
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_STAT_FS:
-            logging.debug("Received statfs request from {}".format(client))
-            return self.on_statfs(httpFsRequest.get_args())
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() not in ("server", "date", "connection"):
+                self.send_header(name, value)
+        self.send_header("Connection", "keep-alive")
+        self.end_headers()
+        self.wfile.write(body)
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_SYMLINK:
-            logging.debug("Received symlink request from {}".format(client))
-            return self.on_symlink(httpFsRequest.get_args())
+    def send_httpfs_response(self, response_obj):
+        """
+        Sends the response to a request, as a binary frame if it carries
+        bytes and the client accepts frames and as JSON otherwise
+        :param response_obj: The HttpFsResponse returned by a handler
+        """
+        response_data = response_obj.get_data()
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_TRUNCATE:
-            logging.debug("Received truncate request from {}".format(client))
-            return self.on_truncate(httpFsRequest.get_args())
+        if not self._has_bytes(response_data):
+            return self.send_json_response(
+                http.HTTPStatus.OK, response_obj.as_dict()
+            )
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_UNLINK:
-            logging.debug("Received unlink request from {}".format(client))
-            return self.on_unlink(httpFsRequest.get_args())
+        try:
+            if self.accepts_frames():
+                return self.send_frame_response(
+                    http.HTTPStatus.OK, response_obj.as_dict()
+                )
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_UTIMENS:
-            logging.debug("Received unlink request from {}".format(client))
-            return self.on_utimens(httpFsRequest.get_args())
+            # JSON clients get bytes as base64 strings
+            return self.send_json_response(
+                http.HTTPStatus.OK,
+                HttpFsResponse(
+                    response_obj.get_error_no(), self._encode_bytes(response_data)
+                ).as_dict()
+            )
+        finally:
+            self._close_file_regions(response_data)
 
-        elif httpFsRequest.get_type() == HttpFsRequest.OP_WRITE:
-            logging.debug("Received write request from {}".format(client))
-            return self.on_write(httpFsRequest.get_args())
+    def write_payload(self, chunk):
+        # _FileRegion payloads are sent straight from the file
+        if isinstance(chunk, _FileRegion):
+            return self.check_region_sent(chunk, chunk.send(self.connection))
+        return super().write_payload(chunk)
 
-        else:
-            logging.warning("Recieved unknown request from {}".format(client))
-            response_obj = HttpFsResponse(
-                errno.EIO, {"message": "Method not implemented"})
-            return self.send_json_response(
-                http.HTTPStatus.BAD_REQUEST,
-                response_obj.as_dict()
+    def check_region_sent(self, file_region, sent_size):
+        """
+        Closes the connection after a response whose _FileRegion payload
+        came up short because the file was truncated while it was sent. The
+        response is shorter than its Content-Length, so the client can't
+        read past it.
+        :param file_region: The sent _FileRegion
+        :param sent_size: Number of bytes of it that were sent
+        """
+        if sent_size < len(file_region):
+            logging.error(
+                "File shrank while being sent to %s, closing the connection",
+                self.client_address[0]
             )
+            self.close_connection = True
+
+    @staticmethod
+    def _has_bytes(value):
+        """
+        :param value: Response data, or a value in it
+        :return: Whether value holds a bytes-like value at any depth
+        """
+        if isinstance(value, _HttpFsRequestHandler._BYTES_TYPES + (_FileRegion,)):
+            return True
+        if isinstance(value, dict):
+            return any(_HttpFsRequestHandler._has_bytes(v) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return any(_HttpFsRequestHandler._has_bytes(v) for v in value)
+        return False
+
+    @staticmethod
+    def _encode_bytes(value):
+        """
+        :param value: Response data, or a value in it
+        :return: A copy of value with bytes-like values as base64 strings
+        """
+        if isinstance(value, _FileRegion):
+            value = value.read()
+        if isinstance(value, _HttpFsRequestHandler._BYTES_TYPES):
+            return base64.standard_b64encode(value).decode("utf-8")
+        if isinstance(value, dict):
+            return {
+                k: _HttpFsRequestHandler._encode_bytes(v) for k, v in value.items()
+            }
+        if isinstance(value, (list, tuple)):
+            return [_HttpFsRequestHandler._encode_bytes(v) for v in value]
+        return value
+
+    @staticmethod
+    def _close_file_regions(value):
+        """
+        Closes the _FileRegions in response data once it's been sent
+        :param value: Response data, or a value in it
+        """
+        if isinstance(value, _FileRegion):
+            value.close()
+        elif isinstance(value, dict):
+            for v in value.values():
+                _HttpFsRequestHandler._close_file_regions(v)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                _HttpFsRequestHandler._close_file_regions(v)
 
     def on_invalid_request(self, err_msg):
         """
@@ -220,60 +788,100 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         mode = httpfs_request_args["mode"]
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
-        file_stats = os.stat(path)
-
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
-        read_requested = bool(mode & os.R_OK)
-        write_requested = bool(mode & os.W_OK)
-        execute_requested = bool(mode & os.X_OK)
-        exists_requested = mode == os.F_OK
-
-        access_ok = True
-
-        # Exists requested
-        if exists_requested:
-            access_ok = os.path.exists(path)
-
-        # Owner access
-        if is_owner:
-            owner_readable = bool(file_stats.st_mode & stat.S_IRUSR)
-            owner_writeable = bool(file_stats.st_mode & stat.S_IWUSR)
-            owner_executable = bool(file_stats.st_mode & stat.S_IXUSR)
-            if read_requested:
-                access_ok = access_ok and owner_readable
-            if write_requested:
-                access_ok = access_ok and owner_writeable
-            if execute_requested:
-                access_ok = access_ok and owner_executable
-        # Group access
-        elif is_group:
-            group_readable = bool(file_stats.st_mode & stat.S_IRGRP)
-            group_writeable = bool(file_stats.st_mode & stat.S_IWGRP)
-            group_executable = bool(file_stats.st_mode & stat.S_IXGRP)
-            if read_requested:
-                access_ok = access_ok and group_readable
-            if write_requested:
-                access_ok = access_ok and group_writeable
-            if execute_requested:
-                access_ok = access_ok and group_executable
-        # World access
-        else:
-            world_readable = bool(file_stats.st_mode & stat.S_IROTH)
-            world_writeable = bool(file_stats.st_mode & stat.S_IWOTH)
-            world_executable = bool(file_stats.st_mode & stat.S_IXGRP)
-            if read_requested:
-                access_ok = access_ok and world_readable
-            if write_requested:
-                access_ok = access_ok and world_writeable
-            if execute_requested:
-                access_ok = access_ok and world_executable
+        try:
+            access_ok = self.check_access(path, uid, gid, mode)
+        except FileNotFoundError:
+            access_ok = False
 
         if not access_ok:
             logging.warning("Error during access request: Access denied")
             response_obj.set_err_no(errno.EACCES)
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
+
+    def on_compound(self, httpfs_request_args):
+        """
+        Called when HttpFsRequest.OP_COMPOUND is requested
+        Runs a list of requests in order and returns the list of their
+        responses. An arg of the form HttpFsRequest.ref(step, key) is replaced
+        with response_data[key] of the earlier step. With stop_on_error
+        (the default) the steps after a failed step aren't run and get an
+        ECANCELED response; otherwise every step runs, and steps referring to
+        a failed step get ECANCELED. Releases always run, so the handles
+        opened by earlier steps don't leak.
+        :param httpfs_request_args: The client request args dict
+        """
+        stop_on_error = httpfs_request_args.get("stop_on_error", True)
+        worker_group = self.server.get_worker_group()
+
+        responses = []
+        has_failed = False
+        for sub_request in httpfs_request_args["requests"]:
+            is_release = sub_request.get("type") == HttpFsRequest.OP_RELEASE
+            if has_failed and stop_on_error and not is_release:
+                responses.append(HttpFsResponse(
+                    errno.ECANCELED,
+                    {"message": "Skipped after an earlier error"}
+                ))
+                continue
+
+            try:
+                response_obj = self._run_compound_step(
+                    sub_request, responses, worker_group
+                )
+            except Exception as e:
+                logging.error("Error during compound request step: {}".format(e))
+                response_obj = HttpFsResponse(errno.EIO, {"message": str(e)})
+
+            has_failed = has_failed or response_obj.is_error()
+            responses.append(response_obj)
+
+        response_obj = HttpFsResponse()
+        response_obj.set_data({
+            "responses": [r.as_dict() for r in responses]
+        })
+        return response_obj
+
+    def _run_compound_step(self, sub_request, responses, worker_group):
+        """
+        Runs one request of an OP_COMPOUND request
+        :param sub_request: The request dict
+        :param responses: The responses of the earlier steps
+        :param worker_group: This server's _WorkerGroup
+        :return: The step's HttpFsResponse
+        """
+        request = HttpFsRequest.from_dict(sub_request)
+        op_handler = self._op_handlers.get(request.get_type())
+        if op_handler is None or request.get_type() == HttpFsRequest.OP_COMPOUND:
+            return HttpFsResponse(errno.ENOSYS, {"message": "Method not implemented"})
+
+        args = dict()
+        for key, value in request.get_args().items():
+            if isinstance(value, dict) and HttpFsRequest.REF_KEY in value:
+                step, result_key = value[HttpFsRequest.REF_KEY]
+                if not 0 <= step < len(responses) or responses[step].is_error():
+                    return HttpFsResponse(
+                        errno.ECANCELED,
+                        {"message": "Referenced step {} failed".format(step)}
+                    )
+                value = responses[step].get_data()[result_key]
+            args[key] = value
+
+        # Handles must all come from this worker, see _get_remote_owner
+        for handle_arg in _HttpFsRequestHandler._HANDLE_ARGS:
+            handle = args.get(handle_arg)
+            is_local = not isinstance(handle, int) or (
+                worker_group.get_handle_owner(handle) == worker_group.get_index()
+            )
+            if not is_local:
+                return HttpFsResponse(
+                    errno.EXDEV,
+                    {"message": "Handles of a compound request are on several workers"}
+                )
+
+        op_name, handler = op_handler
+        logging.debug("Running compound step %s", op_name)
+        return handler(self, args)
 
     def on_create(self, httpfs_request_args):
         """
@@ -285,28 +893,31 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        dir_stats = os.stat(os.path.dirname(path))
-        is_dir_owner = dir_stats.st_uid == uid
-        is_dir_group = dir_stats.st_gid == gid
-
-        if uid == 0:
-            access_ok = True
-        elif is_dir_owner:
-            access_ok = dir_stats.st_mode & stat.S_IWUSR
-        elif is_dir_group:
-            access_ok = dir_stats.st_mode & stat.S_IWGRP
-        else:
-            access_ok = dir_stats.st_mode & stat.S_IWOTH
+        permissions = self.get_permissions()
+        access_ok = self.check_access(os.path.dirname(path), uid, gid, os.W_OK)
 
         try:
             if access_ok:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_ASYNC | os.O_NOATIME
                 fd = os.open(
                     path,
-                    flags=os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_ASYNC | os.O_NOATIME,
+                    flags=flags,
                     mode=httpfs_request_args["mode"]
                 )
                 os.chown(path, uid, gid)
-                response_obj.set_data({"file_descriptor": fd})
+                permissions.invalidate(path)
+                self.publish_changes((path, HttpFsEvent.ENTRY))
+                # The creator may write whatever mode the file was given
+                handle_id = self.get_file_handles().add(
+                    fd,
+                    path,
+                    flags,
+                    self.get_client_id(),
+                    uid,
+                    gid,
+                    permissions.get_open_mode(flags)
+                )
+                response_obj.set_data({"file_descriptor": self.to_handle(handle_id)})
             else:
                 logging.warning("Error during create request: Access denied")
                 response_obj.set_err_no(errno.EACCES)
@@ -317,7 +928,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_chmod(self, httpfs_request_args):
         """
@@ -330,18 +941,8 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        file_stats = os.stat(path)
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
-
-        if uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IWUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IWGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IWOTH
+        permissions = self.get_permissions()
+        access_ok = self.check_access(path, uid, gid, os.W_OK)
 
         try:
             if access_ok:
@@ -349,6 +950,8 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
                     path,
                     httpfs_request_args["mode"]
                 )
+                permissions.invalidate(path)
+                self.publish_changes((path, HttpFsEvent.ATTR))
                 logging.debug("Successful chmod for {}".format(client))
             else:
                 logging.warning("Error during chmod request: Access denied")
@@ -359,7 +962,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_chown(self, httpfs_request_args):
         """
@@ -374,23 +977,15 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         caller_uid = httpfs_request_args["caller_uid"]
         caller_gid = httpfs_request_args["caller_gid"]
 
-        file_stats = os.stat(path)
-        is_owner = file_stats.st_uid == caller_uid
-        is_group = file_stats.st_gid == caller_gid
-
-        if caller_uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IWUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IWGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IWOTH
+        permissions = self.get_permissions()
+        access_ok = self.check_access(path, caller_uid, caller_gid, os.W_OK)
 
         # TODO: Don't let me if it isn't mine
         try:
             if access_ok:
                 os.chown(path, uid, gid)
+                permissions.invalidate(path)
+                self.publish_changes((path, HttpFsEvent.ATTR))
                 logging.debug("Successful chown for {}".format(client))
             else:
                 response_obj.set_err_no(errno.EACCES)
@@ -401,7 +996,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_flush(self, httpfs_request_args):
         """
@@ -411,13 +1006,14 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         response_obj = HttpFsResponse()
 
         try:
-            os.fsync(httpfs_request_args["file_descriptor"])
+            with self._use_file(httpfs_request_args) as open_file:
+                os.fsync(open_file.fd)
         except Exception as e:
             logging.error("Error during flush request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_fsync(self, httpfs_request_args):
         """
@@ -427,16 +1023,17 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         response_obj = HttpFsResponse()
 
         try:
-            if httpfs_request_args["datasync"]:
-                os.fdatasync(httpfs_request_args["file_descriptor"])
-            else:
-                os.fsync(httpfs_request_args["file_descriptor"])
+            with self._use_file(httpfs_request_args) as open_file:
+                if httpfs_request_args["datasync"]:
+                    os.fdatasync(open_file.fd)
+                else:
+                    os.fsync(open_file.fd)
         except Exception as e:
             logging.error("Error during fsync request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_getattr(self, httpfs_request_args):
         """
@@ -459,7 +1056,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             logging.warning("{} not found".format(path))
             response_obj.set_err_no(errno.ENOENT)
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_link(self, httpfs_request_args):
         """
@@ -473,12 +1070,17 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
 
         try:
             os.link(source_path, target_path)
+            self.get_permissions().invalidate(target_path)
+            # The link count of the file changes too
+            self.publish_changes(
+                (target_path, HttpFsEvent.ENTRY), (source_path, HttpFsEvent.ATTR)
+            )
         except Exception as e:
             logging.error("Error during link request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_mkdir(self, httpfs_request_args):
         """
@@ -490,12 +1092,14 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
 
         try:
             os.mkdir(path, mode=httpfs_request_args["mode"])
+            self.get_permissions().invalidate(path)
+            self.publish_changes((path, HttpFsEvent.ENTRY))
         except Exception as e:
             logging.error("Error during mkdir request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_mknod(self, httpfs_request_args):
         """
@@ -508,12 +1112,14 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         try:
             os.mknod(
                 path, mode=httpfs_request_args["mode"], device=httpfs_request_args["dev"])
+            self.get_permissions().invalidate(path)
+            self.publish_changes((path, HttpFsEvent.ENTRY))
         except Exception as e:
             logging.error("Error during mknod request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_open(self, httpfs_request_args):
         """
@@ -529,60 +1135,29 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        dir_stats = os.stat(os.path.dirname(path))
-        is_dir_owner = dir_stats.st_uid == uid
-        is_dir_group = dir_stats.st_gid == gid
-
-        if uid == 0:
-            access_ok = True
-        elif is_dir_owner:
-            access_ok = dir_stats.st_mode & stat.S_IXUSR
-        elif is_dir_group:
-            access_ok = dir_stats.st_mode & stat.S_IXGRP
-        else:
-            access_ok = dir_stats.st_mode & stat.S_IXOTH
-
-        if access_ok and os.path.exists(path):
-            file_stats = os.stat(path)
-            is_owner = file_stats.st_uid == uid
-            is_group = file_stats.st_gid == gid
-
-            read_requested = (
-                flags & os.O_RDONLY or
-                flags & os.O_RDWR or
-                flags & os.O_EXCL
-            )
-            write_requested = (
-                flags & os.O_WRONLY or
-                flags & os.O_RDWR or
-                flags & os.O_APPEND
-            )
+        permissions = self.get_permissions()
+        open_mode = permissions.get_open_mode(flags)
 
-            if uid == 0:
-                access_ok = True
-            elif is_owner:
-                if read_requested:
-                    access_ok = file_stats.st_mode & stat.S_IRUSR
-                elif write_requested:
-                    access_ok = file_stats.st_mode & stat.S_IWUSR
-            elif is_group:
-                if read_requested:
-                    access_ok = file_stats.st_mode & stat.S_IRGRP
-                elif write_requested:
-                    access_ok = file_stats.st_mode & stat.S_IWGRP
-            else:
-                if read_requested:
-                    access_ok = file_stats.st_mode & stat.S_IROTH
-                elif write_requested:
-                    access_ok = file_stats.st_mode & stat.S_IROTH
+        access_ok = self.check_access(os.path.dirname(path), uid, gid, os.X_OK)
+        if access_ok:
+            try:
+                access_ok = self.check_access(path, uid, gid, open_mode)
+            except FileNotFoundError:
+                # Left to os.open(), which may create it
+                pass
 
         try:
             if access_ok:
-                fd = os.open(
-                    self.get_abs_path(httpfs_request_args["path"]),
-                    flags
+                fd = os.open(path, flags)
+                if flags & os.O_CREAT:
+                    permissions.invalidate(path)
+                    self.publish_changes((path, HttpFsEvent.ENTRY))
+                elif flags & os.O_TRUNC:
+                    self.publish_changes((path, HttpFsEvent.DATA))
+                handle_id = self.get_file_handles().add(
+                    fd, path, flags, self.get_client_id(), uid, gid, open_mode
                 )
-                response_obj.set_data({"file_descriptor": fd})
+                response_obj.set_data({"file_descriptor": self.to_handle(handle_id)})
             else:
                 response_obj.set_err_no(errno.EACCES)
                 response_obj.set_data({"message": "Access denied"})
@@ -593,7 +1168,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_read(self, httpfs_request_args):
         """
@@ -601,80 +1176,155 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         :param httpfs_request_args: The client request arg dict
         """
         response_obj = HttpFsResponse()
-        file_descriptor = httpfs_request_args["file_descriptor"]
         offset = httpfs_request_args["offset"]
         size = httpfs_request_args["size"]
 
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        file_stats = os.stat(file_descriptor)
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
-
-        if uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IRUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IRGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IROTH
-
         try:
-            if access_ok:
-                with self.server.get_fs_lock():
-                    os.lseek(file_descriptor, offset, os.SEEK_SET)
-                    bytes_read = os.read(file_descriptor, size)
-                response_obj.set_data({
-                    "bytes_read": base64.standard_b64encode(bytes_read).decode("utf-8")
-                })
-            else:
-                logging.warning("Error during read request: Access denied")
-                response_obj.set_err_no(errno.EACCES)
-                response_obj.set_data({"message": "Access denied"})
+            with self._use_file(httpfs_request_args) as open_file:
+                access_ok = self.check_file_access(
+                    open_file, uid, gid, os.R_OK
+                )
+                if access_ok:
+                    file_descriptor = open_file.fd
+                    # Only reads large enough to be sent from the file need
+                    # its size
+                    use_region = False
+                    if size >= _HttpFsRequestHandler.MIN_FILE_REGION_SIZE:
+                        file_stats = os.fstat(file_descriptor)
+                        region_size = max(0, min(size, file_stats.st_size - offset))
+                        use_region = stat.S_ISREG(file_stats.st_mode) and (
+                            region_size >= _HttpFsRequestHandler.MIN_FILE_REGION_SIZE
+                        )
+                    if use_region:
+                        bytes_read = _FileRegion(file_descriptor, offset, region_size)
+                    else:
+                        bytes_read = os.pread(file_descriptor, size, offset)
+                    self.get_metrics().add("httpfs_read_bytes_total", len(bytes_read))
+                    response_obj.set_data({"bytes_read": bytes_read})
+                else:
+                    logging.warning("Error during read request: Access denied")
+                    response_obj.set_err_no(errno.EACCES)
+                    response_obj.set_data({"message": "Access denied"})
 
         except Exception as e:
             logging.error("Error during read request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_readdir(self, httpfs_request_args):
         """
         Called when HttpFsRequest.OP_READDIR is requested
         :param httpfs_request_args: The client request args dict
         """
-        path = self.get_abs_path(httpfs_request_args["path"])
-        uid = httpfs_request_args["uid"]
-        gid = httpfs_request_args["gid"]
+        return self._list_dir(httpfs_request_args, with_attrs=False)
 
-        file_stats = os.stat(path)
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
+    def on_readdir_plus(self, httpfs_request_args):
+        """
+        Called when HttpFsRequest.OP_READDIR_PLUS is requested
+        Same as readdir, with each entry's getattr result included so
+        listing a directory doesn't cost a getattr request per entry
+        :param httpfs_request_args: The client request args dict
+        """
+        return self._list_dir(httpfs_request_args, with_attrs=True)
+
+    def _list_dir(self, httpfs_request_args, with_attrs):
+        """
+        Lists a directory for readdir and readdir_plus
+        Listings are paginated when the client sends a page_size: each page
+        holds at most page_size entries plus a cursor to send back for the next
+        page, which is None after the last page. Only the same client and uid
+        can continue a listing.
+        :param httpfs_request_args: The client request args dict
+        :param with_attrs: Whether to include the entries' attributes
+        """
+        page_size = httpfs_request_args.get("page_size")
+        cursor = httpfs_request_args.get("cursor")
 
         response_obj = HttpFsResponse()
 
-        if uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IRUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IRGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IROTH
+        if page_size is not None:
+            if not isinstance(page_size, int) or page_size < 1:
+                response_obj.set_err_no(errno.EINVAL)
+                response_obj.set_data({"message": "Invalid page size"})
+                return response_obj
+            page_size = min(page_size, _HttpFsRequestHandler.MAX_READDIR_PAGE_SIZE)
 
-        if access_ok:
-            dir_listing = os.listdir(path)
-            dir_listing = [".", ".."] + dir_listing
-            response_obj.set_data({"dir_listing": dir_listing})
+        if cursor is None:
+            path = self.get_abs_path(httpfs_request_args["path"])
+            uid = httpfs_request_args["uid"]
+            gid = httpfs_request_args["gid"]
+
+            access_ok = self.check_access(path, uid, gid, os.R_OK)
+
+            if not access_ok:
+                logging.warning("Error during readdir request: Access denied")
+                response_obj.set_err_no(errno.EACCES)
+                response_obj.set_data({"message": "Access denied"})
+                return response_obj
+
+            if page_size is None and not with_attrs:
+                dir_listing = os.listdir(path)
+                dir_listing = [".", ".."] + dir_listing
+                response_obj.set_data({"dir_listing": dir_listing})
+                return response_obj
+
+            dir_iterator = os.scandir(path)
+            dir_listing = [".", ".."]
         else:
-            logging.warning("Error during readdir request: Access denied")
-            response_obj.set_err_no(errno.EACCES)
-            response_obj.set_data({"message": "Access denied"})
+            dir_iterator = self.get_dir_cursors().take(
+                self.from_handle(cursor),
+                self.get_client_id(),
+                httpfs_request_args.get("uid")
+            )
+            if dir_iterator is None:
+                logging.warning("Error during readdir request: Cursor expired")
+                response_obj.set_err_no(errno.EINVAL)
+                response_obj.set_data({"message": "Directory cursor expired"})
+                return response_obj
+            dir_listing = []
+
+        dir_attrs = dict()
+        try:
+            page_entries = 0
+            for dir_entry in itertools.islice(dir_iterator, page_size):
+                page_entries += 1
+                dir_listing.append(dir_entry.name)
+                if not with_attrs:
+                    continue
+                try:
+                    entry_stats = dir_entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    # Removed since the directory was read, getattr will
+                    # report it
+                    continue
+                dir_attrs[dir_entry.name] = {
+                    k: getattr(entry_stats, k)
+                    for k in _HttpFsRequestHandler.GETATTR_KEYS
+                }
+        except BaseException:
+            dir_iterator.close()
+            raise
+
+        if page_size is not None and page_entries == page_size:
+            next_cursor = self.to_handle(self.get_dir_cursors().put(
+                dir_iterator, self.get_client_id(), httpfs_request_args.get("uid")
+            ))
+        else:
+            dir_iterator.close()
+            next_cursor = None
 
-        self.send_json_response(200, response_obj.as_dict())
+        response_data = {"dir_listing": dir_listing}
+        if with_attrs:
+            response_data["dir_attrs"] = dir_attrs
+        if page_size is not None:
+            response_data["cursor"] = next_cursor
+        response_obj.set_data(response_data)
+        return response_obj
 
     def on_rename(self, httpfs_request_args):
         """
@@ -687,24 +1337,19 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        file_stats = os.stat(old_path)
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
+        permissions = self.get_permissions()
+        access_ok = self.check_access(old_path, uid, gid, os.W_OK)
 
         response_obj = HttpFsResponse()
 
-        if uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IWUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IWGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IWOTH
-
         try:
             if access_ok:
                 os.rename(old_path, new_path)
+                permissions.invalidate(old_path, recursive=True)
+                permissions.invalidate(new_path, recursive=True)
+                self.publish_changes(
+                    (old_path, HttpFsEvent.TREE), (new_path, HttpFsEvent.TREE)
+                )
             else:
                 logging.warning("Error during rename request: Access denied")
                 response_obj.set_err_no(errno.EACCES)
@@ -714,7 +1359,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_readlink(self, httpfs_request_args):
         # TODO: This doesn't work
@@ -734,7 +1379,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             logging.error("Error during readlink request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_release(self, httpfs_request_args):
         """
@@ -744,12 +1389,15 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         response_obj = HttpFsResponse()
 
         try:
-            os.close(httpfs_request_args["file_descriptor"])
+            self.get_file_handles().close(
+                self.from_handle(httpfs_request_args["file_descriptor"]),
+                self.get_client_id()
+            )
         except Exception as e:
             logging.error("Error during release request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_rmdir(self, httpfs_request_args):
         """
@@ -759,9 +1407,11 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         response_obj = HttpFsResponse()
         path = self.get_abs_path(httpfs_request_args["path"])
         _error = None
-        _err = None 
+        err = None
         try:
             os.rmdir(path)
+            self.get_permissions().invalidate(path)
+            self.publish_changes((path, HttpFsEvent.ENTRY))
 
         except FileNotFoundError as e:
             logging.error("{} not found".format(path))
@@ -776,10 +1426,10 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
 
         if _error != None:
             logging.error("Error during rmdir request: {}".format(_error))
-            response_obj.set_err_no(_err)
+            response_obj.set_err_no(err)
             response_obj.set_data({"message": str(_error)})
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_statfs(self, httpfs_request_args):
         """
@@ -794,7 +1444,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             statfs_result[k] = getattr(statfs_os_result, k)
 
         response_obj = HttpFsResponse(response_data=statfs_result)
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_symlink(self, httpfs_request_args):
         """
@@ -807,11 +1457,13 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
 
         try:
             os.symlink(source, target)
+            self.get_permissions().invalidate(target)
+            self.publish_changes((target, HttpFsEvent.ENTRY))
         except Exception as e:
             logging.error("Error during symlink request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_truncate(self, httpfs_request_args):
         """
@@ -825,12 +1477,13 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         try:
             with open(path, 'r+') as f:
                 f.truncate(length)
+            self.publish_changes((path, HttpFsEvent.DATA))
         except Exception as e:
             logging.error("Error during truncate request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_unlink(self, httpfs_request_args):
         """
@@ -843,21 +1496,11 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         gid = httpfs_request_args["gid"]
 
         try:
-            file_stats = os.stat(path)
-            is_owner = file_stats.st_uid == uid
-            is_group = file_stats.st_gid == gid
-
-            if uid == 0:
-                access_ok = True
-            elif is_owner:
-                access_ok = file_stats.st_mode & stat.S_IWUSR
-            elif is_group:
-                access_ok = file_stats.st_mode & stat.S_IWGRP
-            else:
-                access_ok = file_stats.st_mode & stat.S_IWOTH
-
-            if access_ok:
+            permissions = self.get_permissions()
+            if self.check_access(path, uid, gid, os.W_OK):
                 os.unlink(path)
+                permissions.invalidate(path)
+                self.publish_changes((path, HttpFsEvent.ENTRY))
             else:
                 logging.warning("Error during unlink request: Access denied")
                 response_obj.set_err_no(errno.EACCES)
@@ -871,7 +1514,7 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(200, response_obj.as_dict())
+        return response_obj
 
     def on_utimens(self, httpfs_request_args):
         """
@@ -887,22 +1530,12 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        file_stats = os.stat(path)
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
-
-        if uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IWUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IWGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IWOTH
+        access_ok = self.check_access(path, uid, gid, os.W_OK)
 
         try:
             if access_ok:
                 os.utime(path, times)
+                self.publish_changes((path, HttpFsEvent.ATTR))
             else:
                 logging.warning("Error during write request: Access denied")
                 response_obj.set_err_no(errno.EACCES)
@@ -913,74 +1546,95 @@ class _HttpFsRequestHandler(_JSONRequestHandler):
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
+        return response_obj
 
     def on_write(self, httpfs_request_args):
         """
-        Called when HttpFsRequest.OP_UTIMENS is received from the client
+        Called when HttpFsRequest.OP_WRITE is received from the client
         :param httpfs_request_args: The client request arg dict
         """
-        start_time = time.time()
-
         response_obj = HttpFsResponse()
 
-        file_descriptor = httpfs_request_args["file_descriptor"]
-        data = base64.standard_b64decode(httpfs_request_args["data"])
+        data = httpfs_request_args["data"]
         offset = httpfs_request_args["offset"]
 
+        # Framed requests carry the bytes raw, JSON requests send base64
+        if isinstance(data, str):
+            data = base64.standard_b64decode(data)
+
         uid = httpfs_request_args["uid"]
         gid = httpfs_request_args["gid"]
 
-        file_stats = os.stat(file_descriptor)
-        is_owner = file_stats.st_uid == uid
-        is_group = file_stats.st_gid == gid
-
-        if uid == 0:
-            access_ok = True
-        elif is_owner:
-            access_ok = file_stats.st_mode & stat.S_IWUSR
-        elif is_group:
-            access_ok = file_stats.st_mode & stat.S_IWGRP
-        else:
-            access_ok = file_stats.st_mode & stat.S_IWOTH
-
         try:
-            if access_ok:
-                write_start_time = time.time()
-                with self.server.get_fs_lock():
-                    os.lseek(file_descriptor, offset, os.SEEK_SET)
-                    bytes_written = os.write(file_descriptor, data)
-                    logging.debug("{} wrote {} bytes".format(
-                        self.client_address[0],
-                        bytes_written)
-                    )
+            with self._use_file(httpfs_request_args) as open_file:
+                access_ok = self.check_file_access(
+                    open_file, uid, gid, os.W_OK
+                )
+                if access_ok:
+                    file_descriptor = open_file.fd
+                    write_start_time = time.time()
+                    # O_APPEND writes ignore the offset, so they are kept in
+                    # order with a per-file lock instead
+                    file_lock = self.get_file_locks().get_lock(file_descriptor)
+                    if file_lock is None:
+                        bytes_written = os.pwrite(file_descriptor, data, offset)
+                    else:
+                        wait_start_time = time.perf_counter()
+                        with file_lock:
+                            self.get_metrics().observe(
+                                "httpfs_file_lock_wait_seconds",
+                                time.perf_counter() - wait_start_time
+                            )
+                            bytes_written = os.write(file_descriptor, data)
+                    self.get_metrics().add("httpfs_written_bytes_total", bytes_written)
+                    self.publish_changes((open_file.path, HttpFsEvent.DATA))
                     response_obj.set_data({"bytes_written": bytes_written})
-                write_elapsed = time.time() - write_start_time
-                logging.debug(
-                    "Took {:.2f}s to write {} bytes ({:.2f} MB/s)".format(
-                        write_elapsed,
-                        bytes_written,
-                        bytes_written / 1024**2 / write_elapsed
+                    logging.debug(
+                        "%s took %.4fs to write %d bytes",
+                        self.client_address[0],
+                        time.time() - write_start_time,
+                        bytes_written
                     )
-                )
-            else:
-                logging.warning("Error during write request: Access denied")
-                response_obj.set_err_no(errno.EACCES)
-                response_obj.set_data({"message": "Access denied"})
+                else:
+                    logging.warning("Error during write request: Access denied")
+                    response_obj.set_err_no(errno.EACCES)
+                    response_obj.set_data({"message": "Access denied"})
 
         except Exception as e:
             logging.error("Error during write request: {}".format(e))
             response_obj.set_err_no(errno.EIO)
             response_obj.set_data({"message": str(e)})
 
-        # Send response
-        self.send_json_response(http.HTTPStatus.OK, response_obj.as_dict())
-        response_elapsed = time.time() - start_time
-
-        # Print 1/10 of the time
-        logging.debug(
-            "Took {:.2f}s to complete write response ({:.2f} MB/s)".format(
-                response_elapsed,
-                bytes_written / 1024**2 / response_elapsed
-            )
-        )
+        return response_obj
+
+    # Request type -> (name for logs, handler), see register_op()
+    _op_handlers = {
+        op_type: (HttpFsRequest.get_op_name(op_type), handler)
+        for op_type, handler in {
+            HttpFsRequest.OP_ACCESS: on_access,
+            HttpFsRequest.OP_CREATE: on_create,
+            HttpFsRequest.OP_FLUSH: on_flush,
+            HttpFsRequest.OP_FSYNC: on_fsync,
+            HttpFsRequest.OP_GET_ATTR: on_getattr,
+            HttpFsRequest.OP_LINK: on_link,
+            HttpFsRequest.OP_MKDIR: on_mkdir,
+            HttpFsRequest.OP_MKNOD: on_mknod,
+            HttpFsRequest.OP_OPEN: on_open,
+            HttpFsRequest.OP_READ: on_read,
+            HttpFsRequest.OP_READDIR: on_readdir,
+            HttpFsRequest.OP_READLINK: on_readlink,
+            HttpFsRequest.OP_RELEASE: on_release,
+            HttpFsRequest.OP_RENAME: on_rename,
+            HttpFsRequest.OP_RM_DIR: on_rmdir,
+            HttpFsRequest.OP_STAT_FS: on_statfs,
+            HttpFsRequest.OP_SYMLINK: on_symlink,
+            HttpFsRequest.OP_TRUNCATE: on_truncate,
+            HttpFsRequest.OP_UNLINK: on_unlink,
+            HttpFsRequest.OP_UTIMENS: on_utimens,
+            HttpFsRequest.OP_WRITE: on_write,
+            HttpFsRequest.OP_CHOWN: on_chown,
+            HttpFsRequest.OP_CHMOD: on_chmod,
+            HttpFsRequest.OP_READDIR_PLUS: on_readdir_plus,
+            HttpFsRequest.OP_COMPOUND: on_compound
+        }.items()
+    }
@@ -0,0 +1,193 @@
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+
+from ._DirCursorTable import _DirCursorTable
+from ._FileHandleTable import _FileHandleTable
+from ._FileLockTable import _FileLockTable
+from ._InvalidationLog import _InvalidationLog
+from ._PermissionCache import _PermissionCache
+from ._ServerMetrics import _ServerMetrics
+from ._WorkerGroup import _WorkerGroup
+from ..common import HttpFsEvent
+from ..common.credentials.TextCredStore import TextCredStore
+
+
+class _HttpFsServerMixin:
+    """
+    State and configuration shared by every HttpFs server engine, which is
+    everything _HttpFsRequestHandler needs from its server
+    """
+
+    # TCP keepAlive activates after 1 second of idle connection,
+    # sends a ping every 3 seconds, and closes after 1 failed ping
+    _tcp_keepidle_secs = 1
+    _tcp_keep_interval_secs = 3
+    _tcp_keep_max_fails = 1
+
+    def _init_httpfs(self, fs_root, cred_store_file=None, worker_group=None,
+                     slow_request_time=None):
+        """
+        :param fs_root: The HttpFS filesystem root on the server
+        :param cred_store_file: Optional JSON file with the allowed API keys
+        :param worker_group: The _WorkerGroup when running as one of several
+        worker processes
+        :param slow_request_time: Seconds after which a request is logged
+        with the time spent in each phase, None to log none
+        """
+        self._fs_root = os.path.realpath(fs_root)
+        self._slow_request_time = slow_request_time
+        self._file_locks = _FileLockTable()
+        self._file_handles = _FileHandleTable(self._file_locks)
+        self._dir_cursors = _DirCursorTable()
+        self._permissions = _PermissionCache()
+        self._metrics = _ServerMetrics()
+        self._worker_group = worker_group or _WorkerGroup()
+        self._invalidation_log = _InvalidationLog()
+
+        # Changes are passed on to the other workers in the background, so
+        # the requests making them don't wait for it
+        self._peer_changes = None
+        if self._worker_group.get_count() > 1:
+            self._peer_changes = queue.Queue()
+            threading.Thread(
+                target=self._send_peer_changes,
+                name="httpfs-peer-changes",
+                daemon=True
+            ).start()
+
+        if cred_store_file is not None:
+            self._cred_store = TextCredStore(cred_store_file)
+        else:
+            self._cred_store = None
+
+        if not os.path.exists(self._fs_root):
+            raise RuntimeError(
+                "Filesystem root '{}' doesn't exist".format(self._fs_root)
+            )
+
+    @staticmethod
+    def _configure_socket(sock):
+        """
+        Sets the TCP options inherited by every accepted connection
+        :param sock: The listening socket
+        """
+        # This line fixes the HTTP/1.1 keep-alive delay
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # These options configure TCP keep-alive, which is different
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(
+            socket.IPPROTO_TCP,
+            socket.TCP_KEEPIDLE,
+            _HttpFsServerMixin._tcp_keepidle_secs
+        )
+        sock.setsockopt(
+            socket.IPPROTO_TCP,
+            socket.TCP_KEEPINTVL,
+            _HttpFsServerMixin._tcp_keep_interval_secs
+        )
+        sock.setsockopt(
+            socket.IPPROTO_TCP,
+            socket.TCP_KEEPCNT,
+            _HttpFsServerMixin._tcp_keep_max_fails
+        )
+
+    def get_fs_root(self):
+        return self._fs_root
+
+    def get_file_locks(self):
+        return self._file_locks
+
+    def get_file_handles(self):
+        return self._file_handles
+
+    def get_dir_cursors(self):
+        return self._dir_cursors
+
+    def get_permissions(self):
+        return self._permissions
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_metrics_snapshot(self):
+        """
+        :return: This process's metrics, see _ServerMetrics.collect()
+        """
+        return self._metrics.collect({
+            "httpfs_open_handles": len(self._file_handles),
+            "httpfs_open_fds": self._file_handles.get_open_fds(),
+            "httpfs_threads": threading.active_count()
+        })
+
+    def get_slow_request_time(self):
+        return self._slow_request_time
+
+    def get_cred_store(self):
+        return self._cred_store
+
+    def get_worker_group(self):
+        return self._worker_group
+
+    def get_invalidation_log(self):
+        return self._invalidation_log
+
+    def publish_changes(self, changes, origin=None):
+        """
+        Tells the clients polling GET /events on any worker about changes
+        :param changes: (client path, change) pairs, see HttpFsEvent
+        :param origin: Id of the client that made the changes
+        """
+        self._invalidation_log.publish(changes, origin)
+        if self._peer_changes is not None:
+            self._peer_changes.put((changes, origin))
+
+    def get_max_event_wait(self):
+        """
+        :return: Max seconds a GET /events request may wait for changes on
+        the thread running it, 0 for engines that wait before running it
+        """
+        return _InvalidationLog.MAX_WAIT
+
+    def _send_peer_changes(self):
+        """
+        Sends the changes published by this worker to the other workers,
+        batching the ones that pile up while a batch is sent
+        """
+        worker_group = self._worker_group
+        while True:
+            batches = [self._peer_changes.get()]
+            while not self._peer_changes.empty():
+                batches.append(self._peer_changes.get_nowait())
+            body = json.dumps([
+                {"changes": changes, "origin": origin} for changes, origin in batches
+            ]).encode()
+
+            for index in range(worker_group.get_count()):
+                if index == worker_group.get_index():
+                    continue
+                try:
+                    status, _, _ = worker_group.forward(
+                        index,
+                        {"Content-Type": "application/json"},
+                        body,
+                        _WorkerGroup.PEER_ADDRESS[0],
+                        path=HttpFsEvent.URL_PATH
+                    )
+                except (OSError, http.client.HTTPException) as e:
+                    logging.warning("Can't send changes to worker %d: %s", index, e)
+                    continue
+                if status != http.HTTPStatus.NO_CONTENT:
+                    logging.warning("Can't send changes to worker %d: %d", index, status)
+
+    def get_mux_executor(self):
+        """
+        :return: The executor running the requests of multiplexed
+        connections, or None if the engine can't serve them
+        """
+        return None
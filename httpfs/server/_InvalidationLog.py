@@ -0,0 +1,168 @@
+import binascii
+import collections
+import os
+import threading
+import urllib.parse
+
+from httpfs.common import HttpFsEvent
+
+_EventsQuery = collections.namedtuple(
+    "_EventsQuery", ["log_id", "since", "subtree", "origin", "timeout"]
+)
+
+
+class _InvalidationLog:
+    """
+    The latest changes made through the server, for clients long-polling
+    GET /events to invalidate their caches with
+
+    Every change gets the next sequence number, and clients ask for the
+    changes after the last one they saw. Only the newest max_events changes
+    are kept. A client that fell further behind, or whose sequence numbers
+    come from another log (a restarted server, or another worker), is told
+    to reset, i.e. to drop everything it caches.
+
+    A change repeated right after itself, like the writes of a file being
+    copied, replaces the earlier one instead of taking another slot.
+    """
+    # Seconds a poll waits for changes unless it asks for less
+    DEFAULT_WAIT = 30
+    MAX_WAIT = 60
+
+    def __init__(self, max_events=4096):
+        """
+        :param max_events: Number of changes to keep for clients that poll
+        less often than changes happen
+        """
+        self._log_id = binascii.hexlify(os.urandom(8)).decode()
+        self._max_events = max_events
+        self._condition = threading.Condition()
+        # (sequence number, path, change, origin), oldest first
+        self._events = collections.deque()
+        self._last_seq = 0
+        # Clients that saw less than this missed changes
+        self._evicted_seq = 0
+        self._listeners = []
+
+    def get_log_id(self):
+        return self._log_id
+
+    def add_listener(self, listener):
+        """
+        :param listener: Called without arguments after changes are
+        published, from the publishing thread
+        """
+        self._listeners.append(listener)
+
+    def publish(self, changes, origin=None):
+        """
+        Appends changes to the log and wakes the polls waiting for them
+        :param changes: (path, change) pairs, see HttpFsEvent
+        :param origin: Id of the client that made the changes, whose own
+        polls can leave them out
+        """
+        with self._condition:
+            for path, change in changes:
+                last_event = self._events[-1] if self._events else None
+                if last_event is not None and last_event[1:] == (path, change, origin):
+                    self._events.pop()
+                elif len(self._events) >= self._max_events:
+                    self._evicted_seq = self._events.popleft()[0]
+                self._last_seq += 1
+                self._events.append((self._last_seq, path, change, origin))
+            self._condition.notify_all()
+
+        for listener in self._listeners:
+            listener()
+
+    @staticmethod
+    def parse_query(query_string):
+        """
+        :param query_string: Query string of a GET /events request
+        :return: The _EventsQuery it asks for
+        """
+        params = urllib.parse.parse_qs(query_string)
+
+        def get_param(name, param_type, default):
+            try:
+                return param_type(params[name][0])
+            except (KeyError, ValueError):
+                return default
+
+        timeout = get_param("timeout", float, _InvalidationLog.DEFAULT_WAIT)
+        return _EventsQuery(
+            log_id=get_param("log", str, None),
+            since=get_param("since", int, None),
+            subtree=get_param("path", str, "/"),
+            origin=get_param("origin", str, None),
+            timeout=min(max(timeout, 0), _InvalidationLog.MAX_WAIT)
+        )
+
+    def has_events(self, query):
+        """
+        :param query: An _EventsQuery
+        :return: Whether a poll for query can be answered without waiting
+        """
+        with self._condition:
+            return self._has_events(query)
+
+    def wait(self, query, timeout):
+        """
+        Waits for changes a poll asks for
+        :param query: An _EventsQuery
+        :param timeout: Max seconds to wait
+        :return: Whether the poll can be answered
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._has_events(query), timeout)
+
+    def get_events(self, query):
+        """
+        :param query: An _EventsQuery
+        :return: (the HttpFsEvents the client hasn't seen, the sequence number
+        to poll from next, whether the client must reset its caches instead)
+        """
+        with self._condition:
+            if query.since is None or self._is_lost(query):
+                return [], self._last_seq, query.since is not None
+
+            events = []
+            for seq, path, change, origin in reversed(self._events):
+                if seq <= query.since:
+                    break
+                event = HttpFsEvent(path, change)
+                if origin is not None and origin == query.origin:
+                    continue
+                if event.is_below(query.subtree):
+                    events.append(event)
+            events.reverse()
+            return events, self._last_seq, False
+
+    def _has_events(self, query):
+        """
+        Must hold _condition
+        """
+        if query.since is None or self._is_lost(query):
+            return True
+        # Answered before the changes it left out are evicted, so clients
+        # whose own changes fill the log aren't told to reset
+        if self._last_seq - query.since >= self._max_events // 2:
+            return True
+        for seq, path, change, origin in reversed(self._events):
+            if seq <= query.since:
+                break
+            if origin is not None and origin == query.origin:
+                continue
+            if HttpFsEvent(path, change).is_below(query.subtree):
+                return True
+        return False
+
+    def _is_lost(self, query):
+        """
+        :return: Whether the client missed changes, must hold _condition
+        """
+        return (
+            query.log_id != self._log_id
+            or query.since < self._evicted_seq
+            or query.since > self._last_seq
+        )
@@ -3,6 +3,9 @@ from http.server import BaseHTTPRequestHandler
 
 import ujson
 
+from httpfs.common import HttpFsFrame, HttpFsCompression, HttpFsResponse
+from ._RequestTimer import _RequestTimer
+
 
 class _JSONRequestHandler(BaseHTTPRequestHandler):
     ERR_INVALID_CONTENT_TYPE = "Incompatible Content-Type"
@@ -11,10 +14,20 @@ class _JSONRequestHandler(BaseHTTPRequestHandler):
     ERR_INVALID_REQ_TYPE = "HTTP method not supported"
     ERR_UNKNOWN = "Unknown error"
     ERR_CONTENT_LENGTH = "Content-Length was 0 or was not set"
+    ERR_CONTENT_ENCODING = "Invalid request body: {}"
+    ERR_BODY_TOO_LARGE = "Request body is larger than {} bytes"
 
     protocol_version = "HTTP/1.1"
     default_request_version = "HTTP/1.1"
 
+    # Types besides bytes that send_frame_response() sends as payloads, they
+    # are written with write_payload()
+    frame_payload_types = ()
+
+    # Max size of a request body, after decompression. A few bytes of deflate
+    # can inflate to gigabytes.
+    max_request_size = 64 * 1024 * 1024
+
     @staticmethod
     def _dict_to_json(dict_obj):
         try:
@@ -29,6 +42,13 @@ class _JSONRequestHandler(BaseHTTPRequestHandler):
         except json.JSONDecodeError as e:
             return e.msg
 
+    @staticmethod
+    def _frame_to_dict(frame_bytes):
+        try:
+            return HttpFsFrame.unpack(frame_bytes)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            return str(e)
+
     def on_valid_request(self, request_dict):
         """
         To be implemented by extending classes
@@ -43,6 +63,21 @@ class _JSONRequestHandler(BaseHTTPRequestHandler):
         """
         pass
 
+    def is_authorized(self):
+        """
+        To be implemented by extending classes, compressed request bodies are
+        only decompressed for authorized clients
+        :return: Whether the request comes from an authorized client
+        """
+        return True
+
+    def parse_request(self):
+        # One handler serves every request of a keep-alive connection
+        self._timer = _RequestTimer()
+        self._request_id = None
+        self._send_server_timing = False
+        return super().parse_request()
+
     def do_GET(self):
         """
         Called when a GET request comes in
@@ -57,19 +92,26 @@ class _JSONRequestHandler(BaseHTTPRequestHandler):
         """
         return self._validate_request()
 
+    def accepts_frames(self):
+        """
+        :return: Whether the client negotiated binary frame responses
+        """
+        return HttpFsFrame.CONTENT_TYPE in self.headers.get("Accept", "")
+
     def _validate_request(self):
         """
         Called when any valid request comes in
         """
         content_len = 0
 
-        # Check for JSON request
-        json_sent = (
-            "Content-Type" in self.headers and
-            self.headers["Content-Type"].startswith("application/json")
-        )
+        # Check for JSON or binary frame request
+        content_type = self.headers.get("Content-Type", "")
+        json_sent = content_type.startswith("application/json")
+        frame_sent = content_type.startswith(HttpFsFrame.CONTENT_TYPE)
 
-        if not json_sent:
+        if not json_sent and not frame_sent:
+            # The body is left unread, so the connection can't be reused
+            self.close_connection = True
             return self.on_invalid_request(_JSONRequestHandler.ERR_INVALID_CONTENT_TYPE)
 
         # Check for Content-Length
@@ -81,12 +123,39 @@ class _JSONRequestHandler(BaseHTTPRequestHandler):
         if not length_sent or content_len <= 0:
             return self.on_invalid_request(_JSONRequestHandler.ERR_CONTENT_LENGTH)
 
+        if content_len > self.max_request_size:
+            # The body is left unread, so the connection can't be reused
+            self.close_connection = True
+            return self.on_invalid_request(
+                _JSONRequestHandler.ERR_BODY_TOO_LARGE.format(self.max_request_size)
+            )
+
         # Parse request
-        request_str = self.rfile.read(content_len).decode("utf-8")
-        request_json = _JSONRequestHandler._json_to_dict(request_str)
+        request_bytes = self.rfile.read(content_len)
+        content_encoding = self.headers.get(
+            "Content-Encoding", HttpFsCompression.IDENTITY
+        )
+        if content_encoding != HttpFsCompression.IDENTITY and not self.is_authorized():
+            return self.on_invalid_request(_JSONRequestHandler.ERR_UNAUTHORIZED)
+        try:
+            request_bytes = HttpFsCompression.decompress(
+                content_encoding, request_bytes, self.max_request_size
+            )
+        except ValueError as e:
+            return self.on_invalid_request(
+                _JSONRequestHandler.ERR_CONTENT_ENCODING.format(e)
+            )
+        self._request_body = request_bytes
+        if frame_sent:
+            request_json = _JSONRequestHandler._frame_to_dict(request_bytes)
+        else:
+            request_json = _JSONRequestHandler._json_to_dict(
+                request_bytes.decode("utf-8")
+            )
 
         if isinstance(request_json, dict):
             # This is the only successful outcome
+            self._timer.lap("parse")
             return self.on_valid_request(request_json)
         else:
             return self.on_invalid_request(_JSONRequestHandler.ERR_INVALID_JSON.format(request_json))
@@ -101,9 +170,78 @@ class _JSONRequestHandler(BaseHTTPRequestHandler):
             response_dict
         ).encode("utf-8")
 
+        self._send_body(
+            status_code, "application/json; charset=utf-8", [res_json_bytes]
+        )
+
+    def send_frame_response(self, status_code, response_dict):
+        """
+        Sends the given dict as a binary frame response, with any bytes
+        values sent raw after the frame header
+        :param status_code: Integer HTTP status code to send
+        :param response_dict: The response object
+        """
+        self._send_body(
+            status_code,
+            HttpFsFrame.CONTENT_TYPE,
+            HttpFsFrame.pack(response_dict, self.frame_payload_types)
+        )
+
+    def write_payload(self, chunk):
+        """
+        Writes one chunk of a response body, see frame_payload_types
+        :param chunk: The bytes-like chunk or payload
+        """
+        self.wfile.write(chunk)
+
+    def _send_body(self, status_code, content_type, chunks):
+        """
+        Sends a response, compressed with the coding the client prefers if
+        it accepts one and the body looks compressible. Bodies with
+        frame_payload_types payloads aren't compressed, they're sent as they
+        are. Every response lists the codings request bodies may be sent
+        with.
+        :param status_code: Integer HTTP status code to send
+        :param content_type: Content-Type of the body
+        :param chunks: The body, as bytes-like chunks and payloads
+        """
+        coding = HttpFsCompression.choose(self.headers.get("Accept-Encoding"))
+        if any(isinstance(c, self.frame_payload_types) for c in chunks):
+            coding = None
+        if coding is not None:
+            body_size = sum(len(c) for c in chunks)
+            if HttpFsCompression.is_compressible(body_size, self._sample_body(chunks)):
+                chunks = [HttpFsCompression.compress(coding, b"".join(chunks))]
+            else:
+                coding = None
+
+        self._timer.lap("serialize")
         self.send_response(status_code)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", len(res_json_bytes))
+        self.send_header("Content-Type", content_type)
+        if self._request_id is not None:
+            self.send_header(HttpFsResponse.REQUEST_ID_HEADER, self._request_id)
+        if self._send_server_timing:
+            self.send_header(
+                HttpFsResponse.SERVER_TIMING_HEADER, self._timer.get_server_timing()
+            )
+        if coding is not None:
+            self.send_header("Content-Encoding", coding)
+        self.send_header("Accept-Encoding", HttpFsCompression.get_accept_encoding())
+        self.send_header("Content-Length", sum(len(c) for c in chunks))
         self.send_header("Connection", "keep-alive")
         self.end_headers()
-        self.wfile.write(res_json_bytes)
+        for chunk in chunks:
+            self.write_payload(chunk)
+
+    def _sample_body(self, chunks):
+        """
+        :return: The first HttpFsCompression.SAMPLE_SIZE bytes of the body
+        """
+        sample = []
+        remaining = HttpFsCompression.SAMPLE_SIZE
+        for chunk in chunks:
+            if remaining <= 0:
+                break
+            sample.append(bytes(chunk[:remaining]))
+            remaining -= len(sample[-1])
+        return b"".join(sample)
@@ -0,0 +1,130 @@
+import concurrent.futures
+import logging
+import socket
+import threading
+
+from httpfs.common import HttpFsMuxFrame
+from ._BufferedRequestHandler import _BufferedRequestHandler
+from ._FileRegion import _FileRegion
+
+
+class _MuxConnection:
+    """
+    Serves a connection switched to the multiplexed protocol, see
+    HttpFsMuxFrame
+
+    The connection's thread only reads frames. Each request is run through
+    a _BufferedRequestHandler on the server's executor and its response is
+    written back as soon as it's ready, so a slow request doesn't hold up
+    the ones sent after it.
+    """
+    # Max requests of one connection queued or running at once, reading
+    # more frames waits until one finishes
+    _MAX_IN_FLIGHT = 256
+
+    def __init__(self, sock, reader, client_address, server, executor):
+        """
+        :param sock: The upgraded connection
+        :param reader: Buffered reader of the connection, which may hold the
+        first frames already
+        :param client_address: The client's address
+        :param server: The HttpFs server
+        :param executor: Executor to run requests on
+        """
+        self._sock = sock
+        self._reader = reader
+        self._client_address = client_address
+        self._server = server
+        self._executor = executor
+        self._write_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(_MuxConnection._MAX_IN_FLIGHT)
+        self._futures = set()
+
+    def serve(self):
+        """
+        Serves requests until the client closes the connection
+        """
+        try:
+            while True:
+                frame = HttpFsMuxFrame.read(self._reader)
+                if frame is None:
+                    break
+
+                self._in_flight.acquire()
+                future = self._executor.submit(self._run_request, *frame)
+                self._futures.add(future)
+                future.add_done_callback(self._futures.discard)
+        except (ConnectionError, socket.timeout) as e:
+            logging.debug(
+                "Closing multiplexed connection from %s: %s",
+                self._client_address[0],
+                e
+            )
+        finally:
+            # The socket is closed once this returns
+            concurrent.futures.wait(list(self._futures))
+
+    def _run_request(self, stream_id, raw_request):
+        try:
+            handler = _BufferedRequestHandler(
+                raw_request, self._client_address, self._server
+            )
+            response_parts = handler.get_response_parts()
+        except Exception as e:
+            # Like an error on a plain connection, drop the connection so the
+            # client doesn't wait for the response
+            logging.error(
+                "Error serving %s, closing its connection: %s",
+                self._client_address[0],
+                e
+            )
+            self._shutdown()
+            return
+        finally:
+            self._in_flight.release()
+
+        try:
+            self._send_response(stream_id, response_parts)
+        except OSError as e:
+            logging.debug(
+                "Couldn't send response to %s: %s", self._client_address[0], e
+            )
+        finally:
+            for part in response_parts:
+                if isinstance(part, _FileRegion):
+                    part.close()
+
+    def _send_response(self, stream_id, response_parts):
+        """
+        Sends a response from _BufferedRequestHandler.get_response_parts() in
+        one frame, with its _FileRegions sent straight from the file
+        """
+        size = sum(len(part) for part in response_parts)
+        header = HttpFsMuxFrame.pack_header(stream_id, size)
+        with self._write_lock:
+            # One send for small responses, so they go out in one packet
+            if size < 64 * 1024 and not any(
+                isinstance(part, _FileRegion) for part in response_parts
+            ):
+                self._sock.sendall(header + b"".join(response_parts))
+                return
+
+            self._sock.sendall(header)
+            for part in response_parts:
+                if not isinstance(part, _FileRegion):
+                    self._sock.sendall(part)
+                elif part.send(self._sock) < len(part):
+                    # The frame is shorter than its header says, the rest of
+                    # the connection can't be read
+                    logging.error(
+                        "File shrank while being sent to %s, closing the connection",
+                        self._client_address[0]
+                    )
+                    self._shutdown()
+                    return
+
+    def _shutdown(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
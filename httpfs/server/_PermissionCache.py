@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+
+class _PermissionCache:
+    """
+    Evaluates the permission checks of client requests against file modes
+
+    Path checks use a stat cache whose entries expire after stat_ttl
+    seconds, and handlers invalidate the paths they change, so a burst of
+    requests on one path costs one stat. Changes made by other worker
+    processes or outside the server show up once the entry expires.
+
+    Open files are checked against the permissions granted when they were
+    opened, like a local open file, so reads and writes need no stat at all.
+    """
+    _ALL_ACCESS = os.R_OK | os.W_OK | os.X_OK
+
+    def __init__(self, stat_ttl=1.0, max_entries=4096):
+        """
+        :param stat_ttl: Seconds a path's stat result is reused, 0 disables
+        the stat cache
+        :param max_entries: Max number of cached stat results
+        """
+        self._stat_ttl = stat_ttl
+        self._max_entries = max_entries
+        self._guard = threading.Lock()
+        # path -> (expiry time, os.stat_result), oldest first
+        self._stats = dict()
+
+    @staticmethod
+    def get_allowed(file_stats, uid, gid):
+        """
+        :param file_stats: The file's os.stat_result
+        :param uid: The caller's uid
+        :param gid: The caller's gid
+        :return: The access mode bits (os.R_OK, os.W_OK, os.X_OK) the file's
+        mode gives the caller
+        """
+        if uid == 0:
+            return _PermissionCache._ALL_ACCESS
+        if file_stats.st_uid == uid:
+            return (file_stats.st_mode >> 6) & _PermissionCache._ALL_ACCESS
+        if file_stats.st_gid == gid:
+            return (file_stats.st_mode >> 3) & _PermissionCache._ALL_ACCESS
+        return file_stats.st_mode & _PermissionCache._ALL_ACCESS
+
+    @staticmethod
+    def get_open_mode(flags):
+        """
+        :param flags: os.open() flags
+        :return: The access mode bits opening a file with the flags needs
+        """
+        access_mode = flags & os.O_ACCMODE
+        mode = 0
+        if access_mode in (os.O_RDONLY, os.O_RDWR):
+            mode |= os.R_OK
+        if access_mode in (os.O_WRONLY, os.O_RDWR) or flags & os.O_TRUNC:
+            mode |= os.W_OK
+        return mode
+
+    def check(self, path, uid, gid, mode):
+        """
+        :param path: Absolute path on the server
+        :param uid: The caller's uid
+        :param gid: The caller's gid
+        :param mode: The access mode bits needed, os.F_OK to check that the
+        path exists
+        :return: Whether the caller has that access
+        :raise OSError: If the path can't be stat'ed, e.g. FileNotFoundError
+        """
+        allowed = _PermissionCache.get_allowed(self.get_stats(path), uid, gid)
+        return allowed & mode == mode
+
+    def get_stats(self, path):
+        """
+        :param path: Absolute path on the server
+        :return: The path's os.stat_result, at most stat_ttl seconds old
+        :raise OSError: If the path can't be stat'ed
+        """
+        if self._stat_ttl <= 0:
+            return os.stat(path)
+
+        now = time.monotonic()
+        entry = self._stats.get(path)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        # Missing paths aren't cached, they're usually about to be created
+        file_stats = os.stat(path)
+        with self._guard:
+            self._stats.pop(path, None)
+            self._stats[path] = (now + self._stat_ttl, file_stats)
+            self._pop_stale(now)
+        return file_stats
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drops a changed path's cached stat result
+        :param path: Absolute path on the server
+        :param recursive: Also drop the paths under it, for renamed
+        directories
+        """
+        with self._guard:
+            self._stats.pop(path, None)
+            if recursive:
+                prefix = path.rstrip("/") + "/"
+                for cached_path in [p for p in self._stats if p.startswith(prefix)]:
+                    del self._stats[cached_path]
+
+    @staticmethod
+    def check_file(open_file, uid, gid, mode):
+        """
+        :param open_file: The _OpenFile being used, with its fd set
+        :param uid: The caller's uid
+        :param gid: The caller's gid
+        :param mode: The access mode bits needed
+        :return: Whether the caller has that access through the open file
+        """
+        if open_file.uid == uid and open_file.gid == gid:
+            return open_file.mode & mode == mode
+
+        # Another user than the opener, check the file as it is now
+        allowed = _PermissionCache.get_allowed(os.fstat(open_file.fd), uid, gid)
+        return allowed & mode == mode
+
+    def _pop_stale(self, now):
+        """
+        Removes expired entries and the oldest entries over max_entries,
+        must hold _guard
+        """
+        # Every entry gets the same TTL, so the dict is ordered by expiry
+        while self._stats:
+            path, (expiry, _) = next(iter(self._stats.items()))
+            if expiry > now and len(self._stats) <= self._max_entries:
+                break
+            del self._stats[path]
@@ -0,0 +1,69 @@
+import contextlib
+import time
+
+
+class _RequestTimer:
+    """
+    Splits the time spent on one request into phases
+
+    lap() charges the time since the previous lap to a phase. Time spent in
+    a measure() block is charged to that block's phase instead of the next
+    lap's, e.g. permission checks in the middle of a handler.
+
+    auth covers the API key check and the uid/gid permission checks the
+    handlers make, so dispatch is only the server's own overhead.
+    """
+    # Phases in the order requests go through them
+    PHASES = ("parse", "auth", "dispatch", "syscall", "serialize")
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._mark = self._start
+        # Time measured since the last lap, not to be charged to the next one
+        self._nested = 0.0
+        self._phases = dict.fromkeys(_RequestTimer.PHASES, 0.0)
+
+    def lap(self, phase):
+        """
+        Charges the time since the previous lap to a phase
+        :param phase: One of PHASES
+        """
+        now = time.perf_counter()
+        self._phases[phase] += now - self._mark - self._nested
+        self._mark = now
+        self._nested = 0.0
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """
+        Context manager charging the time spent in its block to a phase
+        :param phase: One of PHASES
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self._phases[phase] += elapsed
+            self._nested += elapsed
+
+    def get_phases(self):
+        """
+        :return: Dict of phase -> seconds
+        """
+        return dict(self._phases)
+
+    def get_elapsed(self):
+        """
+        :return: Seconds since the request started
+        """
+        return time.perf_counter() - self._start
+
+    def get_server_timing(self):
+        """
+        :return: The phases as a Server-Timing header value, in milliseconds
+        """
+        return ", ".join(
+            "{};dur={:.3f}".format(phase, seconds * 1000)
+            for phase, seconds in self._phases.items()
+        )
@@ -0,0 +1,244 @@
+import bisect
+import threading
+
+
+class _ThreadMetrics:
+    """
+    The counters and histograms one thread records into
+    """
+    __slots__ = ("thread", "counters", "histograms")
+
+    def __init__(self, thread):
+        self.thread = thread
+        # (name, labels) -> value
+        self.counters = dict()
+        # (name, labels) -> [count per bucket..., sum, count]
+        self.histograms = dict()
+
+
+class _ServerMetrics:
+    """
+    Request counters and latency histograms of a server, rendered in the
+    Prometheus text format
+
+    Every thread records into its own _ThreadMetrics, which only that thread
+    writes, so recording takes no lock. A scrape copies and sums the
+    per-thread values, and folds those of threads that have exited into
+    one set of totals. Labels are tuples of (name, value) pairs.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    # Threads that exited are folded into the totals every time this many
+    # more threads have recorded, and on every scrape
+    _RETIRE_INTERVAL = 256
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+    # name -> (type, help) of every metric a server exports
+    METRICS = {
+        "httpfs_requests_total": (
+            "counter", "Requests handled, by operation"
+        ),
+        "httpfs_request_errors_total": (
+            "counter", "Requests that returned an error, by operation and errno"
+        ),
+        "httpfs_request_duration_seconds": (
+            "histogram", "Time to handle and send a request, by operation"
+        ),
+        "httpfs_requests_in_flight": (
+            "gauge", "Requests being handled right now"
+        ),
+        "httpfs_read_bytes_total": (
+            "counter", "Bytes read from files for clients"
+        ),
+        "httpfs_written_bytes_total": (
+            "counter", "Bytes written to files for clients"
+        ),
+        "httpfs_file_lock_wait_seconds": (
+            "histogram", "Time O_APPEND writes waited for their file's lock"
+        ),
+        "httpfs_connections_active": (
+            "gauge", "Open client connections"
+        ),
+        "httpfs_connections_total": (
+            "counter", "Client connections accepted"
+        ),
+        "httpfs_open_handles": (
+            "gauge", "Files clients have open"
+        ),
+        "httpfs_open_fds": (
+            "gauge", "File descriptors open for client files"
+        ),
+        "httpfs_threads": (
+            "gauge", "Threads in the server process"
+        )
+    }
+
+    def __init__(self):
+        self._local = threading.local()
+        self._guard = threading.Lock()
+        self._threads = []
+        # Totals of the threads that have exited
+        self._retired = _ThreadMetrics(None)
+
+    def add(self, name, value=1, labels=()):
+        """
+        Adds to a counter
+        :param name: The metric name
+        :param value: The amount to add
+        :param labels: The metric's labels
+        """
+        counters = self._get_thread_metrics().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """
+        Records a value in a histogram
+        :param name: The metric name
+        :param value: The observed value, in seconds
+        :param labels: The metric's labels
+        """
+        histograms = self._get_thread_metrics().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(_ServerMetrics.BUCKETS) + 3)
+        histogram[bisect.bisect_left(_ServerMetrics.BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self, gauges=None):
+        """
+        :param gauges: Dict of gauge name -> value to add to the snapshot
+        :return: A JSON serializable snapshot of every metric, for render()
+        """
+        with self._guard:
+            self._retire_exited()
+            totals = _ThreadMetrics(None)
+            _ServerMetrics._merge(totals, self._retired)
+            for thread_metrics in self._threads:
+                _ServerMetrics._merge(totals, thread_metrics)
+
+        counters = totals.counters
+        # Started and finished are counted by different threads
+        in_flight = counters.pop(("httpfs_requests_started", ()), 0) - counters.pop(
+            ("httpfs_requests_finished", ()), 0
+        )
+        active = counters.get(("httpfs_connections_total", ()), 0) - counters.pop(
+            ("httpfs_connections_closed", ()), 0
+        )
+        gauges = dict(gauges or {})
+        gauges["httpfs_requests_in_flight"] = in_flight
+        gauges["httpfs_connections_active"] = active
+
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+            "histograms": [
+                [name, labels, histogram]
+                for (name, labels), histogram in totals.histograms.items()
+            ],
+            "gauges": [[name, (), value] for name, value in gauges.items()]
+        }
+
+    @staticmethod
+    def render(snapshots):
+        """
+        :param snapshots: List of (extra labels, snapshot from collect()),
+        e.g. one per worker process
+        :return: The metrics in the Prometheus text format
+        """
+        # name -> sample lines, so each metric family is listed once
+        families = dict()
+        for extra_labels, snapshot in snapshots:
+            extra_labels = tuple(tuple(label) for label in extra_labels)
+            for kind in ("counters", "gauges"):
+                for name, labels, value in snapshot[kind]:
+                    labels = extra_labels + tuple(tuple(label) for label in labels)
+                    families.setdefault(name, []).append(
+                        _ServerMetrics._format_sample(name, labels, value)
+                    )
+            for name, labels, histogram in snapshot["histograms"]:
+                labels = extra_labels + tuple(tuple(label) for label in labels)
+                samples = families.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(_ServerMetrics.BUCKETS + ("+Inf",), histogram):
+                    cumulative += count
+                    samples.append(_ServerMetrics._format_sample(
+                        name + "_bucket", labels + (("le", str(bound)),), cumulative
+                    ))
+                samples.append(_ServerMetrics._format_sample(
+                    name + "_sum", labels, histogram[-2]
+                ))
+                samples.append(_ServerMetrics._format_sample(
+                    name + "_count", labels, histogram[-1]
+                ))
+
+        lines = []
+        for name, samples in families.items():
+            metric_type, metric_help = _ServerMetrics.METRICS.get(name, ("untyped", name))
+            lines.append("# HELP {} {}".format(name, metric_help))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def _get_thread_metrics(self):
+        thread_metrics = getattr(self._local, "metrics", None)
+        if thread_metrics is None:
+            thread_metrics = self._local.metrics = _ThreadMetrics(
+                threading.current_thread()
+            )
+            with self._guard:
+                self._threads.append(thread_metrics)
+                # Servers with a thread per connection start many threads
+                if len(self._threads) % _ServerMetrics._RETIRE_INTERVAL == 0:
+                    self._retire_exited()
+        return thread_metrics
+
+    def _retire_exited(self):
+        """
+        Folds the values of threads that have exited into the totals, must
+        hold _guard
+        """
+        live_threads = []
+        for thread_metrics in self._threads:
+            if thread_metrics.thread.is_alive():
+                live_threads.append(thread_metrics)
+            else:
+                _ServerMetrics._merge(self._retired, thread_metrics)
+        self._threads = live_threads
+
+    @staticmethod
+    def _merge(totals, thread_metrics):
+        """
+        Adds a thread's values to totals. Copying a dict or list is atomic,
+        so the thread may keep recording meanwhile.
+        """
+        for key, value in dict(thread_metrics.counters).items():
+            totals.counters[key] = totals.counters.get(key, 0) + value
+        for key, histogram in dict(thread_metrics.histograms).items():
+            histogram = list(histogram)
+            total = totals.histograms.get(key)
+            if total is None:
+                totals.histograms[key] = histogram
+            else:
+                totals.histograms[key] = [a + b for a, b in zip(total, histogram)]
+
+    @staticmethod
+    def _format_sample(name, labels, value):
+        if labels:
+            name += "{" + ",".join(
+                '{}="{}"'.format(label, _ServerMetrics._escape(label_value))
+                for label, label_value in labels
+            ) + "}"
+        if isinstance(value, float):
+            return "{} {!r}".format(name, value)
+        return "{} {}".format(name, value)
+
+    @staticmethod
+    def _escape(label_value):
+        return str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,119 @@
+import http.client
+import os
+import socket
+import threading
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTPConnection to a server listening on a Unix socket
+    """
+
+    def __init__(self, socket_path):
+        super().__init__("localhost")
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._socket_path)
+
+
+class _WorkerGroup:
+    """
+    A server's place in a group of worker processes sharing one port
+
+    File descriptors only exist in the worker that opened them, so the
+    handles given to clients encode the owning worker. A request for a handle
+    owned by another worker, which happens whenever a client's connections are
+    spread over several workers, is forwarded to the owner over a Unix socket
+    that every worker listens on next to its TCP port.
+    """
+    # Request headers passed on when forwarding a request
+    _FORWARDED_HEADERS = [
+        "Content-Type", "Accept", "Accept-Encoding", "Authorization", "User-Agent"
+    ]
+
+    # Client address of forwarded requests, Unix sockets have none
+    PEER_ADDRESS = ("worker-peer", 0)
+
+    # Header carrying the address of the client a request is forwarded for,
+    # only trusted on requests from PEER_ADDRESS
+    FORWARDED_FOR_HEADER = "X-HttpFs-Forwarded-For"
+
+    def __init__(self, index=0, count=1, run_dir=None):
+        """
+        :param index: This worker's index, from 0 to count - 1
+        :param count: Number of workers in the group
+        :param run_dir: Directory holding the workers' Unix sockets
+        """
+        self._index = index
+        self._count = count
+        self._run_dir = run_dir
+        self._connections = threading.local()
+
+    def get_index(self):
+        return self._index
+
+    def get_count(self):
+        return self._count
+
+    def get_socket_path(self, index):
+        return os.path.join(self._run_dir, "worker-{}.sock".format(index))
+
+    def to_handle(self, local_id):
+        """
+        :param local_id: A file handle or cursor id from this worker's tables
+        :return: The handle to give the client for it
+        """
+        return local_id * self._count + self._index
+
+    def from_handle(self, handle):
+        """
+        :param handle: A handle returned by to_handle() in the owning worker
+        :return: The id in the owning worker's tables
+        """
+        return handle // self._count
+
+    def get_handle_owner(self, handle):
+        """
+        :param handle: A handle returned by to_handle()
+        :return: Index of the worker the handle belongs to
+        """
+        return handle % self._count
+
+    def forward(self, index, headers, body, client_host, method="POST", path="/"):
+        """
+        Sends a request to another worker and returns its response
+        :param index: The worker to send the request to
+        :param headers: The headers of the original request
+        :param body: The body of the original request
+        :param client_host: Address of the client that sent it
+        :param method: The HTTP method
+        :param path: The request path
+        :return: (status code, response headers, response body)
+        """
+        connections = getattr(self._connections, "by_index", None)
+        if connections is None:
+            connections = self._connections.by_index = dict()
+
+        forwarded_headers = {
+            k: headers[k] for k in _WorkerGroup._FORWARDED_HEADERS if k in headers
+        }
+        forwarded_headers[_WorkerGroup.FORWARDED_FOR_HEADER] = client_host
+
+        # Reconnect once if a cached connection has gone stale
+        for attempt in range(2):
+            conn = connections.get(index)
+            if conn is None:
+                conn = connections[index] = _UnixHTTPConnection(
+                    self.get_socket_path(index)
+                )
+            try:
+                conn.request(method, path, body=body, headers=forwarded_headers)
+                response = conn.getresponse()
+                return response.status, response.getheaders(), response.read()
+            except (ConnectionError, http.client.HTTPException):
+                conn.close()
+                del connections[index]
+                if attempt == 1:
+                    raise
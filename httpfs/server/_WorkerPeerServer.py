@@ -0,0 +1,31 @@
+import os
+from socketserver import ThreadingUnixStreamServer
+
+from ._HttpFsRequestHandler import _HttpFsRequestHandler
+from ._WorkerGroup import _WorkerGroup
+
+
+class _WorkerPeerServer(ThreadingUnixStreamServer):
+    """
+    Unix socket listener that receives requests forwarded by the other
+    workers in a _WorkerGroup and runs them against this worker's server
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, httpfs_server):
+        """
+        :param socket_path: Path to listen on
+        :param httpfs_server: The worker's HttpFs server, whose state
+        (open files, cred store) forwarded requests use
+        """
+        self._httpfs_server = httpfs_server
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _HttpFsRequestHandler)
+
+    def finish_request(self, request, client_address):
+        self.RequestHandlerClass(
+            request,
+            _WorkerGroup.PEER_ADDRESS,
+            self._httpfs_server
+        )
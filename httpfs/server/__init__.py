@@ -1 +1,3 @@
 from .HttpFsServer import HttpFsServer
+from .AsyncHttpFsServer import AsyncHttpFsServer
+from .HttpFsWorkers import HttpFsWorkers
@@ -1,8 +1,10 @@
 import argparse
+import functools
 import logging
 import sys
 
-from httpfs.server import HttpFsServer
+from httpfs.common import TextCredStore
+from httpfs.server import HttpFsServer, AsyncHttpFsServer, HttpFsWorkers
 
 LOG_FMT = "[%(asctime)s][%(levelname)s] %(message)s"
 DATE_FMT = "%Y-%m-%d %H:%M:%S"
@@ -31,6 +33,33 @@ parser.add_argument(
     help="JSON file with list of API keys",
     default=None
 )
+parser.add_argument(
+    "--engine",
+    help="Connection handling: a thread per connection or an asyncio loop",
+    choices=["threading", "asyncio"],
+    default="threading"
+)
+parser.add_argument(
+    "--executor-threads",
+    dest="executor_threads",
+    help="Max threads running requests at once with the asyncio engine, "
+         "or for multiplexed connections with the threading engine",
+    type=int,
+    default=32
+)
+parser.add_argument(
+    "--workers",
+    help="Number of server processes sharing the port",
+    type=int,
+    default=1
+)
+parser.add_argument(
+    "--slow-request-ms",
+    dest="slow_request_ms",
+    help="Log requests taking longer than this many milliseconds, with the "
+         "time spent in each phase",
+    type=float
+)
 parser.add_argument(
     "--verbose",
     help="Be verbose",
@@ -44,14 +73,41 @@ if args.verbose:
 
 logging.basicConfig(level=log_level, format=LOG_FMT, datefmt=DATE_FMT)
 
+slow_request_time = None
+if args.slow_request_ms is not None:
+    slow_request_time = args.slow_request_ms / 1000
+
 try:
-    server = HttpFsServer(
-        args.port,
-        args.fs_root,
-        cred_store_file=args.cred_store,
-        tls_key=args.tls_key,
-        tls_cert=args.tls_cert
-    )
+    if args.engine == "asyncio":
+        server_factory = functools.partial(
+            AsyncHttpFsServer,
+            args.port,
+            args.fs_root,
+            cred_store_file=args.cred_store,
+            tls_key=args.tls_key,
+            tls_cert=args.tls_cert,
+            executor_threads=args.executor_threads,
+            slow_request_time=slow_request_time
+        )
+    else:
+        server_factory = functools.partial(
+            HttpFsServer,
+            args.port,
+            args.fs_root,
+            cred_store_file=args.cred_store,
+            tls_key=args.tls_key,
+            tls_cert=args.tls_cert,
+            executor_threads=args.executor_threads,
+            slow_request_time=slow_request_time
+        )
+
+    if args.workers > 1:
+        # Create the cred store file once, before the workers all load it
+        if args.cred_store is not None:
+            TextCredStore(args.cred_store)
+        server = HttpFsWorkers(args.workers, server_factory)
+    else:
+        server = server_factory()
 except Exception as e:
     logging.error(e)
     sys.exit(1)
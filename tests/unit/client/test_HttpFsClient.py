@@ -1,9 +1,25 @@
-import base64
+import errno
+import http.server
+import os
+import socket
+import tempfile
+import threading
+import zlib
 import unittest.mock as mock
 from unittest.mock import MagicMock
 
+import pytest
+import requests
+from fuse import FuseOSError
+
 from httpfs.client import HttpFsClient
-from httpfs.common import HttpFsRequest, HttpFsResponse
+from httpfs.client.block_cache import BlockCache
+from httpfs.client.connection_pool import ConnectionPool
+from httpfs.client.disk_cache import DiskCache
+from httpfs.client.latency_stats import LatencyStats
+from httpfs.client.trace_recorder import TraceRecorder
+from httpfs.client.transport import HttpTransport, RequestsTransport
+from httpfs.common import HttpFsRequest, HttpFsResponse, HttpFsFrame, HttpFsEvent
 
 HOSTNAME = "test-host"
 PORT = 8080
@@ -20,6 +36,14 @@ FAKE_POST_REQ = {
     "args": FAKE_REQ_ARGS
 }
 
+def without_request_id(request_dict):
+    """
+    :return: The request dict, less the id every request gets
+    """
+    assert isinstance(request_dict.pop("id"), str)
+    return request_dict
+
+
 def test_constructor_without_ssl():
     client = HttpFsClient(
         HOSTNAME,
@@ -76,14 +100,14 @@ def test_send_request():
     # Fake POST request method
     def fake_post(server_url, **kwargs):
         assert server_url == client._server_url
-        assert kwargs["json"] == FAKE_POST_REQ
+        assert without_request_id(kwargs["json"]) == FAKE_POST_REQ
         return fake_response
 
     # Fake requests.session
     fake_session = MagicMock()
     fake_session.post = fake_post
 
-    client._http_keepalive_session = fake_session
+    client._connection_pool.get_session = MagicMock(return_value=fake_session)
     client._send_request(FAKE_REQ_TYPE, **FAKE_REQ_ARGS)
 
 
@@ -111,16 +135,147 @@ def test_send_request_with_api_key():
     def fake_post(server_url, **kwargs):
         assert server_url == client._server_url
         assert "Authorization" in kwargs["headers"] and kwargs["headers"]["Authorization"] == FAKE_API_KEY
-        assert kwargs["json"] == FAKE_POST_REQ
+        assert without_request_id(kwargs["json"]) == FAKE_POST_REQ
         return fake_response
 
     # Fake requests.session
     fake_session = MagicMock()
     fake_session.post = fake_post
 
-    client._http_keepalive_session = fake_session
+    client._connection_pool.get_session = MagicMock(return_value=fake_session)
     client._send_request(FAKE_REQ_TYPE, **FAKE_REQ_ARGS)
 
+def test_send_request_binary_frame():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None
+    )
+
+    fake_data = b"\x00raw bytes\xff"
+
+    # Fake framed response from the server
+    fake_response = MagicMock()
+    fake_response.raise_for_status = MagicMock(return_value=None)
+    fake_response.headers = {
+        "Content-Type": HttpFsFrame.CONTENT_TYPE,
+        "Server": "HttpFs"
+    }
+    fake_response.content = HttpFsFrame.pack_bytes({
+        "error_no": HttpFsResponse.ERR_NONE,
+        "response_data": {"bytes_read": fake_data}
+    })
+
+    # Fake POST request method
+    def fake_post(server_url, **kwargs):
+        assert kwargs["headers"]["Content-Type"] == HttpFsFrame.CONTENT_TYPE
+        request = HttpFsFrame.unpack(kwargs["data"])
+        assert bytes(request["args"]["data"]) == fake_data
+        return fake_response
+
+    fake_session = MagicMock()
+    fake_session.post = fake_post
+
+    client._connection_pool.get_session = MagicMock(return_value=fake_session)
+    response = client._send_request(HttpFsRequest.OP_WRITE, data=fake_data)
+    assert bytes(response.get_data()["bytes_read"]) == fake_data
+
+def test_send_request_compression():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        compression=True
+    )
+    assert "deflate" in client._connection_pool._headers["Accept-Encoding"]
+
+    # The server advertises the codings it decodes
+    fake_response = MagicMock()
+    fake_response.raise_for_status = MagicMock(return_value=None)
+    fake_response.headers = {
+        "Content-Type": "application/json",
+        "Server": "HttpFs",
+        "Accept-Encoding": "deflate"
+    }
+    fake_response.json = MagicMock(return_value={
+        "error_no": HttpFsResponse.ERR_NONE,
+        "response_data": {}
+    })
+    sent = []
+
+    def fake_post(server_url, **kwargs):
+        sent.append(kwargs)
+        return fake_response
+
+    fake_session = MagicMock()
+    fake_session.post = fake_post
+    client._connection_pool.get_session = MagicMock(return_value=fake_session)
+
+    fake_data = b"compressible text " * 1000
+    for _ in range(2):
+        client._send_request(HttpFsRequest.OP_WRITE, data=fake_data)
+
+    # Only requests after the server advertised a coding are compressed
+    assert "Content-Encoding" not in sent[0]["headers"]
+    assert sent[1]["headers"]["Content-Encoding"] == "deflate"
+    request = HttpFsFrame.unpack(zlib.decompress(sent[1]["data"]))
+    assert bytes(request["args"]["data"]) == fake_data
+
+    # Small requests aren't
+    client._send_request(FAKE_REQ_TYPE, **FAKE_REQ_ARGS)
+    assert "Content-Encoding" not in sent[2]["headers"]
+
+def test_send_request_latency_stats(caplog):
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        latency_stats=True,
+        slow_request_time=0
+    )
+
+    fake_response = MagicMock()
+    fake_response.raise_for_status = MagicMock(return_value=None)
+    fake_response.headers = {
+        "Content-Type": "application/json",
+        "Server": "HttpFs",
+        HttpFsResponse.SERVER_TIMING_HEADER:
+            "parse;dur=0.1, auth;dur=0, dispatch;dur=0.2, syscall;dur=1.5, serialize;dur=0.1"
+    }
+    fake_response.json = MagicMock(return_value={
+        "error_no": HttpFsResponse.ERR_NONE,
+        "response_data": {}
+    })
+    sent = []
+
+    def fake_post(server_url, **kwargs):
+        sent.append(kwargs["json"])
+        return fake_response
+
+    fake_session = MagicMock()
+    fake_session.post = fake_post
+    client._connection_pool.get_session = MagicMock(return_value=fake_session)
+
+    for _ in range(2):
+        client._send_request(HttpFsRequest.OP_GET_ATTR, path="/")
+
+    # Requests get unique ids and ask for the server's timings
+    assert sent[0]["id"] != sent[1]["id"]
+    assert sent[0]["timing"]
+
+    breakdown = client.get_latency_stats().get_breakdown()["getattr"]
+    assert breakdown["count"] == 2
+    assert breakdown["phases"]["server_syscall"] == pytest.approx(0.0015)
+    assert set(LatencyStats.CLIENT_PHASES) <= set(breakdown["phases"])
+    assert "getattr count=2" in client.get_latency_stats().format_breakdown()
+
+    # Every request is slower than 0s
+    slow_logs = [r.getMessage() for r in caplog.records if "Slow getattr" in r.getMessage()]
+    assert len(slow_logs) == 2
+    assert sent[1]["id"] in slow_logs[1]
+    assert "server_syscall 1.50ms" in slow_logs[1]
+
+
 def test_access():
     client = HttpFsClient(
         HOSTNAME,
@@ -267,6 +422,73 @@ def test_getattr():
     client._send_request = fake_send_request
     client.getattr(fake_path)
 
+def test_getattr_cache():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None
+    )
+
+    fake_attrs = {"st_size": 1}
+    sent_paths = []
+
+    # Fake _send_request, /missing doesn't exist
+    def fake_send_request(request_type, **kwargs):
+        if request_type == HttpFsRequest.OP_GET_ATTR:
+            sent_paths.append(kwargs["path"])
+            if kwargs["path"] == "/missing":
+                return HttpFsResponse(errno.ENOENT, {"message": "Not found"})
+            return HttpFsResponse(response_data=fake_attrs)
+        return HttpFsResponse(response_data={"bytes_written": 1})
+
+    client._send_request = fake_send_request
+
+    # Hits and negative hits don't reach the server
+    assert client.getattr("/dir/file") == fake_attrs
+    assert client.getattr("/dir/file") == fake_attrs
+    for _ in range(2):
+        with pytest.raises(FuseOSError):
+            client.getattr("/missing")
+    assert sent_paths == ["/dir/file", "/missing"]
+
+    # Writes invalidate the written path only
+    client.getattr("/dir")
+    client.write("/dir/file", b"x", 0, fh=1)
+    client.getattr("/dir/file")
+    client.getattr("/dir")
+    assert sent_paths == ["/dir/file", "/missing", "/dir", "/dir/file"]
+
+    # Renaming a directory invalidates everything below it
+    client.rename("/dir", "/dir2")
+    client.getattr("/dir/file")
+    assert sent_paths[-1] == "/dir/file"
+
+    # Creating a path drops its negative entry
+    client.mkdir("/missing", 0o755)
+    with pytest.raises(FuseOSError):
+        client.getattr("/missing")
+    assert sent_paths[-1] == "/missing"
+
+def test_getattr_cache_disabled():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        attr_timeout=0,
+        negative_timeout=0
+    )
+
+    sent_paths = []
+
+    def fake_send_request(request_type, **kwargs):
+        sent_paths.append(kwargs["path"])
+        return HttpFsResponse(response_data={})
+
+    client._send_request = fake_send_request
+    client.getattr("/file")
+    client.getattr("/file")
+    assert sent_paths == ["/file", "/file"]
+
 def test_link():
     client = HttpFsClient(
         HOSTNAME,
@@ -353,10 +575,12 @@ def test_open():
     client.open(fake_path, fake_flags)
 
 def test_read():
+    # Without the block cache reads are sent as they are
     client = HttpFsClient(
         HOSTNAME,
         PORT,
-        ca_file=None
+        ca_file=None,
+        block_cache_size=0
     )
 
     fake_path = "/some/path"
@@ -379,6 +603,299 @@ def test_read():
     client._send_request = fake_send_request
     client.read(fake_path, fake_size, fake_offset, fh=fake_fd)
 
+def test_read_ahead():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        max_read_ahead=1024**2
+    )
+
+    block_size = 128 * 1024
+    file_data = bytes(range(256)) * (10 * block_size // 256)
+    sent_reads = []
+
+    # Fake _send_request serving file_data
+    def fake_send_request(request_type, **kwargs):
+        if request_type == HttpFsRequest.OP_READ:
+            sent_reads.append((kwargs["offset"], kwargs["size"]))
+            end = kwargs["offset"] + kwargs["size"]
+            return HttpFsResponse(
+                response_data={"bytes_read": file_data[kwargs["offset"]:end]}
+            )
+        return HttpFsResponse(response_data={"bytes_written": 1})
+
+    client._send_request = fake_send_request
+
+    # Sequential reads are served from blocks fetched ahead of the reader
+    read_data = b""
+    while True:
+        chunk = client.read("/file", block_size, len(read_data), fh=1)
+        if not chunk:
+            break
+        read_data += chunk
+    assert read_data == file_data
+    assert len(sent_reads) < 10
+
+    # Unaligned reads span blocks
+    assert client.read("/file", 100, block_size - 50, fh=1) == \
+        file_data[block_size - 50:block_size + 50]
+
+    # Local writes drop the cached blocks
+    sent_reads.clear()
+    client.write("/file", b"x", 0, fh=1)
+    client.read("/file", 10, 0, fh=2)
+    assert sent_reads[0] == (0, block_size)
+
+    client.release("/file", fh=1)
+    client.release("/file", fh=2)
+
+def test_compound_fallback():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None
+    )
+
+    sent_requests = []
+
+    # Fake _send_request of a server without OP_COMPOUND
+    def fake_send_request(request_type, **kwargs):
+        sent_requests.append((request_type, kwargs))
+        if request_type == HttpFsRequest.OP_COMPOUND:
+            raise FuseOSError(errno.ENOSYS)
+        if request_type == HttpFsRequest.OP_OPEN:
+            return HttpFsResponse(response_data={"file_descriptor": 7})
+        if request_type == HttpFsRequest.OP_RELEASE:
+            return HttpFsResponse()
+        return HttpFsResponse(errno.EIO, {"message": "Failed"})
+
+    client._send_request = fake_send_request
+    responses = client.compound([
+        (HttpFsRequest.OP_OPEN, {"path": "/file"}),
+        (HttpFsRequest.OP_READ, {"file_descriptor": HttpFsRequest.ref(0)}),
+        (HttpFsRequest.OP_RELEASE, {"file_descriptor": HttpFsRequest.ref(0)})
+    ])
+
+    # The requests are sent one by one, with references resolved. The
+    # release still runs after the read failed.
+    assert [r.get_error_no() for r in responses] == [0, errno.EIO, 0]
+    assert sent_requests[2] == (HttpFsRequest.OP_READ, {"file_descriptor": 7})
+    assert sent_requests[3] == (HttpFsRequest.OP_RELEASE, {"file_descriptor": 7})
+    assert len(sent_requests) == 4
+    assert not client._compound
+
+    # References to steps that didn't run yet are canceled like failed steps
+    responses = client.compound([
+        (HttpFsRequest.OP_READ, {"file_descriptor": HttpFsRequest.ref(1)}),
+        (HttpFsRequest.OP_OPEN, {"path": "/file"})
+    ], stop_on_error=False)
+    assert [r.get_error_no() for r in responses] == [errno.ECANCELED, 0]
+
+
+def test_open_small_file():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None
+    )
+
+    file_data = b"small file"
+    sent_requests = []
+
+    # Fake _send_request running compound requests
+    def fake_send_request(request_type, **kwargs):
+        sent_requests.append(request_type)
+        if request_type == HttpFsRequest.OP_GET_ATTR:
+            return HttpFsResponse(response_data={
+                "st_mode": 0o100644, "st_size": len(file_data)
+            })
+        assert request_type == HttpFsRequest.OP_COMPOUND
+        open_request, read_request = kwargs["requests"]
+        assert read_request["args"]["file_descriptor"] == HttpFsRequest.ref(0)
+        return HttpFsResponse(response_data={"responses": [
+            HttpFsResponse(response_data={"file_descriptor": 3}).as_dict(),
+            HttpFsResponse(response_data={"bytes_read": file_data}).as_dict()
+        ]})
+
+    client._send_request = fake_send_request
+    client.getattr("/file")
+    fh = client.open("/file", os.O_RDONLY)
+
+    # Opening read the file, so reading it doesn't send a request
+    assert fh == 3
+    assert client.read("/file", 4096, 0, fh) == file_data
+    assert sent_requests == [HttpFsRequest.OP_GET_ATTR, HttpFsRequest.OP_COMPOUND]
+
+
+def test_invalidation_events():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        attr_timeout=3600,
+        invalidation_events=True
+    )
+    listener = client._invalidation_listener
+
+    file_data = b"small file"
+    sent_requests = []
+
+    def fake_send_request(request_type, **kwargs):
+        sent_requests.append(request_type)
+        if request_type == HttpFsRequest.OP_GET_ATTR:
+            return HttpFsResponse(response_data={
+                "st_mode": 0o100644, "st_size": len(file_data)
+            })
+        if request_type == HttpFsRequest.OP_OPEN:
+            return HttpFsResponse(response_data={"file_descriptor": 4})
+        return HttpFsResponse(response_data={"responses": [
+            HttpFsResponse(response_data={"file_descriptor": 3}).as_dict(),
+            HttpFsResponse(response_data={"bytes_read": file_data}).as_dict()
+        ]})
+
+    client._send_request = fake_send_request
+
+    # Polls report the changes of other clients
+    poll_responses = [
+        {"log": "l1", "next": 0, "reset": False, "events": []},
+        {"log": "l1", "next": 1, "reset": False, "events": [
+            {"path": "/file", "change": HttpFsEvent.DATA}
+        ]}
+    ]
+    listener._session.get = MagicMock(side_effect=[
+        MagicMock(status_code=200, json=MagicMock(return_value=r)) for r in poll_responses
+    ])
+    assert not client._has_live_events()
+    assert listener._poll()
+    assert client._has_live_events()
+
+    # While events arrive, reopening a file keeps its cached data
+    for _ in range(2):
+        client.getattr("/file")
+        fh = client.open("/file", os.O_RDONLY)
+        assert client.read("/file", 4096, 0, fh) == file_data
+    assert sent_requests == [
+        HttpFsRequest.OP_GET_ATTR, HttpFsRequest.OP_COMPOUND, HttpFsRequest.OP_OPEN
+    ]
+
+    # A change drops the file's attributes and data
+    assert listener._poll()
+    assert listener._params == {
+        "path": "/", "timeout": 30, "origin": client._request_id_prefix,
+        "log": "l1", "since": 1
+    }
+    client.getattr("/file")
+    client.open("/file", os.O_RDONLY)
+    assert sent_requests[3:] == [HttpFsRequest.OP_GET_ATTR, HttpFsRequest.OP_COMPOUND]
+
+    # Older servers don't have the endpoint
+    listener._session.get = MagicMock(return_value=MagicMock(status_code=400))
+    assert not listener._poll()
+
+    client._on_events_lost()
+    assert client._attr_cache.get("/file") == (False, None)
+
+
+def test_BlockCache():
+    block_cache = BlockCache(max_bytes=8, block_size=4)
+
+    token = block_cache.begin_fetch("/a")
+    for index in range(3):
+        block_cache.put(token, index, b"abcd")
+    block_cache.end_fetch(token)
+
+    # Over the memory cap, the least recently used block is evicted
+    assert block_cache.get("/a", 0) is None
+    assert block_cache.get("/a", 1) == b"abcd"
+    assert block_cache.get("/a", 2) == b"abcd"
+
+    # Fetches racing an invalidation don't cache stale data
+    token = block_cache.begin_fetch("/a")
+    block_cache.invalidate("/a")
+    block_cache.put(token, 0, b"old!")
+    block_cache.end_fetch(token)
+    assert block_cache.get("/a", 0) is None
+    assert block_cache.get("/a", 1) is None
+
+def test_DiskCache():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        disk_cache = DiskCache(cache_dir, max_bytes=12, block_size=4)
+        with pytest.raises(OSError) as error:
+            DiskCache(cache_dir, max_bytes=12, block_size=4)
+        assert error.value.errno == errno.EBUSY
+
+        # Blocks are only cached and served for validated paths
+        disk_cache.put("/a", None, 0, b"abcd")
+        disk_cache.validate("/a", 1.5, 10)
+        version = disk_cache.get_version("/a")
+        for index in range(3):
+            disk_cache.put("/a", version, index, b"abcd"[:4 - index])
+        assert disk_cache.get("/a", 1) == b"abc"
+        assert disk_cache.get_cached_bytes() == 9
+
+        # Over the quota, the least recently used block is evicted
+        disk_cache.validate("/b", 2.5, 4)
+        disk_cache.put("/b", disk_cache.get_version("/b"), 0, b"wxyz")
+        assert not disk_cache.contains("/a", 0)
+        assert disk_cache.contains("/a", 1)
+        disk_cache.forget("/b")
+        assert disk_cache.get("/b", 0) is None
+        disk_cache.close()
+
+        # Blocks survive a remount, as long as the file didn't change
+        disk_cache = DiskCache(cache_dir, max_bytes=12, block_size=4)
+        assert disk_cache.get("/a", 1) is None
+        disk_cache.validate("/a", 1.5, 10)
+        disk_cache.validate("/b", 3.5, 4)
+        assert disk_cache.get("/a", 1) == b"abc"
+        assert disk_cache.get("/a", 2) == b"ab"
+        assert disk_cache.get("/b", 0) is None
+        assert disk_cache.get_cached_bytes() == 5
+
+        # Data read before the file changed isn't cached
+        version = disk_cache.get_version("/a")
+        disk_cache.invalidate("/a")
+        disk_cache.validate("/a", 4.5, 10)
+        disk_cache.put("/a", version, 0, b"old!")
+        assert disk_cache.get("/a", 0) is None
+        assert disk_cache.get_cached_bytes() == 0
+        disk_cache.close()
+
+        # A different block size empties the cache
+        disk_cache = DiskCache(cache_dir, max_bytes=12, block_size=2)
+        assert disk_cache.get_cached_bytes() == 0
+        disk_cache.close()
+
+
+def test_BlockCache_with_DiskCache():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        disk_cache = DiskCache(cache_dir, max_bytes=16, block_size=4)
+        block_cache = BlockCache(max_bytes=4, block_size=4, disk_cache=disk_cache)
+        disk_cache.validate("/a", 1.0, 8)
+
+        token = block_cache.begin_fetch("/a")
+        block_cache.put(token, 0, b"abcd")
+        block_cache.put(token, 1, b"efgh")
+        block_cache.end_fetch(token)
+
+        # Evicted from memory, read back from disk
+        assert block_cache.contains("/a", 0)
+        assert block_cache.get("/a", 0) == b"abcd"
+
+        # Reopening keeps the blocks on disk until they're revalidated
+        block_cache.invalidate("/a", changed=False)
+        assert not block_cache.contains("/a", 1)
+        disk_cache.validate("/a", 1.0, 8)
+        assert block_cache.get("/a", 1) == b"efgh"
+
+        # Changing the file drops them
+        block_cache.invalidate("/a")
+        disk_cache.validate("/a", 1.0, 8)
+        assert block_cache.get("/a", 1) is None
+        disk_cache.close()
+
+
 def test_readdir():
     client = HttpFsClient(
         HOSTNAME,
@@ -392,7 +909,7 @@ def test_readdir():
     def fake_send_request(request_type, **kwargs):
         for arg in ["uid", "gid"]:
             assert arg in kwargs.keys()
-        assert request_type == HttpFsRequest.OP_READDIR
+        assert request_type == HttpFsRequest.OP_READDIR_PLUS
         assert kwargs["path"] == fake_path
         resp = HttpFsResponse()
         resp._response_data["dir_listing"] = list()
@@ -401,6 +918,82 @@ def test_readdir():
     client._send_request = fake_send_request
     client.readdir(fake_path)
 
+def test_readdir_plus_fills_attr_cache():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None
+    )
+
+    fake_attrs = {"st_size": 1}
+    sent_types = []
+
+    def fake_send_request(request_type, **kwargs):
+        sent_types.append(request_type)
+        return HttpFsResponse(response_data={
+            "dir_listing": [".", "..", "file"],
+            "dir_attrs": {"file": fake_attrs}
+        })
+
+    client._send_request = fake_send_request
+    assert list(client.readdir("/dir/")) == [".", "..", "file"]
+    assert client.getattr("/dir/file") == fake_attrs
+    assert sent_types == [HttpFsRequest.OP_READDIR_PLUS]
+
+def test_readdir_pages():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        readdir_page_size=2
+    )
+
+    pages = {
+        None: {"dir_listing": [".", "..", "a", "b"], "cursor": 7},
+        7: {"dir_listing": ["c", "d"], "cursor": 9},
+        9: {"dir_listing": [], "cursor": None}
+    }
+    sent_cursors = []
+
+    def fake_send_request(request_type, **kwargs):
+        assert kwargs["page_size"] == 2
+        assert "uid" in kwargs
+        sent_cursors.append(kwargs.get("cursor"))
+        return HttpFsResponse(response_data=pages[kwargs.get("cursor")])
+
+    client._send_request = fake_send_request
+    dir_entries = client.readdir("/")
+
+    # Only the first page is fetched until the entries are iterated
+    assert sent_cursors == [None]
+    assert list(dir_entries) == [".", "..", "a", "b", "c", "d"]
+    assert sent_cursors == [None, 7, 9]
+
+def test_readdir_plus_fallback():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None
+    )
+
+    sent_types = []
+
+    # Fake _send_request for a server without READDIR_PLUS
+    def fake_send_request(request_type, **kwargs):
+        sent_types.append(request_type)
+        if request_type == HttpFsRequest.OP_READDIR_PLUS:
+            raise FuseOSError(errno.ENOSYS)
+        return HttpFsResponse(response_data={"dir_listing": [".", ".."]})
+
+    client._send_request = fake_send_request
+    assert list(client.readdir("/")) == [".", ".."]
+    assert list(client.readdir("/")) == [".", ".."]
+    assert sent_types == [
+        HttpFsRequest.OP_READDIR_PLUS,
+        HttpFsRequest.OP_READDIR,
+        HttpFsRequest.OP_READDIR
+    ]
+
 def test_readlink():
     client = HttpFsClient(
         HOSTNAME,
@@ -598,7 +1191,7 @@ def test_write():
             assert arg in kwargs.keys()
         assert request_type == HttpFsRequest.OP_WRITE
         assert kwargs["file_descriptor"] == fake_fd
-        assert kwargs["data"] == base64.standard_b64encode(fake_data).decode("utf-8")
+        assert kwargs["data"] == fake_data
         assert kwargs["offset"] == fake_offset
         resp = HttpFsResponse()
         resp._response_data["bytes_written"] = 10
@@ -606,3 +1199,260 @@ def test_write():
 
     client._send_request = fake_send_request
     client.write(fake_path, fake_data, fake_offset, fh=fake_fd)
+
+def test_write_back():
+    client = HttpFsClient(
+        HOSTNAME,
+        PORT,
+        ca_file=None,
+        write_buffer_size=1024,
+        write_flush_interval=60
+    )
+
+    sent_writes = []
+
+    # Fake _send_request, writes at offset 4096 fail
+    def fake_send_request(request_type, **kwargs):
+        if request_type == HttpFsRequest.OP_WRITE:
+            sent_writes.append((kwargs["offset"], bytes(kwargs["data"])))
+            if kwargs["offset"] == 4096:
+                return HttpFsResponse(errno.ENOSPC, {"message": "No space"})
+            return HttpFsResponse(
+                response_data={"bytes_written": len(kwargs["data"])}
+            )
+        return HttpFsResponse(response_data={"st_size": 0})
+
+    client._send_request = fake_send_request
+
+    # Contiguous writes are sent together on flush
+    for i in range(10):
+        assert client.write("/file", b"0123456789", i * 10, fh=1) == 10
+    assert sent_writes == []
+    client.flush("/file", fh=1)
+    assert sent_writes == [(0, b"0123456789" * 10)]
+
+    # A full buffer or a non-contiguous write sends the buffer
+    sent_writes.clear()
+    client.write("/file", b"x" * 1024, 0, fh=1)
+    client.write("/file", b"a", 2000, fh=1)
+    client.write("/file", b"b", 3000, fh=1)
+    assert sent_writes == [(0, b"x" * 1024), (2000, b"a")]
+
+    # getattr sees buffered writes
+    client.getattr("/file")
+    assert sent_writes[-1] == (3000, b"b")
+
+    # Errors of buffered writes are reported by the next flush
+    client.write("/file", b"c", 4096, fh=1)
+    client.write("/file", b"d", 5000, fh=1)
+    with pytest.raises(FuseOSError) as error_info:
+        client.flush("/file", fh=1)
+    assert error_info.value.errno == errno.ENOSPC
+    client.flush("/file", fh=1)
+
+    client.write("/file", b"c", 4096, fh=1)
+    with pytest.raises(FuseOSError):
+        client.release("/file", fh=1)
+
+def test_TraceRecorder():
+    with tempfile.TemporaryDirectory() as trace_dir:
+        trace_file = os.path.join(trace_dir, "test.trace")
+        client = HttpFsClient(HOSTNAME, PORT, trace_file=trace_file)
+        client.open = MagicMock(return_value=7)
+        client.read = MagicMock(return_value=b"12345")
+        client.readdir = MagicMock(return_value=iter([".", "..", "file"]))
+        client.getattr = MagicMock(side_effect=FuseOSError(errno.ENOENT))
+        client.rename = MagicMock(return_value=None)
+
+        assert client("open", "/file", os.O_RDONLY) == 7
+        assert client("read", "/file", 4096, 8192, 7) == b"12345"
+        assert client("readdir", "/", 0) == [".", "..", "file"]
+        with pytest.raises(FuseOSError):
+            client("getattr", "/missing")
+        client("rename", "/file", "/renamed")
+        client.destroy("/")
+
+        _, records = TraceRecorder.read_trace(trace_file)
+
+    assert [record.op for record in records] == [
+        "open", "read", "readdir", "getattr", "rename"
+    ]
+    open_record, read_record, readdir_record, getattr_record, rename_record = records
+    assert open_record.fh == 7 and open_record.size == os.O_RDONLY
+    assert read_record.path_hash == open_record.path_hash == TraceRecorder.hash_path("/file")
+    assert (read_record.fh, read_record.offset, read_record.size) == (7, 8192, 4096)
+    assert readdir_record.size == 3
+    assert getattr_record.errno == errno.ENOENT
+    assert rename_record.offset == TraceRecorder.hash_path("/renamed")
+    assert all(
+        earlier.time <= later.time for earlier, later in zip(records, records[1:])
+    )
+
+
+def test_ConnectionPool():
+    connection_pool = ConnectionPool(4, {"User-Agent": "test"})
+
+    # Each thread has its own session, all sharing one adapter
+    main_session = connection_pool.get_session()
+    assert connection_pool.get_session() is main_session
+    assert main_session.headers["User-Agent"] == "test"
+
+    thread_sessions = []
+    thread = threading.Thread(
+        target=lambda: thread_sessions.append(connection_pool.get_session())
+    )
+    thread.start()
+    thread.join()
+    assert thread_sessions[0] is not main_session
+    assert thread_sessions[0].get_adapter(EXPECTED_URL) is \
+        main_session.get_adapter(EXPECTED_URL)
+
+def test_RequestsTransport_doesnt_resend():
+    connection_pool = MagicMock()
+    session = connection_pool.get_session.return_value
+    session.post.side_effect = requests.exceptions.ConnectionError("reset")
+    transport = RequestsTransport(EXPECTED_URL, connection_pool)
+
+    # The server may have run the request before the connection dropped
+    with pytest.raises(requests.exceptions.ConnectionError):
+        transport.post({}, json_dict=FAKE_POST_REQ)
+    session.post.assert_called_once()
+
+def test_error_responses_release_connections():
+    class _RejectingHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = b"Unauthorized"
+            self.send_response(401)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RejectingHandler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        client = HttpFsClient(
+            "127.0.0.1",
+            server.server_address[1],
+            ca_file=None,
+            api_key="wrong-key",
+            max_connections=2
+        )
+        errors = []
+
+        # More error responses than the pool has connections
+        def send_requests():
+            for _ in range(5):
+                with pytest.raises(FuseOSError) as fuse_error:
+                    client._send_request(FAKE_REQ_TYPE, **FAKE_REQ_ARGS)
+                errors.append(fuse_error.value.errno)
+
+        request_thread = threading.Thread(target=send_requests, daemon=True)
+        request_thread.start()
+        request_thread.join(timeout=10)
+        assert not request_thread.is_alive()
+        assert errors == [errno.EACCES] * 5
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_HttpTransport():
+    with socket.socket() as server_sock:
+        server_sock.bind(("127.0.0.1", 0))
+        server_sock.listen()
+        port = server_sock.getsockname()[1]
+        received = []
+
+        # Answers two requests on one connection, then closes it
+        def serve():
+            conn, _ = server_sock.accept()
+            with conn:
+                for _ in range(2):
+                    received.append(conn.recv(65536))
+                    body = b'{"error_no": 0, "response_data": {}}'
+                    conn.sendall(
+                        b"HTTP/1.1 200 OK\r\nServer: HttpFs/0.1\r\n"
+                        b"Content-Type: application/json\r\n"
+                        b"Content-Length: " + str(len(body)).encode() +
+                        b"\r\n\r\n" + body
+                    )
+            conn, _ = server_sock.accept()
+            with conn:
+                received.append(conn.recv(65536))
+                conn.sendall(
+                    b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n"
+                )
+
+        server_thread = threading.Thread(target=serve)
+        server_thread.start()
+
+        transport = HttpTransport("127.0.0.1", port, {"User-Agent": "test"})
+        for _ in range(2):
+            response = transport.post({"Authorization": "key"}, json_dict={"a": 1})
+            assert response.status_code == 200
+            assert response.headers.get("Content-Type") == "application/json"
+            assert response.json() == {"error_no": 0, "response_data": {}}
+
+        # The closed keep-alive connection is replaced
+        response = transport.post({}, data=b"raw")
+        assert response.status_code == 400
+        server_thread.join()
+
+    assert received[0].startswith(b"POST / HTTP/1.1\r\n")
+    assert b"User-Agent: test\r\n" in received[0]
+    assert b"Authorization: key\r\n" in received[0]
+    assert received[0].endswith(b'\r\n\r\n{"a":1}')
+
+
+def test_HttpTransport_retries():
+    ok_response = (
+        b"HTTP/1.1 200 OK\r\nServer: HttpFs/0.1\r\n"
+        b"Content-Type: application/json\r\nContent-Length: 2\r\n\r\n{}"
+    )
+    with socket.socket() as server_sock:
+        server_sock.bind(("127.0.0.1", 0))
+        server_sock.listen()
+        port = server_sock.getsockname()[1]
+        received = []
+
+        def serve():
+            # Closes the reused connection without answering, the request
+            # is resent on a new connection
+            conn, _ = server_sock.accept()
+            with conn:
+                received.append(conn.recv(65536))
+                conn.sendall(ok_response)
+                received.append(conn.recv(65536))
+            conn, _ = server_sock.accept()
+            with conn:
+                received.append(conn.recv(65536))
+                conn.sendall(ok_response)
+                # Drops the connection in the middle of the response, after
+                # the request ran
+                received.append(conn.recv(65536))
+                conn.sendall(ok_response[:-1])
+            server_sock.settimeout(1)
+            try:
+                server_sock.accept()[0].close()
+                received.append(b"resent")
+            except socket.timeout:
+                pass
+
+        server_thread = threading.Thread(target=serve)
+        server_thread.start()
+
+        transport = HttpTransport("127.0.0.1", port, {"User-Agent": "test"})
+        for _ in range(2):
+            assert transport.post({}, json_dict={"a": 1}).status_code == 200
+        with pytest.raises(ConnectionResetError):
+            transport.post({}, json_dict={"a": 1})
+        server_thread.join()
+
+    assert len(received) == 4
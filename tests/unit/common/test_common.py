@@ -1,5 +1,8 @@
 import os
-from httpfs.common import TextCredStore
+from httpfs.common import (
+    TextCredStore, HttpFsFrame, HttpFsRequest, HttpFsResponse, HttpFsCompression,
+    HttpFsEvent
+)
 
 TEST_FILE = "test-file.json"
 
@@ -13,3 +16,110 @@ def test_TextCredStore():
     assert key in repo._key_set
 
     os.remove(TEST_FILE)
+
+def test_HttpFsFrame():
+    request = HttpFsRequest(
+        HttpFsRequest.OP_WRITE,
+        {"file_descriptor": 3, "offset": 0, "data": b"\x00\x01binary\xff"}
+    )
+
+    frame = HttpFsFrame.pack_bytes(request.as_dict())
+    assert b"binary" in frame
+
+    unpacked = HttpFsRequest.from_dict(HttpFsFrame.unpack(frame))
+    assert unpacked.get_type() == HttpFsRequest.OP_WRITE
+    assert unpacked.get_args()["file_descriptor"] == 3
+    assert bytes(unpacked.get_args()["data"]) == b"\x00\x01binary\xff"
+
+    # Dicts without bytes are just a JSON header
+    response = HttpFsResponse(response_data={"bytes_written": 10})
+    assert HttpFsFrame.unpack(HttpFsFrame.pack_bytes(response.as_dict())) == response.as_dict()
+
+    # Payloads can be copied out so the frame buffer can be reused
+    frame_buffer = bytearray(frame)
+    unpacked = HttpFsFrame.unpack(frame_buffer, copy_payloads=True)
+    frame_buffer[:] = bytes(len(frame_buffer))
+    assert unpacked["args"]["data"] == b"\x00\x01binary\xff"
+
+def test_HttpFsCompression():
+    assert "deflate" in HttpFsCompression.get_codings()
+    assert HttpFsCompression.choose("gzip, deflate;q=0.5") == "deflate"
+    assert HttpFsCompression.choose("deflate;q=0") is None
+    assert HttpFsCompression.choose("identity") is None
+    assert HttpFsCompression.choose(None) is None
+
+    text = b"some text that repeats, " * 100
+    compressed = HttpFsCompression.compress("deflate", text)
+    assert len(compressed) < len(text) // 5
+    assert HttpFsCompression.decompress("deflate", compressed) == text
+
+    # Small and random bodies aren't worth compressing
+    assert HttpFsCompression.is_compressible(len(text), text)
+    assert not HttpFsCompression.is_compressible(100, text[:100])
+    random_data = os.urandom(4096)
+    assert not HttpFsCompression.is_compressible(len(random_data), random_data)
+
+    # Decompression stops past max_size
+    assert HttpFsCompression.decompress("deflate", compressed, len(text)) == text
+    try:
+        HttpFsCompression.decompress("deflate", compressed, len(text) - 1)
+        assert False
+    except ValueError:
+        pass
+
+    for coding, data in [
+        ("deflate", b"not deflate"), ("deflate", compressed[:-10]), ("unknown", text)
+    ]:
+        try:
+            HttpFsCompression.decompress(coding, data)
+            assert False
+        except ValueError:
+            pass
+
+def test_HttpFsRequest_id():
+    request = HttpFsRequest(
+        HttpFsRequest.OP_GET_ATTR, {"path": "/"}, request_id="ab12-7", timing=True
+    )
+    parsed = HttpFsRequest.from_dict(request.as_dict())
+    assert parsed.get_request_id() == "ab12-7"
+    assert parsed.is_timing_requested()
+
+    # Both are optional, and left out of the dict when unset
+    plain = HttpFsRequest(HttpFsRequest.OP_GET_ATTR, {"path": "/"})
+    assert set(plain.as_dict()) == {"type", "args"}
+    parsed = HttpFsRequest.from_dict(plain.as_dict())
+    assert parsed.get_request_id() is None
+    assert not parsed.is_timing_requested()
+
+    try:
+        HttpFsRequest.from_dict(dict(plain.as_dict(), id=7))
+        assert False
+    except ValueError:
+        pass
+
+def test_HttpFsRequest_op_names():
+    op_names = [
+        HttpFsRequest.get_op_name(value)
+        for name, value in vars(HttpFsRequest).items()
+        if name.startswith("OP_")
+    ]
+    assert len(set(op_names)) == len(op_names)
+    assert HttpFsRequest.get_op_name(HttpFsRequest.OP_RM_DIR) == "rmdir"
+    assert HttpFsRequest.get_op_name(99) == "99"
+
+def test_HttpFsEvent():
+    event = HttpFsEvent.from_dict(HttpFsEvent("/a/b", HttpFsEvent.DATA).as_dict())
+    assert (event.get_path(), event.get_change()) == ("/a/b", HttpFsEvent.DATA)
+    assert event.is_below("/") and event.is_below("/a") and event.is_below("/a/b")
+    assert not event.is_below("/a/bc") and not event.is_below("/a/b/c")
+
+    # Renaming a directory changes the paths below it
+    assert HttpFsEvent("/a", HttpFsEvent.TREE).is_below("/a/b/c")
+    assert not HttpFsEvent("/a", HttpFsEvent.ENTRY).is_below("/a/b")
+
+    for invalid in [{"path": "/a"}, {"path": "/a", "change": "moved"}]:
+        try:
+            HttpFsEvent.from_dict(invalid)
+            assert False
+        except ValueError:
+            pass
@@ -0,0 +1,1035 @@
+import errno
+import http.client
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from unittest import mock
+from unittest.mock import MagicMock
+
+from httpfs.client.transport import MuxTransport
+from httpfs.common import HttpFsRequest, HttpFsResponse, HttpFsEvent, HttpFsFrame
+from httpfs.common import HttpFsCompression
+from httpfs.common.credentials import TextCredStore
+from httpfs.server import AsyncHttpFsServer, HttpFsServer
+from httpfs.server._DirCursorTable import _DirCursorTable
+from httpfs.server._FileHandleTable import _FileHandleTable, _OpenFile
+from httpfs.server._FileRegion import _FileRegion
+from httpfs.server._FileLockTable import _FileLockTable
+from httpfs.server._InvalidationLog import _InvalidationLog
+from httpfs.server._JSONRequestHandler import _JSONRequestHandler
+from httpfs.server._PermissionCache import _PermissionCache
+from httpfs.server._RequestTimer import _RequestTimer
+from httpfs.server._ServerMetrics import _ServerMetrics
+from httpfs.server._HttpFsRequestHandler import _HttpFsRequestHandler
+from httpfs.server._WorkerGroup import _WorkerGroup
+
+
+def test_FileLockTable():
+    lock_table = _FileLockTable()
+
+    with tempfile.NamedTemporaryFile() as tmp_file:
+        append_fd_1 = os.open(tmp_file.name, os.O_WRONLY | os.O_APPEND)
+        append_fd_2 = os.open(tmp_file.name, os.O_WRONLY | os.O_APPEND)
+        positional_fd = os.open(tmp_file.name, os.O_WRONLY)
+
+        for fd, flags in [
+            (append_fd_1, os.O_WRONLY | os.O_APPEND),
+            (append_fd_2, os.O_WRONLY | os.O_APPEND),
+            (positional_fd, os.O_WRONLY)
+        ]:
+            lock_table.track(fd, flags)
+
+        # Positional I/O needs no lock, O_APPEND fds share one per file
+        assert lock_table.get_lock(positional_fd) is None
+        assert lock_table.get_lock(append_fd_1) is not None
+        assert lock_table.get_lock(append_fd_1) is lock_table.get_lock(append_fd_2)
+
+        for fd in [append_fd_1, append_fd_2, positional_fd]:
+            lock_table.untrack(fd)
+            os.close(fd)
+
+        assert lock_table.get_lock(append_fd_1) is None
+        assert not lock_table._file_locks
+
+
+def test_register_op():
+    CUSTOM_OP = 1000
+
+    class _CustomRequestHandler(_HttpFsRequestHandler):
+        # pylint: disable=super-init-not-called
+        def __init__(self):
+            self.client_address = ("127.0.0.1", 0)
+            self.server = MagicMock()
+            self.server.get_worker_group.return_value = _WorkerGroup()
+            self.server.get_slow_request_time.return_value = None
+            self._timer = _RequestTimer()
+            self.sent = []
+
+        def send_httpfs_response(self, response_obj):
+            self.sent.append(response_obj)
+
+    def on_custom(request_handler, httpfs_request_args):
+        return HttpFsResponse(response_data={"echo": httpfs_request_args["value"]})
+
+    _CustomRequestHandler.register_op(CUSTOM_OP, "custom", on_custom)
+
+    request_handler = _CustomRequestHandler()
+    request_handler._delegate_request(HttpFsRequest(CUSTOM_OP, {"value": 42}))
+    assert request_handler.sent[0].get_data() == {"echo": 42}
+
+    # Built-in ops are still registered, the parent class is untouched
+    assert HttpFsRequest.OP_WRITE in _CustomRequestHandler._op_handlers
+    assert CUSTOM_OP not in _HttpFsRequestHandler._op_handlers
+
+
+def test_AsyncHttpFsServer():
+    with tempfile.TemporaryDirectory() as fs_root:
+        server = AsyncHttpFsServer(0, fs_root)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+            request = HttpFsRequest(HttpFsRequest.OP_GET_ATTR, {"path": "/"})
+
+            # Two requests on one keep-alive connection
+            for _ in range(2):
+                conn.request(
+                    "POST",
+                    "/",
+                    body=json.dumps(request.as_dict()),
+                    headers={
+                        "Content-Type": "application/json",
+                        "User-Agent": "HttpFsClient/test"
+                    }
+                )
+                response = conn.getresponse()
+                assert response.status == 200
+                response_obj = HttpFsResponse.from_dict(json.loads(response.read()))
+                assert not response_obj.is_error()
+                assert stat.S_ISDIR(response_obj.get_data()["st_mode"])
+
+            # Requests can ask for the time spent in each phase
+            request = HttpFsRequest(
+                HttpFsRequest.OP_GET_ATTR, {"path": "/"}, request_id="c0ffee-1", timing=True
+            )
+            conn.request(
+                "POST",
+                "/",
+                body=json.dumps(request.as_dict()),
+                headers={"Content-Type": "application/json", "User-Agent": "HttpFsClient/test"}
+            )
+            response = conn.getresponse()
+            response.read()
+            assert response.getheader(HttpFsResponse.REQUEST_ID_HEADER) == "c0ffee-1"
+            server_timing = response.getheader(HttpFsResponse.SERVER_TIMING_HEADER)
+            assert [metric.split(";")[0] for metric in server_timing.split(", ")] == list(
+                _RequestTimer.PHASES
+            )
+
+            conn.request("GET", "/metrics")
+            response = conn.getresponse()
+            assert response.status == 200
+            metrics_text = response.read().decode()
+            assert 'httpfs_requests_total{op="getattr"} 3' in metrics_text
+            assert "httpfs_connections_active 1" in metrics_text
+
+            # Files are streamed from the file, in several chunks
+            file_data = os.urandom(3 * 1024 * 1024 + 1000)
+            with open(os.path.join(fs_root, "big"), "wb") as big_file:
+                big_file.write(file_data)
+            os.chmod(os.path.join(fs_root, "big"), 0o644)
+            for _ in range(2):
+                conn.request("GET", "/files/big")
+                response = conn.getresponse()
+                assert response.status == 200
+                assert response.read() == file_data
+            conn.close()
+        finally:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+
+def test_mux_connection():
+    with tempfile.TemporaryDirectory() as fs_root:
+        os.mkdir(os.path.join(fs_root, "subdir"))
+        servers = [HttpFsServer(0, fs_root), AsyncHttpFsServer(0, fs_root)]
+        server_threads = [
+            threading.Thread(target=server.serve_forever) for server in servers
+        ]
+        for server_thread in server_threads:
+            server_thread.start()
+
+        try:
+            for server in servers:
+                transport = MuxTransport(
+                    "127.0.0.1",
+                    server.server_address[1],
+                    {"User-Agent": "HttpFsClient/test"}
+                )
+                results = []
+
+                def get_attr(path):
+                    response = transport.post({}, json_dict=HttpFsRequest(
+                        HttpFsRequest.OP_GET_ATTR, {"path": path}
+                    ).as_dict())
+                    results.append((path, HttpFsResponse.from_dict(response.json())))
+
+                # Concurrent requests each get their own response
+                paths = ["/", "/subdir", "/missing"] * 4
+                threads = [
+                    threading.Thread(target=get_attr, args=(path,)) for path in paths
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                assert len(results) == len(paths)
+                for path, response_obj in results:
+                    assert response_obj.is_error() == (path == "/missing")
+
+                # Large reads are sent straight from the file
+                file_data = os.urandom(200 * 1024)
+                with open(os.path.join(fs_root, "file"), "wb") as test_file:
+                    test_file.write(file_data)
+                response = transport.post({}, json_dict=HttpFsRequest(
+                    HttpFsRequest.OP_OPEN,
+                    {"path": "/file", "flags": os.O_RDONLY, "uid": 0, "gid": 0}
+                ).as_dict())
+                handle = response.json()["response_data"]["file_descriptor"]
+                response = transport.post(
+                    {"Accept": HttpFsFrame.CONTENT_TYPE},
+                    json_dict=HttpFsRequest(HttpFsRequest.OP_READ, {
+                        "file_descriptor": handle,
+                        "size": len(file_data),
+                        "offset": 0,
+                        "uid": 0,
+                        "gid": 0
+                    }).as_dict()
+                )
+                response_obj = HttpFsResponse.from_dict(
+                    HttpFsFrame.unpack(response.content, copy_payloads=True)
+                )
+                assert response_obj.get_data()["bytes_read"] == file_data
+
+                # Only the threading engine multiplexes, the asyncio engine
+                # refuses the upgrade
+                is_multiplexed = isinstance(server, HttpFsServer)
+                assert (transport._fallback is None) == is_multiplexed
+        finally:
+            for server, server_thread in zip(servers, server_threads):
+                server.shutdown()
+                server_thread.join()
+                server.server_close()
+
+
+def test_get_file():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = os.path.join(tmp_dir, "root")
+        os.mkdir(fs_root)
+        file_data = os.urandom(100 * 1024)
+        with open(os.path.join(fs_root, "some file"), "wb") as test_file:
+            test_file.write(file_data)
+        os.chmod(os.path.join(fs_root, "some file"), 0o644)
+        with open(os.path.join(tmp_dir, "outside"), "wb") as outside_file:
+            outside_file.write(b"secret")
+        os.symlink(os.path.join(tmp_dir, "outside"), os.path.join(fs_root, "link"))
+
+        server = HttpFsServer(0, fs_root)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+
+            def get(path, **headers):
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                return response, response.read()
+
+            response, body = get("/files/some%20file")
+            assert response.status == 200
+            assert body == file_data
+            etag = response.getheader("ETag")
+            assert response.getheader("Last-Modified") is not None
+
+            # Byte ranges
+            response, body = get("/files/some%20file", Range="bytes=10-19")
+            assert response.status == 206
+            assert body == file_data[10:20]
+            assert response.getheader("Content-Range") == "bytes 10-19/{}".format(
+                len(file_data)
+            )
+            response, body = get("/files/some%20file", Range="bytes=-5")
+            assert body == file_data[-5:]
+            response, body = get("/files/some%20file", Range="bytes=200000-")
+            assert response.status == 416
+
+            # Conditional requests
+            response, body = get("/files/some%20file", **{"If-None-Match": etag})
+            assert response.status == 304
+            assert body == b""
+            response, body = get(
+                "/files/some%20file", Range="bytes=0-9", **{"If-Range": '"old"'}
+            )
+            assert response.status == 200
+
+            # Nothing outside the served directory or not world-readable
+            assert get("/files/link")[0].status == 404
+            assert get("/files/../outside")[0].status == 404
+            assert get("/files/missing")[0].status == 404
+            os.chmod(os.path.join(fs_root, "some file"), 0o600)
+            assert get("/files/some%20file")[0].status == 403
+            conn.close()
+        finally:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+
+def test_compression():
+    with tempfile.TemporaryDirectory() as fs_root:
+        for i in range(200):
+            open(os.path.join(fs_root, "file-{}".format(i)), "w").close()
+
+        server = HttpFsServer(0, fs_root)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+
+            def post(request, **headers):
+                body = json.dumps(request.as_dict()).encode("utf-8")
+                if "Content-Encoding" in headers:
+                    body = zlib.compress(body)
+                conn.request("POST", "/", body=body, headers=dict(headers, **{
+                    "Content-Type": "application/json",
+                    "User-Agent": "HttpFsClient/test"
+                }))
+                response = conn.getresponse()
+                return response, response.read()
+
+            readdir = HttpFsRequest(
+                HttpFsRequest.OP_READDIR, {"path": "/", "uid": 0, "gid": 0}
+            )
+
+            # Large listings are compressed for clients that accept it
+            response, body = post(readdir, **{"Accept-Encoding": "deflate"})
+            assert response.getheader("Content-Encoding") == "deflate"
+            assert "deflate" in response.getheader("Accept-Encoding")
+            listing = json.loads(zlib.decompress(body))
+            assert len(listing["response_data"]["dir_listing"]) == 202
+
+            response, body = post(readdir)
+            assert response.getheader("Content-Encoding") is None
+            assert json.loads(body) == listing
+
+            # Small responses and compressed requests
+            response, body = post(
+                HttpFsRequest(HttpFsRequest.OP_GET_ATTR, {"path": "/file-1"}),
+                **{"Accept-Encoding": "deflate", "Content-Encoding": "deflate"}
+            )
+            assert response.getheader("Content-Encoding") is None
+            assert not HttpFsResponse.from_dict(json.loads(body)).is_error()
+
+            # Large reads are sent straight from the file, uncompressed
+            file_data = b"compressible " * 20000
+            with open(os.path.join(fs_root, "file-1"), "wb") as test_file:
+                test_file.write(file_data)
+            response, body = post(HttpFsRequest(
+                HttpFsRequest.OP_OPEN,
+                {"path": "/file-1", "flags": os.O_RDONLY, "uid": 0, "gid": 0}
+            ))
+            handle = json.loads(body)["response_data"]["file_descriptor"]
+            response, body = post(
+                HttpFsRequest(HttpFsRequest.OP_READ, {
+                    "file_descriptor": handle,
+                    "size": len(file_data),
+                    "offset": 0,
+                    "uid": 0,
+                    "gid": 0
+                }),
+                **{"Accept": HttpFsFrame.CONTENT_TYPE, "Accept-Encoding": "deflate"}
+            )
+            assert response.getheader("Content-Encoding") is None
+            response_dict = HttpFsFrame.unpack(body, copy_payloads=True)
+            assert response_dict["response_data"]["bytes_read"] == file_data
+
+            # Unknown request codings are rejected
+            conn.request("POST", "/", body=b"{}", headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": "unknown",
+                "User-Agent": "HttpFsClient/test"
+            })
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 400
+            conn.close()
+        finally:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+
+def test_compression_bomb():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fs_root = os.path.join(tmp_dir, "root")
+        os.mkdir(fs_root)
+        cred_store_file = os.path.join(tmp_dir, "api-keys.json")
+        api_key = TextCredStore(cred_store_file).add_cred()
+
+        server = HttpFsServer(0, fs_root, cred_store_file=cred_store_file)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+            request = HttpFsRequest(HttpFsRequest.OP_GET_ATTR, {"path": "/"}).as_dict()
+            # About 64 KiB of deflate, just over the limit once inflated
+            padding = b" " * (_JSONRequestHandler.max_request_size + 1)
+            bomb = zlib.compress(json.dumps(request).encode("utf-8") + padding, 9)
+            assert len(bomb) < 1024 * 1024
+
+            def post(body, **headers):
+                conn.request("POST", "/", body=body, headers=dict(headers, **{
+                    "Content-Type": "application/json",
+                    "Content-Encoding": "deflate",
+                    "User-Agent": "HttpFsClient/test"
+                }))
+                response = conn.getresponse()
+                return response.status, json.loads(response.read())
+
+            # Compressed bodies of clients without a valid key aren't inflated
+            with mock.patch.object(
+                HttpFsCompression, "decompress", side_effect=AssertionError
+            ):
+                status, response_dict = post(bomb, Authorization="wrong-key")
+            assert status == 400
+            assert response_dict["response_data"]["message"] == \
+                _JSONRequestHandler.ERR_UNAUTHORIZED
+
+            # Bodies that inflate past max_request_size are rejected
+            status, response_dict = post(bomb, Authorization=api_key)
+            assert status == 400
+            assert "more than" in response_dict["response_data"]["message"]
+
+            # The connection is still usable
+            status, response_dict = post(
+                zlib.compress(json.dumps(request).encode("utf-8")), Authorization=api_key
+            )
+            assert status == 200
+            assert not HttpFsResponse.from_dict(response_dict).is_error()
+            conn.close()
+        finally:
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+
+
+def test_WorkerGroup_handles():
+    single_worker = _WorkerGroup()
+    assert single_worker.to_handle(7) == 7
+    assert single_worker.from_handle(7) == 7
+
+    workers = [_WorkerGroup(index, 3, "/tmp") for index in range(3)]
+    for worker in workers:
+        handle = worker.to_handle(12)
+        assert worker.from_handle(handle) == 12
+        for other_worker in workers:
+            assert other_worker.get_handle_owner(handle) == worker.get_index()
+
+
+class _FakeRequestHandler(_HttpFsRequestHandler):
+    # pylint: disable=super-init-not-called
+    def __init__(self, fs_root):
+        self.client_address = ("127.0.0.1", 0)
+        self._timer = _RequestTimer()
+        self._request_id = None
+        self.server = MagicMock()
+        self.server.get_fs_root.return_value = fs_root
+        self.server.get_cred_store.return_value = None
+        self.server.get_dir_cursors.return_value = _DirCursorTable()
+        self.server.get_file_handles.return_value = _FileHandleTable(_FileLockTable())
+        self.server.get_permissions.return_value = _PermissionCache()
+        self.server.get_worker_group.return_value = _WorkerGroup()
+
+
+def test_readdir_plus():
+    with tempfile.TemporaryDirectory() as fs_root:
+        os.mkdir(os.path.join(fs_root, "subdir"))
+        with open(os.path.join(fs_root, "file"), "wb") as test_file:
+            test_file.write(b"12345")
+
+        request_handler = _FakeRequestHandler(fs_root)
+        response_obj = request_handler.on_readdir_plus(
+            {"path": "/", "uid": 0, "gid": 0}
+        )
+
+        assert not response_obj.is_error()
+        response_data = response_obj.get_data()
+        assert sorted(response_data["dir_listing"]) == [".", "..", "file", "subdir"]
+        assert set(response_data["dir_attrs"]) == {"file", "subdir"}
+        assert response_data["dir_attrs"]["file"]["st_size"] == 5
+        assert stat.S_ISDIR(response_data["dir_attrs"]["subdir"]["st_mode"])
+        assert set(response_data["dir_attrs"]["file"]) == set(
+            _HttpFsRequestHandler.GETATTR_KEYS
+        )
+
+
+def test_rmdir_error():
+    with tempfile.TemporaryDirectory() as fs_root:
+        os.mkdir(os.path.join(fs_root, "subdir"))
+        with open(os.path.join(fs_root, "subdir", "file"), "wb"):
+            pass
+
+        request_handler = _FakeRequestHandler(fs_root)
+        response_obj = request_handler.on_rmdir({"path": "/subdir"})
+        assert response_obj.get_error_no() == errno.ENOTEMPTY
+        response_obj = request_handler.on_rmdir({"path": "/subdir/file"})
+        assert response_obj.get_error_no() == errno.ENOTDIR
+
+
+def test_publish_changes():
+    with tempfile.TemporaryDirectory() as fs_root:
+        os.mkdir(os.path.join(fs_root, "dir"))
+        request_handler = _FakeRequestHandler(fs_root)
+        request_handler._request_id = "c0ffee-3"
+
+        response_obj = request_handler.on_rename(
+            {"old_path": "/dir", "new_path": "/moved", "uid": 0, "gid": 0}
+        )
+        assert not response_obj.is_error()
+        request_handler.server.publish_changes.assert_called_once_with(
+            [("/dir", HttpFsEvent.TREE), ("/moved", HttpFsEvent.TREE)], "c0ffee"
+        )
+
+        # Failed changes aren't published
+        request_handler.on_unlink({"path": "/missing", "uid": 0, "gid": 0})
+        request_handler.server.publish_changes.assert_called_once()
+
+
+def test_readdir_pages():
+    with tempfile.TemporaryDirectory() as fs_root:
+        file_names = ["file{}".format(i) for i in range(5)]
+        for file_name in file_names:
+            open(os.path.join(fs_root, file_name), "wb").close()
+
+        request_handler = _FakeRequestHandler(fs_root)
+        request_args = {"path": "/", "uid": 0, "gid": 0, "page_size": 2}
+        dir_listing = []
+        page_count = 0
+        while True:
+            response_obj = request_handler.on_readdir(request_args)
+            assert not response_obj.is_error()
+            response_data = response_obj.get_data()
+            assert len(response_data["dir_listing"]) <= 4
+            dir_listing.extend(response_data["dir_listing"])
+            page_count += 1
+            if response_data["cursor"] is None:
+                break
+            request_args = {
+                "cursor": response_data["cursor"], "uid": 0, "gid": 0, "page_size": 2
+            }
+
+        assert sorted(dir_listing) == [".", ".."] + file_names
+        assert page_count == 3
+
+        # Another user can't continue the listing, and doesn't end it
+        response_obj = request_handler.on_readdir(
+            {"path": "/", "uid": 0, "gid": 0, "page_size": 2}
+        )
+        cursor = response_obj.get_data()["cursor"]
+        response_obj = request_handler.on_readdir(
+            {"cursor": cursor, "uid": 1000, "gid": 1000, "page_size": 2}
+        )
+        assert response_obj.get_error_no() == errno.EINVAL
+        response_obj = request_handler.on_readdir(
+            {"cursor": cursor, "uid": 0, "gid": 0, "page_size": 2}
+        )
+        assert not response_obj.is_error()
+        request_args = {
+            "cursor": response_obj.get_data()["cursor"], "uid": 0, "gid": 0, "page_size": 2
+        }
+        request_handler.on_readdir(request_args)
+
+        # Cursors are single use
+        response_obj = request_handler.on_readdir(request_args)
+        assert response_obj.get_error_no() == errno.EINVAL
+
+
+def test_compound():
+    with tempfile.TemporaryDirectory() as fs_root:
+        with open(os.path.join(fs_root, "file"), "wb") as test_file:
+            test_file.write(b"12345")
+
+        request_handler = _FakeRequestHandler(fs_root)
+        open_request = HttpFsRequest(
+            HttpFsRequest.OP_OPEN,
+            {"path": "/file", "flags": os.O_RDONLY, "uid": 0, "gid": 0}
+        ).as_dict()
+        read_request = HttpFsRequest(
+            HttpFsRequest.OP_READ,
+            {
+                "file_descriptor": HttpFsRequest.ref(0),
+                "size": 3,
+                "offset": 1,
+                "uid": 0,
+                "gid": 0
+            }
+        ).as_dict()
+
+        # Later requests use the results of earlier ones
+        response_obj = request_handler.on_compound(
+            {"requests": [open_request, read_request]}
+        )
+        responses = [
+            HttpFsResponse.from_dict(r) for r in response_obj.get_data()["responses"]
+        ]
+        assert [r.is_error() for r in responses] == [False, False]
+        assert bytes(responses[1].get_data()["bytes_read"]) == b"234"
+        request_handler.on_release(responses[0].get_data())
+
+        # Requests after a failed one are skipped
+        missing_request = dict(open_request, args=dict(
+            open_request["args"], path="/missing"
+        ))
+        response_obj = request_handler.on_compound(
+            {"requests": [missing_request, open_request]}
+        )
+        responses = response_obj.get_data()["responses"]
+        assert responses[0]["error_no"] != HttpFsResponse.ERR_NONE
+        assert responses[1]["error_no"] == errno.ECANCELED
+
+        # Or run anyway, unless they depend on the failed one
+        response_obj = request_handler.on_compound({
+            "requests": [missing_request, read_request, open_request],
+            "stop_on_error": False
+        })
+        responses = response_obj.get_data()["responses"]
+        assert [r["error_no"] for r in responses[1:]] == [
+            errno.ECANCELED, HttpFsResponse.ERR_NONE
+        ]
+        request_handler.on_release(responses[2]["response_data"])
+        assert not request_handler.get_file_handles()
+
+        # Handles opened before a failed step are still released
+        write_only_request = dict(open_request, args=dict(
+            open_request["args"], flags=os.O_WRONLY
+        ))
+        release_request = HttpFsRequest(
+            HttpFsRequest.OP_RELEASE,
+            {"file_descriptor": HttpFsRequest.ref(0), "uid": 0, "gid": 0}
+        ).as_dict()
+        response_obj = request_handler.on_compound(
+            {"requests": [write_only_request, read_request, release_request]}
+        )
+        responses = response_obj.get_data()["responses"]
+        assert responses[0]["error_no"] == HttpFsResponse.ERR_NONE
+        assert responses[1]["error_no"] != HttpFsResponse.ERR_NONE
+        assert responses[2]["error_no"] == HttpFsResponse.ERR_NONE
+        assert not request_handler.get_file_handles()
+
+        # Compound requests don't nest
+        response_obj = request_handler.on_compound({
+            "requests": [{"type": HttpFsRequest.OP_COMPOUND, "args": {"requests": []}}]
+        })
+        assert response_obj.get_data()["responses"][0]["error_no"] == errno.ENOSYS
+
+
+def test_FileRegion():
+    with tempfile.TemporaryDirectory() as fs_root:
+        file_data = os.urandom(200 * 1024)
+        with open(os.path.join(fs_root, "file"), "wb") as test_file:
+            test_file.write(file_data)
+
+        # Large reads are sent straight from the file
+        request_handler = _FakeRequestHandler(fs_root)
+        handle = request_handler.on_open(
+            {"path": "/file", "flags": os.O_RDONLY, "uid": 0, "gid": 0}
+        ).get_data()["file_descriptor"]
+        response_obj = request_handler.on_read({
+            "file_descriptor": handle,
+            "size": 1024 * 1024,
+            "offset": 1000,
+            "uid": 0,
+            "gid": 0
+        })
+        file_region = response_obj.get_data()["bytes_read"]
+        assert isinstance(file_region, _FileRegion)
+        assert len(file_region) == len(file_data) - 1000
+
+        # The region outlives the client's file handle
+        request_handler.on_release({"file_descriptor": handle})
+        assert request_handler.get_file_handles().get_open_fds() == 0
+        assert file_region.read() == file_data[1000:]
+
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            received = []
+            receive_thread = threading.Thread(target=lambda: received.append(
+                receiver.makefile("rb").read(len(file_region))
+            ))
+            receive_thread.start()
+            assert file_region.send(sender) == len(file_region)
+            receive_thread.join()
+            assert received[0] == file_data[1000:]
+
+        # Truncation while it's sent shows up as a short send
+        os.truncate(os.path.join(fs_root, "file"), 5000)
+        assert file_region.read() == file_data[1000:5000]
+        file_region.close()
+
+
+def test_PermissionCache():
+    permissions = _PermissionCache(stat_ttl=60, max_entries=2)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "file")
+        with open(path, "w"):
+            pass
+        os.chmod(path, 0o640)
+        owner, group = os.stat(path).st_uid + 1, os.stat(path).st_gid + 1
+        os.chown(path, owner, group)
+
+        # Owner, group and other bits, root may do anything
+        assert permissions.check(path, owner, 0, os.R_OK | os.W_OK)
+        assert permissions.check(path, 1000, group, os.R_OK)
+        assert not permissions.check(path, 1000, group, os.W_OK)
+        assert not permissions.check(path, 1000, 1000, os.R_OK)
+        assert permissions.check(path, 1000, 1000, os.F_OK)
+        assert permissions.check(path, 0, 0, os.R_OK | os.W_OK | os.X_OK)
+
+        # Stat results are reused until the path is invalidated
+        os.chmod(path, 0o644)
+        assert not permissions.check(path, 1000, 1000, os.R_OK)
+        permissions.invalidate(tmp_dir, recursive=True)
+        assert permissions.check(path, 1000, 1000, os.R_OK)
+
+        # The oldest entries go once there are too many
+        permissions.get_stats(tmp_dir)
+        permissions.get_stats("/")
+        assert path not in permissions._stats
+        assert len(permissions._stats) == 2
+
+        # Open files keep the access they were opened with
+        assert permissions.get_open_mode(os.O_RDONLY) == os.R_OK
+        assert permissions.get_open_mode(os.O_WRONLY | os.O_TRUNC) == os.W_OK
+        assert permissions.get_open_mode(os.O_RDWR) == os.R_OK | os.W_OK
+        fd = os.open(path, os.O_RDONLY)
+        open_file = _OpenFile(fd, path, os.O_RDONLY, "client", 1000, 1000, os.R_OK)
+        os.chmod(path, 0o600)
+        assert permissions.check_file(open_file, 1000, 1000, os.R_OK)
+        assert not permissions.check_file(open_file, 1000, 1000, os.W_OK)
+
+        # Other users are checked against the file's current mode
+        assert not permissions.check_file(open_file, 1001, 1001, os.R_OK)
+        os.close(fd)
+
+
+def test_FileHandleTable():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [os.path.join(tmp_dir, "file{}".format(i)) for i in range(3)]
+        for i, path in enumerate(paths):
+            with open(path, "wb") as test_file:
+                test_file.write(bytes([i]))
+
+        handles = _FileHandleTable(_FileLockTable(), max_open_fds=1)
+        handle_ids = [
+            handles.add(os.open(path, os.O_RDONLY), path, os.O_RDONLY, "a", 0, 0, os.R_OK)
+            for path in paths
+        ]
+        assert len(handles) == 3
+
+        # Only the most recently used file keeps its fd, the others are
+        # reopened when they're used
+        assert handles.get_open_fds() == 1
+        for i, handle_id in enumerate(handle_ids):
+            with handles.use(handle_id, "a") as open_file:
+                assert os.pread(open_file.fd, 1, 0) == bytes([i])
+        assert handles.get_open_fds() == 1
+
+        # Handles belong to the client that opened them
+        try:
+            with handles.use(handle_ids[0], "b"):
+                pass
+            assert False
+        except OSError as e:
+            assert e.errno == errno.EBADF
+
+        # Files replaced while parked can't be reopened
+        with open(paths[0] + ".new", "wb"):
+            pass
+        os.rename(paths[0] + ".new", paths[0])
+        try:
+            with handles.use(handle_ids[0], "a"):
+                pass
+            assert False
+        except OSError as e:
+            assert e.errno == errno.ESTALE
+
+        # Files unlinked while open keep their fd
+        with handles.use(handle_ids[1], "a"):
+            pass
+        os.unlink(paths[1])
+        with handles.use(handle_ids[2], "a"):
+            pass
+        assert handles.get_open_fds() == 2
+        with handles.use(handle_ids[1], "a") as open_file:
+            assert os.pread(open_file.fd, 1, 0) == b"\x01"
+
+        for handle_id in handle_ids:
+            handles.close(handle_id, "a")
+        assert len(handles) == 0
+        assert handles.get_open_fds() == 0
+
+        # Handles unused for idle_timeout are closed
+        idle_handles = _FileHandleTable(_FileLockTable(), idle_timeout=60)
+        handle_id = idle_handles.add(
+            os.open(paths[2], os.O_RDONLY), paths[2], os.O_RDONLY, "a", 0, 0, os.R_OK
+        )
+        idle_handles._handles[handle_id].last_used -= 120
+        idle_handles._last_reap -= 120
+        idle_handles.add(
+            os.open(paths[2], os.O_RDONLY), paths[2], os.O_RDONLY, "a", 0, 0, os.R_OK
+        )
+        assert len(idle_handles) == 1
+        assert idle_handles.get_open_fds() == 1
+
+        # Also when no files are opened, the handle in use is kept
+        handle_id = idle_handles.add(
+            os.open(paths[2], os.O_RDONLY), paths[2], os.O_RDONLY, "a", 0, 0, os.R_OK
+        )
+        for open_file in idle_handles._handles.values():
+            open_file.last_used -= 120
+        idle_handles._last_reap -= 120
+        with idle_handles.use(handle_id, "a"):
+            pass
+        assert len(idle_handles) == 1
+        assert idle_handles.get_open_fds() == 1
+
+        # Files are reopened and stat'ed without holding the table's lock
+        handles = _FileHandleTable(_FileLockTable(), max_open_fds=1)
+        handle_ids = [
+            handles.add(os.open(paths[2], os.O_RDONLY), paths[2], os.O_RDONLY, "a", 0, 0, os.R_OK)
+            for _ in range(2)
+        ]
+        real_open, real_stat = os.open, os.stat
+
+        def stat_unlocked(*args, **kwargs):
+            assert not handles._guard.locked()
+            return real_stat(*args, **kwargs)
+
+        with mock.patch("os.stat", side_effect=stat_unlocked) as patched_stat:
+            with handles.use(handle_ids[0], "a") as open_file:
+                assert os.pread(open_file.fd, 1, 0) == b"\x02"
+        assert patched_stat.called
+        assert handles.get_open_fds() == 1
+
+        # A handle closed while its file is reopened isn't given the new fd
+        def open_and_close(*args, **kwargs):
+            assert not handles._guard.locked()
+            handles.close(handle_ids[1], "a")
+            return real_open(*args, **kwargs)
+
+        with mock.patch("os.open", side_effect=open_and_close):
+            try:
+                with handles.use(handle_ids[1], "a"):
+                    pass
+                assert False
+            except OSError as e:
+                assert e.errno == errno.EBADF
+        assert len(handles) == 1
+        assert handles.get_open_fds() == 1
+
+
+def test_ServerMetrics():
+    metrics = _ServerMetrics()
+    labels = (("op", "read"),)
+
+    # Threads record separately, exited threads are kept in the totals
+    def record():
+        metrics.add("httpfs_requests_total", labels=labels)
+        metrics.observe("httpfs_request_duration_seconds", 0.002, labels)
+
+    threads = [threading.Thread(target=record) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    record()
+    metrics.add("httpfs_read_bytes_total", 4096)
+    metrics.add("httpfs_connections_total", 2)
+    metrics.add("httpfs_connections_closed")
+
+    snapshot = json.loads(json.dumps(metrics.collect({"httpfs_open_handles": 5})))
+    assert len(metrics._threads) == 1
+
+    metrics_text = _ServerMetrics.render([((("worker", "1"),), snapshot)])
+    lines = metrics_text.splitlines()
+    assert lines.count("# TYPE httpfs_request_duration_seconds histogram") == 1
+    assert 'httpfs_requests_total{worker="1",op="read"} 4' in lines
+    assert 'httpfs_request_duration_seconds_bucket{worker="1",op="read",le="0.001"} 0' in lines
+    assert 'httpfs_request_duration_seconds_bucket{worker="1",op="read",le="0.0025"} 4' in lines
+    assert 'httpfs_request_duration_seconds_bucket{worker="1",op="read",le="+Inf"} 4' in lines
+    assert 'httpfs_request_duration_seconds_count{worker="1",op="read"} 4' in lines
+    assert 'httpfs_read_bytes_total{worker="1"} 4096' in lines
+    assert 'httpfs_connections_active{worker="1"} 1' in lines
+    assert 'httpfs_open_handles{worker="1"} 5' in lines
+    assert "httpfs_connections_closed" not in metrics_text
+
+
+def test_RequestTimer():
+    timer = _RequestTimer()
+    timer.lap("parse")
+    # Time in a measure() block isn't charged to the next lap
+    with timer.measure("dispatch"):
+        time.sleep(0.02)
+    timer.lap("syscall")
+
+    phases = timer.get_phases()
+    assert phases["dispatch"] >= 0.02
+    assert phases["syscall"] < 0.02
+    assert phases["auth"] == 0.0
+    assert timer.get_elapsed() >= sum(phases.values())
+    assert timer.get_server_timing().startswith("parse;dur=")
+
+    # Permission checks in the handlers are charged to auth
+    request_handler = _FakeRequestHandler("/")
+    with mock.patch.object(
+        _PermissionCache, "check", side_effect=lambda *args: time.sleep(0.02) or True
+    ):
+        assert request_handler.check_access("/", 1000, 1000, os.R_OK)
+    phases = request_handler._timer.get_phases()
+    assert phases["auth"] >= 0.02
+    assert phases["dispatch"] == 0.0
+
+
+def test_DirCursorTable():
+    cursors = _DirCursorTable(idle_timeout=60, max_cursors=2)
+    iterators = [MagicMock() for _ in range(3)]
+    cursor_ids = [cursors.put(iterator, "client", 0) for iterator in iterators]
+
+    # The oldest cursor is closed to stay under max_cursors
+    iterators[0].close.assert_called_once()
+    assert cursors.take(cursor_ids[0], "client", 0) is None
+
+    # Only the client and user that started the listing can continue it
+    assert cursors.take(cursor_ids[1], "other-client", 0) is None
+    assert cursors.take(cursor_ids[1], "client", 1000) is None
+    assert cursors.take(cursor_ids[1], "client", 0) is iterators[1]
+    assert cursors.take(cursor_ids[1], "client", 0) is None
+
+    expired_cursors = _DirCursorTable(idle_timeout=-1)
+    cursor_id = expired_cursors.put(iterators[2], "client", 0)
+    assert expired_cursors.take(cursor_id, "client", 0) is None
+    iterators[2].close.assert_called_once()
+
+
+def test_InvalidationLog():
+    log = _InvalidationLog(max_events=4)
+
+    def poll(since, log_id=None, **params):
+        query = _InvalidationLog.parse_query(urllib.parse.urlencode(dict(
+            params, log=log_id or log.get_log_id(), since=since
+        )))
+        events, next_seq, reset = log.get_events(query)
+        return [(e.get_path(), e.get_change()) for e in events], next_seq, reset
+
+    # The first poll only learns where the log is
+    first = _InvalidationLog.parse_query("")
+    assert log.has_events(first)
+    assert log.get_events(first) == ([], 0, False)
+
+    log.publish([("/a/1", HttpFsEvent.DATA), ("/b", HttpFsEvent.ENTRY)], "me")
+    log.publish([("/a/1", HttpFsEvent.DATA)], "other")
+    assert poll(0) == (
+        [("/a/1", "data"), ("/b", "entry"), ("/a/1", "data")], 3, False
+    )
+    assert poll(1, origin="me") == ([("/a/1", "data")], 3, False)
+    assert poll(0, path="/a") == ([("/a/1", "data"), ("/a/1", "data")], 3, False)
+
+    # Repeated changes take one slot
+    log.publish([("/a/1", HttpFsEvent.DATA)] * 3, "other")
+    assert poll(2) == ([("/a/1", "data")], 6, False)
+    assert poll(6) == ([], 6, False)
+    assert not log.wait(_InvalidationLog.parse_query(
+        "log={}&since=6".format(log.get_log_id())
+    ), 0.01)
+
+    # Clients that fell behind the evicted changes, or poll another log,
+    # must reset
+    log.publish([("/c", HttpFsEvent.ATTR), ("/d", HttpFsEvent.ATTR)])
+    assert poll(0) == ([], 8, True)
+    assert poll(1) == (
+        [("/b", "entry"), ("/a/1", "data"), ("/c", "attr"), ("/d", "attr")], 8, False
+    )
+    assert poll(1, log_id="restarted") == ([], 8, True)
+
+    # Polls wake up when a change is published
+    query = _InvalidationLog.parse_query("log={}&since=8".format(log.get_log_id()))
+    threading.Timer(0.05, log.publish, [[("/e", HttpFsEvent.DATA)]]).start()
+    assert log.wait(query, 5)
+
+
+def test_events_long_poll():
+    for server_class in (HttpFsServer, AsyncHttpFsServer):
+        with tempfile.TemporaryDirectory() as fs_root:
+            server = server_class(0, fs_root)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+
+            try:
+                port = server.server_address[1]
+                events_conn = http.client.HTTPConnection("127.0.0.1", port)
+                events_conn.request("GET", HttpFsEvent.URL_PATH)
+                start = json.loads(events_conn.getresponse().read())
+                assert start["next"] == 0 and not start["reset"]
+
+                def make_dirs():
+                    conn = http.client.HTTPConnection("127.0.0.1", port)
+                    for path, request_id in [("/mine", "me-1"), ("/theirs", "them-1")]:
+                        request = HttpFsRequest(
+                            HttpFsRequest.OP_MKDIR,
+                            {"path": path, "mode": 0o755},
+                            request_id=request_id
+                        )
+                        conn.request(
+                            "POST",
+                            "/",
+                            body=json.dumps(request.as_dict()),
+                            headers={
+                                "Content-Type": "application/json",
+                                "User-Agent": "HttpFsClient/test"
+                            }
+                        )
+                        conn.getresponse().read()
+                    conn.close()
+
+                # The poll waits for a change the client didn't make itself
+                threading.Timer(0.1, make_dirs).start()
+                events_conn.request("GET", "{}?log={}&since=0&origin=me&timeout=10".format(
+                    HttpFsEvent.URL_PATH, start["log"]
+                ))
+                response = json.loads(events_conn.getresponse().read())
+                assert response["events"] == [{"path": "/theirs", "change": "entry"}]
+                assert response["next"] == 2
+
+                poll_start = time.monotonic()
+                events_conn.request("GET", "{}?log={}&since=2&timeout=0.2".format(
+                    HttpFsEvent.URL_PATH, start["log"]
+                ))
+                assert json.loads(events_conn.getresponse().read())["events"] == []
+                assert time.monotonic() - poll_start >= 0.2
+                events_conn.close()
+            finally:
+                server.shutdown()
+                server_thread.join()
+                server.server_close()